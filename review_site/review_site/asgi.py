@@ -5,6 +5,9 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+
+通知のSSE（/api/notifications/stream/）は接続を保持し続けるため、
+本番ではASGIサーバーで起動する（例: gunicorn review_site.asgi:application -k uvicorn.workers.UvicornWorker）。
 """
 
 import os
@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import sys
 import dj_database_url
 import cloudinary
 import cloudinary.uploader
@@ -40,6 +41,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware', # WhiteNoiseを一番上に近い位置に追加
+    'reviews.sql_instrumentation.SQLInstrumentationMiddleware', # リクエストごとのSQL計測（静的ファイルは対象外）
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -61,6 +63,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'reviews.sse.sse_context',  # EventSourceを使うか（ASGIのときだけ）
             ],
         },
     },
@@ -105,11 +108,113 @@ STATIC_ROOT = BASE_DIR / 'staticfiles' # collectstaticの出力先
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 # --- メディアファイル (画像アップロード) の設定 ---
-# 画像はデータベースにBase64形式で保存するため、メディアファイル設定は不要
+# 画像はコンテンツのハッシュ値をキーにしてブロブストレージに保存する
+BLOB_STORAGE_BACKEND = os.environ.get('BLOB_STORAGE_BACKEND', 'reviews.blobstore.LocalFileSystemBlobStore')
+BLOB_STORAGE_ROOT = Path(os.environ.get('BLOB_STORAGE_ROOT', BASE_DIR / 'blob_storage'))
+
+# アップロード画像の変換はリクエストの外（プロセスプール）で行う
+IMAGE_PROCESSING_ASYNC = os.environ.get('IMAGE_PROCESSING_ASYNC', 'True').lower() == 'true'
+IMAGE_PROCESSING_WORKERS = int(os.environ.get('IMAGE_PROCESSING_WORKERS', '2'))
+# 再起動などで失われた処理は、予約からこの分数が過ぎたら manage.py recover_image_jobs で「失敗」にする
+IMAGE_PROCESSING_STALE_MINUTES = int(os.environ.get('IMAGE_PROCESSING_STALE_MINUTES', '30'))
+
+# --- 推薦 ---
+# manage.py build_people_suggestions などで作った推薦の配列の保存先
+RECOMMENDATION_ROOT = Path(os.environ.get('RECOMMENDATION_ROOT', BASE_DIR / 'recommendations'))
+# レビュー投稿時の類似店舗の再計算をリクエストの外（スレッド）で行う
+RECOMMENDATION_UPDATE_ASYNC = os.environ.get('RECOMMENDATION_UPDATE_ASYNC', 'True').lower() == 'true'
 
 # --- 主キーの型設定 ---
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# --- 店舗検索の設定 ---
+# 空ならDBに合わせて自動選択（SQLite: FTS5、PostgreSQL: pg_trgm）
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', '')
+
+# --- キャッシュ設定 ---
+# CACHE_BACKEND=file にするとファイルに保存する（同じサーバーの複数プロセスで共有できる）
+# locmem はプロセスごとのメモリに保存する。店舗ページのバージョン番号を全ワーカーで共有しないと
+# 他のワーカーが古いページ（とそのETag）を返し続けるので、ワーカーが複数なら既定で file にする
+# （WEB_CONCURRENCY は gunicorn がワーカー数の既定値に使う環境変数）
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', '1'))
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'file' if WEB_CONCURRENCY > 1 else 'locmem')
+if CACHE_BACKEND == 'file':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('CACHE_LOCATION', str(BASE_DIR / 'django_cache')),
+            'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', '10000'))},
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'review-site',
+            'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', '3000'))},
+        }
+    }
+
+# 店舗ページ（未ログイン向けのページ全体・店舗カードの断片）をキャッシュする秒数
+STORE_PAGE_CACHE_TIMEOUT = 600
+
+# フォロー関係（FollowGraph）をユーザーごとにキャッシュする秒数
+FOLLOW_GRAPH_CACHE_TIMEOUT = 300
+
+# 未読通知数のカウンタをキャッシュする秒数
+NOTIFICATION_COUNT_CACHE_TIMEOUT = 300
+
+# --- レビュー通知のファンアウト ---
+# フォロワーへの通知の作成をリクエストの外（スレッド）で行う
+NOTIFICATION_FANOUT_ASYNC = os.environ.get('NOTIFICATION_FANOUT_ASYNC', 'True').lower() == 'true'
+# 一度に読むフォロワー・bulk_createする通知の数
+NOTIFICATION_FANOUT_CHUNK_SIZE = int(os.environ.get('NOTIFICATION_FANOUT_CHUNK_SIZE', '500'))
+# この秒数以内の同じ人からの未読のレビュー通知は1件にまとめる
+NOTIFICATION_COALESCE_SECONDS = 600
+
+# --- 通知の保存期間（manage.py purge_notifications） ---
+# 既読の通知を残す日数
+NOTIFICATION_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_RETENTION_DAYS', '90'))
+# ユーザーごとに残す既読の通知の上限
+NOTIFICATION_HISTORY_LIMIT = int(os.environ.get('NOTIFICATION_HISTORY_LIMIT', '200'))
+
+# --- リアルタイム通知（SSE）の設定 ---
+# Pub/Subのバックエンド（InProcessBrokerは同じプロセス内にしか届かない）
+PUBSUB_BACKEND = os.environ.get('PUBSUB_BACKEND', 'reviews.pubsub.InProcessBroker')
+# 接続維持のためのコメントを送る間隔（秒）
+SSE_HEARTBEAT_INTERVAL = 25
+
+# --- SQL計測の設定 ---
+# リクエストごとのクエリ数・SQL時間を計測し、DEBUGレベルのログ（reviews.sql）に出す
+SQL_INSTRUMENTATION = os.environ.get('SQL_INSTRUMENTATION', 'True').lower() == 'true'
+# 計測結果をServer-Timingヘッダーでも返すか（誰にでも見えるので開発時だけ）
+SQL_SERVER_TIMING = os.environ.get('SQL_SERVER_TIMING', str(DEBUG)).lower() == 'true'
+# @query_budgetの上限を超えたときに例外にするか（テスト実行時は例外、本番は警告ログのみ）
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+QUERY_BUDGET_RAISE = os.environ.get('QUERY_BUDGET_RAISE', str(TESTING)).lower() == 'true'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # クエリ数の上限超過は WARNING、リクエストごとの計測結果は DEBUG
+        'reviews.sql': {
+            'handlers': ['console'],
+            'level': os.environ.get('SQL_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+        # レビュー通知のファンアウトの遅延・チャンクの大きさ
+        'reviews.notifications': {
+            'handlers': ['console'],
+            'level': os.environ.get('NOTIFICATION_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 # --- ログイン・ログアウトのリダイレクト設定 ---
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = '/'
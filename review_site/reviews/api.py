@@ -0,0 +1,147 @@
+# reviews/api.py
+"""
+読み取り専用のJSON API（/api/v1/）の直列化。
+
+モデルのインスタンスを作らず、.values() の行（dict）から直接JSONを組み立てる。
+?fields=id,name,... で返す項目を選べ、選ばれた項目に必要な列だけをSELECTするので、
+コメントのような重い列や不要な結合を省ける。
+評価統計はレビューを数えず、集計テーブル（StoreRatingSummary）の列を結合して読むだけ。
+"""
+from django.urls import reverse
+
+from .models import Review, Store
+
+
+class ApiError(Exception):
+    """クライアントの指定が不正（400を返す）"""
+
+
+class ApiField:
+    """APIの項目。columns は .values() に渡す列、build は行から値を作る関数"""
+
+    def __init__(self, columns, build=None):
+        self.columns = columns
+        self.build = build
+
+
+def _column(name):
+    return ApiField([name], lambda row: row[name])
+
+
+def _datetime(name):
+    return ApiField([name], lambda row: row[name].isoformat() if row[name] else None)
+
+
+RATING_LABELS = dict(Review.RATING_CHOICES)
+
+_RATING_COLUMNS = {
+    'review_count': 'rating_summary__review_count',
+    'average': 'rating_summary__rating_average',
+    'last_review_at': 'rating_summary__last_review_at',
+}
+_RATING_COUNT_COLUMNS = {value: f'rating_summary__rating_{value}_count' for value, _ in Review.RATING_CHOICES}
+
+
+def _rating(row):
+    # まだレビューのない店舗は集計行がない（LEFT JOINの列がNone）
+    last_review_at = row[_RATING_COLUMNS['last_review_at']]
+    return {
+        'review_count': row[_RATING_COLUMNS['review_count']] or 0,
+        'average': round(row[_RATING_COLUMNS['average']] or 0, 2),
+        'last_review_at': last_review_at.isoformat() if last_review_at else None,
+        'counts': [
+            {'rating': value, 'label': RATING_LABELS[value], 'count': row[column] or 0}
+            for value, column in _RATING_COUNT_COLUMNS.items()
+        ],
+    }
+
+
+STORE_FIELDS = {
+    'id': _column('id'),
+    'name': _column('name'),
+    'address': _column('address'),
+    'comment': _column('comment'),
+    'website_url': _column('website_url'),
+    'created_at': _datetime('created_at'),
+    'url': ApiField(['id'], lambda row: reverse('store_detail', args=[row['id']])),
+    'image_url': ApiField(
+        ['image_key'],
+        lambda row: reverse('blob_image', args=[row['image_key']]) if row['image_key'] else None,
+    ),
+    'created_by': ApiField(
+        ['created_by_id', 'created_by__username'],
+        lambda row: {'id': row['created_by_id'], 'username': row['created_by__username']},
+    ),
+    'rating': ApiField([*_RATING_COLUMNS.values(), *_RATING_COUNT_COLUMNS.values()], _rating),
+    # タグは別の1クエリでまとめて読む（attach_store_tags）
+    'tags': ApiField(['id']),
+}
+
+REVIEW_FIELDS = {
+    'id': _column('id'),
+    'rating': _column('rating'),
+    'rating_label': ApiField(['rating'], lambda row: RATING_LABELS.get(row['rating'])),
+    'comment': _column('comment'),
+    'created_at': _datetime('created_at'),
+    'user': ApiField(['user_id', 'user__username'], lambda row: {'id': row['user_id'], 'username': row['user__username']}),
+    'reactions': ApiField(
+        ['good_count', 'bad_count', 'question_count'],
+        lambda row: {'good': row['good_count'], 'bad': row['bad_count'], 'question': row['question_count']},
+    ),
+}
+
+# カーソルを作るために常に取得する列
+_KEYSET_COLUMNS = ['id', 'created_at']
+
+
+def parse_fields(request, available):
+    """?fields= を項目名のリストにする（省略時はすべての項目）"""
+    raw = request.GET.get('fields')
+    if not raw:
+        return list(available)
+    names = [name.strip() for name in raw.split(',') if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ApiError(f'不明な項目です: {", ".join(unknown)}（使える項目: {", ".join(available)}）')
+    # 重複を除き、指定された順に並べる
+    return list(dict.fromkeys(names))
+
+
+def parse_tag_ids(request):
+    """?tag=1&tag=2 をタグIDのリストにする"""
+    try:
+        return [int(value) for value in request.GET.getlist('tag')]
+    except ValueError:
+        raise ApiError('tag にはタグIDを指定してください')
+
+
+def select_columns(fields, available):
+    """選ばれた項目に必要な列（カーソル用の列を含む）"""
+    columns = list(_KEYSET_COLUMNS)
+    for name in fields:
+        columns.extend(available[name].columns)
+    return list(dict.fromkeys(columns))
+
+
+def attach_store_tags(rows):
+    """店舗の行に tags を付ける（ページ内の店舗のタグを1回のクエリで読む）"""
+    tags = {row['id']: [] for row in rows}
+    if not tags:
+        return
+    links = (Store.tags.through.objects
+             .filter(store_id__in=list(tags))
+             .order_by('tag__name')
+             .values_list('store_id', 'tag_id', 'tag__name', 'tag__color'))
+    for store_id, tag_id, name, color in links:
+        tags[store_id].append({'id': tag_id, 'name': name, 'color': color})
+    for row in rows:
+        row['tags'] = tags[row['id']]
+
+
+def serialize_rows(rows, fields, available):
+    """行を選ばれた項目だけのdictにする"""
+    builders = [
+        (name, available[name].build or (lambda row, name=name: row[name]))
+        for name in fields
+    ]
+    return [{name: build(row) for name, build in builders} for row in rows]
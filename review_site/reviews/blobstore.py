@@ -0,0 +1,91 @@
+# reviews/blobstore.py
+"""
+画像などのバイナリデータを保存するためのブロブストレージ。
+
+データはSHA-256のハッシュ値をキーとして保存する（コンテンツアドレス方式）。
+同じ内容の画像は同じキーになるため重複して保存されず、
+キーが変わらない限り中身も変わらないので、ブラウザに長期間キャッシュさせられる。
+"""
+import hashlib
+import os
+import re
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# キーはSHA-256の16進文字列（64文字）
+BLOB_KEY_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def make_blob_key(data):
+    """バイト列からブロブのキーを計算する"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_valid_blob_key(key):
+    return bool(key) and BLOB_KEY_RE.match(key) is not None
+
+
+class LocalFileSystemBlobStore:
+    """
+    ローカルファイルシステムにブロブを保存するバックエンド。
+    1ディレクトリにファイルが集中しないよう、キーの先頭4文字で2階層に分ける。
+    """
+
+    def __init__(self, root=None):
+        self.root = Path(root or settings.BLOB_STORAGE_ROOT)
+
+    def path(self, key):
+        if not is_valid_blob_key(key):
+            raise ValueError(f"不正なブロブキーです: {key!r}")
+        return self.root / key[:2] / key[2:4] / key
+
+    def exists(self, key):
+        return self.path(key).exists()
+
+    def put(self, data):
+        """データを保存してキーを返す（既に同じデータがあれば書き込まない）"""
+        key = make_blob_key(data)
+        path = self.path(key)
+        if path.exists():
+            return key
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 一時ファイルに書いてから置き換えることで、書きかけのファイルが読まれないようにする
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return key
+
+    def open(self, key):
+        """読み込み用のファイルオブジェクトを返す（存在しない場合はFileNotFoundError）"""
+        return open(self.path(key), 'rb')
+
+    def read(self, key):
+        with self.open(key) as f:
+            return f.read()
+
+    def size(self, key):
+        return self.path(key).stat().st_size
+
+    def delete(self, key):
+        try:
+            self.path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+
+@lru_cache(maxsize=None)
+def get_blob_store():
+    """settings.BLOB_STORAGE_BACKENDで指定されたバックエンドを返す"""
+    backend = getattr(settings, 'BLOB_STORAGE_BACKEND', 'reviews.blobstore.LocalFileSystemBlobStore')
+    return import_string(backend)()
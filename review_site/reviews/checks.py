@@ -0,0 +1,20 @@
+# reviews/checks.py
+"""設定のチェック（manage.py check や runserver・migrate の実行時に行われる）"""
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+LOCMEM_BACKEND = 'django.core.cache.backends.locmem.LocMemCache'
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """店舗ページのバージョン番号などを置くキャッシュが、複数のワーカーで共有されているか"""
+    workers = getattr(settings, 'WEB_CONCURRENCY', 1)
+    if workers > 1 and settings.CACHES['default']['BACKEND'] == LOCMEM_BACKEND:
+        return [Error(
+            f'ワーカーが{workers}個あるのに、キャッシュがプロセスごとの locmem です。',
+            hint=('あるワーカーでの書き込みが他のワーカーの店舗ページのキャッシュ・ETagに反映されません。'
+                  'CACHE_BACKEND=file など、プロセス間で共有されるキャッシュを使ってください。'),
+            id='reviews.E001',
+        )]
+    return []
@@ -0,0 +1,72 @@
+# reviews/conditional.py
+"""
+条件付きGET（ETag / Last-Modified）の検証子。
+
+django.views.decorators.http.condition と組み合わせて使う。
+検証子は描画に必要なクエリを実行せずに安く求められるもの（集計1回・キャッシュのバージョン番号）だけから作るので、
+ブラウザが持っている内容と一致すればビュー本体を呼ばずに304を返せる。
+
+ログインユーザーのページには個人ごとの表示（オーナー用の操作・友達バッジ・CSRFトークン）が含まれるので、
+ユーザーIDやCSRFのシークレットも検証子に含める。
+"""
+import hashlib
+
+from django.db.models import Count, Max
+
+from .follow_graph import get_follow_graph
+from .models import Tag
+from .page_cache import get_global_version, get_store_version
+from .store_recommendations import index_version
+
+
+def _hash(*parts):
+    return hashlib.sha1(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def _viewer(request, include_follow_graph=False):
+    """閲覧者ごとに変わる部分"""
+    if not request.user.is_authenticated:
+        return 'anonymous'
+    parts = [request.user.id, request.META.get('CSRF_COOKIE', '')]
+    if include_follow_graph:
+        graph = get_follow_graph(request)
+        parts.append(','.join(map(str, sorted(graph.following_ids))))
+        parts.append(','.join(map(str, sorted(graph.follower_ids))))
+    return _hash(*parts)
+
+
+def _tag_stats(request):
+    """タグの件数と最終作成日時（1リクエストで1回だけ集計する）"""
+    if not hasattr(request, '_tag_stats'):
+        request._tag_stats = Tag.objects.aggregate(count=Count('id'), last_created_at=Max('created_at'))
+    return request._tag_stats
+
+
+def tags_etag(request):
+    stats = _tag_stats(request)
+    last_created_at = stats['last_created_at'].isoformat() if stats['last_created_at'] else ''
+    return _hash('tags', stats['count'], last_created_at)
+
+
+def tags_last_modified(request):
+    return _tag_stats(request)['last_created_at']
+
+
+def store_list_etag(request):
+    # ログインユーザーにはおすすめの店舗も表示する（おすすめを再構築すると変わる）
+    return _hash('store_list', get_global_version(), index_version(), _viewer(request))
+
+
+def store_detail_etag(request, store_id):
+    return _hash(
+        'store_detail', store_id, get_store_version(store_id), index_version(),
+        _viewer(request, include_follow_graph=True),
+    )
+
+
+def api_stores_etag(request):
+    return _hash('api_stores', get_global_version(), request.GET.urlencode())
+
+
+def api_store_reviews_etag(request, store_id):
+    return _hash('api_store_reviews', store_id, get_store_version(store_id), request.GET.urlencode())
@@ -0,0 +1,64 @@
+# reviews/direct_messages.py
+"""
+DMの差分取得とリアルタイム配信。
+
+メッセージが送信・削除されたら、コミット後に会話のチャンネル（dm:{会話ID}）へPub/Subで送る。
+会話画面はSSEでこのチャンネルを購読し、届いたメッセージだけを画面に追加する。
+再接続時や取りこぼしの確認には「ID N より後のメッセージ」だけをDBから読む。
+会話を開いたときは、相手からの未読メッセージをまとめて既読にする。
+"""
+from django.db import transaction
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import DirectMessage
+from .pubsub import publish
+
+# 1回の差分取得で返す最大件数
+MAX_MESSAGES_PER_FETCH = 100
+
+
+def conversation_channel(conversation_id):
+    return f'dm:{conversation_id}'
+
+
+def message_to_dict(message):
+    """DirectMessageをJSON用のdictにする（senderはselect_relatedしておくこと）"""
+    return {
+        'id': message.id,
+        'conversation_id': message.conversation_id,
+        'sender_id': message.sender_id,
+        'sender': message.sender.username,
+        'content': message.content,
+        'created_at': message.created_at.isoformat(),
+        'time': timezone.localtime(message.created_at).strftime('%H:%M'),
+        'delete_url': reverse('delete_dm', args=[message.id]),
+    }
+
+
+def messages_since(conversation_id, since_id=0, limit=MAX_MESSAGES_PER_FETCH):
+    """会話のうち since_id より後のメッセージを古い順に返す"""
+    return (DirectMessage.objects
+            .filter(conversation_id=conversation_id, id__gt=since_id)
+            .select_related('sender')
+            .order_by('id')[:limit])
+
+
+def mark_conversation_read(conversation_id, user):
+    """相手から届いた未読メッセージを1回のUPDATEで既読にする"""
+    return (DirectMessage.objects
+            .filter(conversation_id=conversation_id, is_read=False)
+            .exclude(sender_id=user.id)
+            .update(is_read=True))
+
+
+def publish_message(message):
+    """コミット後に新しいメッセージを会話の参加者へ送る"""
+    payload = {'type': 'message', 'message': message_to_dict(message)}
+    transaction.on_commit(lambda: publish(conversation_channel(message.conversation_id), payload))
+
+
+def publish_deleted(conversation_id, message_id):
+    """コミット後に削除されたメッセージのIDを会話の参加者へ送る"""
+    payload = {'type': 'deleted', 'id': message_id}
+    transaction.on_commit(lambda: publish(conversation_channel(conversation_id), payload))
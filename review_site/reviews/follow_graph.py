@@ -0,0 +1,94 @@
+# reviews/follow_graph.py
+"""
+ログインユーザーのフォロー関係をまとめて扱うためのヘルパー。
+
+フォローしている人・フォローされている人のIDを1回ずつ取得してセットで持つので、
+レビュー一覧やユーザー一覧で「友達（相互フォロー）かどうか」を何人分調べても追加のクエリは発生しない。
+取得したセットはユーザーごとにキャッシュし、フォロー/アンフォロー時に invalidate_follow_graph() で破棄する。
+フォロワー数・フォロー数はここでは数えず、UserProfileのカウンタ（Follow.toggle()で更新）を使う。
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from .models import Follow
+
+CACHE_KEY = 'follow_graph:{user_id}'
+
+
+class FollowGraph:
+    def __init__(self, user_id=None, following_ids=(), follower_ids=()):
+        self.user_id = user_id
+        self.following_ids = frozenset(following_ids)
+        self.follower_ids = frozenset(follower_ids)
+
+    @classmethod
+    def load(cls, user_id):
+        """キャッシュを使わずにDBから読み込む"""
+        following_ids = Follow.objects.filter(follower_id=user_id).values_list('following_id', flat=True)
+        follower_ids = Follow.objects.filter(following_id=user_id).values_list('follower_id', flat=True)
+        return cls(user_id, following_ids, follower_ids)
+
+    @classmethod
+    def for_user(cls, user):
+        """ユーザーのフォロー関係を返す（未ログインなら空）"""
+        if not user.is_authenticated:
+            return cls()
+
+        key = CACHE_KEY.format(user_id=user.id)
+        cached = cache.get(key)
+        if cached is not None:
+            following_ids, follower_ids = cached
+            return cls(user.id, following_ids, follower_ids)
+
+        graph = cls.load(user.id)
+        timeout = getattr(settings, 'FOLLOW_GRAPH_CACHE_TIMEOUT', 300)
+        cache.set(key, (graph.following_ids, graph.follower_ids), timeout)
+        return graph
+
+    @classmethod
+    def for_user_ids(cls, user, user_ids):
+        """
+        ユーザーと user_ids の人たちとの関係だけを返す（1ページ分のユーザー一覧など）。
+        全員分のセットがキャッシュにあればそれを使い、なければページ内のIDに絞って1回のクエリで読む。
+        """
+        if not user.is_authenticated or not user_ids:
+            return cls(user.id if user.is_authenticated else None)
+
+        cached = cache.get(CACHE_KEY.format(user_id=user.id))
+        if cached is not None:
+            following_ids, follower_ids = cached
+            return cls(user.id, following_ids, follower_ids)
+
+        following_ids, follower_ids = [], []
+        rows = Follow.objects.filter(
+            Q(follower_id=user.id, following_id__in=user_ids) | Q(following_id=user.id, follower_id__in=user_ids)
+        ).values_list('follower_id', 'following_id')
+        for follower_id, following_id in rows:
+            if follower_id == user.id:
+                following_ids.append(following_id)
+            else:
+                follower_ids.append(follower_id)
+        return cls(user.id, following_ids, follower_ids)
+
+    def is_following(self, user_id):
+        return user_id in self.following_ids
+
+    def is_followed_by(self, user_id):
+        return user_id in self.follower_ids
+
+    def is_friend(self, user_id):
+        """相互フォローなら友達"""
+        return user_id != self.user_id and self.is_following(user_id) and self.is_followed_by(user_id)
+
+
+def get_follow_graph(request):
+    """リクエスト中は同じFollowGraphを使い回す"""
+    if not hasattr(request, '_follow_graph'):
+        request._follow_graph = FollowGraph.for_user(request.user)
+    return request._follow_graph
+
+
+def invalidate_follow_graph(*user_ids):
+    """フォロー関係が変わったユーザーのキャッシュを破棄する"""
+    cache.delete_many([CACHE_KEY.format(user_id=user_id) for user_id in user_ids])
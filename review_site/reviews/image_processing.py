@@ -0,0 +1,26 @@
+# reviews/image_processing.py
+"""
+アップロード画像の変換処理（RGB変換・縮小・JPEG化）。
+
+ワーカープロセスから呼び出すため、このモジュールはDjangoに依存させない。
+"""
+import io
+
+from PIL import Image
+
+STORE_IMAGE_SIZE = (800, 600)
+AVATAR_IMAGE_SIZE = (300, 300)
+JPEG_QUALITY = 85
+
+
+def process_image(data, max_size, quality=JPEG_QUALITY):
+    """画像のバイト列をmax_sizeに収まるよう縮小し、JPEGのバイト列にして返す"""
+    with Image.open(io.BytesIO(data)) as img:
+        # 大きなJPEGはデコード時点で縮小しておくとメモリと時間を節約できる
+        img.draft('RGB', max_size)
+        img = img.convert('RGB')
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=quality)
+        return buffer.getvalue()
@@ -0,0 +1,181 @@
+# reviews/image_queue.py
+"""
+アップロード画像をリクエストの外で処理するためのワーカープール。
+
+モデルは先に「処理中」として保存し、画像の変換はプロセスプール（複数コアを使える）で行う。
+変換が終わったら別スレッドでブロブストレージに保存し、モデルに画像のキーを設定する。
+
+予約した処理はプロセス内にしかないので、再起動やデプロイで失われると行が「処理中」のまま残る。
+予約日時が IMAGE_PROCESSING_STALE_MINUTES より古い「処理中」の行は
+recover_stale_images()（manage.py recover_image_jobs）で「失敗」にする。
+"""
+import logging
+import multiprocessing
+import threading
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .blobstore import get_blob_store
+from .image_processing import process_image
+
+logger = logging.getLogger(__name__)
+
+IMAGE_STATUS_READY = 'ready'
+IMAGE_STATUS_PROCESSING = 'processing'
+IMAGE_STATUS_FAILED = 'failed'
+
+# 画像を非同期で処理するモデルと、その状態・予約日時のフィールド
+QUEUED_IMAGE_FIELDS = [
+    ('reviews.Store', 'image_status', 'image_queued_at'),
+    ('reviews.UserProfile', 'avatar_status', 'avatar_queued_at'),
+]
+
+_lock = threading.Lock()
+_process_pool = None
+_writer_pool = None
+
+
+def mark_processing(instance, status_field, queued_at_field):
+    """instanceを「処理中」にして予約日時を記録する（保存は呼び出し側で行う）"""
+    setattr(instance, status_field, IMAGE_STATUS_PROCESSING)
+    setattr(instance, queued_at_field, timezone.now())
+
+
+def find_stale_images(minutes=None):
+    """予約からminutes分を過ぎても「処理中」の行を (モデル, 状態のフィールド, クエリセット) のリストで返す"""
+    if minutes is None:
+        minutes = getattr(settings, 'IMAGE_PROCESSING_STALE_MINUTES', 30)
+    cutoff = timezone.now() - timedelta(minutes=minutes)
+    stale = []
+    for label, status_field, queued_at_field in QUEUED_IMAGE_FIELDS:
+        model = apps.get_model(label)
+        # 予約日時がない行は、予約日時を記録する前から「処理中」のまま残っていたもの
+        queryset = model.objects.filter(
+            Q(**{f'{queued_at_field}__lt': cutoff}) | Q(**{f'{queued_at_field}__isnull': True}),
+            **{status_field: IMAGE_STATUS_PROCESSING},
+        )
+        stale.append((model, status_field, queryset))
+    return stale
+
+
+def recover_stale_images(minutes=None):
+    """
+    取り残された「処理中」の行を「失敗」にして、モデルごとに更新した行の主キーを返す。
+    アップロードされた元の画像は残っていないので、処理をやり直すことはできない。
+    """
+    recovered = {}
+    for model, status_field, queryset in find_stale_images(minutes):
+        with transaction.atomic():
+            pks = list(queryset.select_for_update().values_list('pk', flat=True))
+            model.objects.filter(pk__in=pks).update(**{status_field: IMAGE_STATUS_FAILED})
+        if pks:
+            logger.warning('処理中のまま残っていた画像を失敗にしました: %s %s件', model.__name__, len(pks))
+        recovered[model] = pks
+    return recovered
+
+
+def _get_pools():
+    global _process_pool, _writer_pool
+    with _lock:
+        if _process_pool is None:
+            workers = getattr(settings, 'IMAGE_PROCESSING_WORKERS', 2)
+            # forkだとDB接続などを子プロセスに引き継いでしまうのでspawnで起動する
+            _process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _writer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-writer')
+        return _process_pool, _writer_pool
+
+
+def _reset_process_pool():
+    global _process_pool
+    with _lock:
+        _process_pool = None
+
+
+def _queued_row(model, pk, queued_at_field, queued_at):
+    """
+    予約したときのままの行。後から別の画像が予約されていれば何も選ばないので、
+    先にアップロードされた画像の処理が後から終わっても、新しい画像を上書きしない。
+    """
+    return model.objects.filter(pk=pk, **{queued_at_field: queued_at})
+
+
+def _save_result(model, pk, key_field, status_field, queued_at_field, queued_at, processed):
+    """変換済みの画像をブロブストレージに保存し、モデルに反映する"""
+    key = get_blob_store().put(processed)
+    updated = _queued_row(model, pk, queued_at_field, queued_at).update(
+        **{key_field: key, status_field: IMAGE_STATUS_READY})
+    if not updated:
+        logger.info('新しい画像が予約されているため反映しませんでした: %s(pk=%s)', model.__name__, pk)
+
+
+def _mark_failed(model, pk, status_field, queued_at_field, queued_at):
+    _queued_row(model, pk, queued_at_field, queued_at).update(**{status_field: IMAGE_STATUS_FAILED})
+
+
+def _finish(future, model, pk, key_field, status_field, queued_at_field, queued_at, on_complete):
+    try:
+        _save_result(model, pk, key_field, status_field, queued_at_field, queued_at, future.result())
+    except Exception:
+        logger.exception('画像の処理に失敗しました: %s(pk=%s)', model.__name__, pk)
+        _mark_failed(model, pk, status_field, queued_at_field, queued_at)
+    finally:
+        _notify_complete(on_complete, pk)
+        # ライター用スレッドのDB接続は使い終わったら閉じる
+        connection.close()
+
+
+def _process_now(data, max_size, model, pk, key_field, status_field, queued_at_field, queued_at, on_complete):
+    try:
+        _save_result(model, pk, key_field, status_field, queued_at_field, queued_at, process_image(data, max_size))
+    except Exception:
+        logger.exception('画像の処理に失敗しました: %s(pk=%s)', model.__name__, pk)
+        _mark_failed(model, pk, status_field, queued_at_field, queued_at)
+    _notify_complete(on_complete, pk)
+
+
+def _notify_complete(on_complete, pk):
+    if on_complete is None:
+        return
+    try:
+        on_complete(pk)
+    except Exception:
+        logger.exception('画像処理の完了通知に失敗しました: pk=%s', pk)
+
+
+def enqueue_image(instance, upload, max_size, key_field, status_field, queued_at_field, on_complete=None):
+    """
+    保存済みのinstanceにアップロード画像の処理を予約する（instanceは mark_processing() して保存しておくこと）。
+    結果は予約日時が変わっていない場合だけ反映する（後から予約された画像を優先する）。
+    IMAGE_PROCESSING_ASYNCがFalseの場合はその場で処理する。
+    on_complete(pk) は画像の反映後（失敗時も）に呼ばれる（キャッシュの破棄など）。
+    """
+    # フォームの検証で読み込まれているので先頭に戻してから読む
+    upload.seek(0)
+    data = upload.read()
+    args = (type(instance), instance.pk, key_field, status_field,
+            queued_at_field, getattr(instance, queued_at_field), on_complete)
+
+    if not getattr(settings, 'IMAGE_PROCESSING_ASYNC', True):
+        _process_now(data, max_size, *args)
+        return
+
+    def submit():
+        process_pool, writer_pool = _get_pools()
+        try:
+            future = process_pool.submit(process_image, data, max_size)
+        except BrokenProcessPool:
+            # ワーカーが落ちていたら次回はプールを作り直し、この画像はその場で処理する
+            _reset_process_pool()
+            _process_now(data, max_size, *args)
+            return
+        future.add_done_callback(lambda f: writer_pool.submit(_finish, f, *args))
+
+    # 行がコミットされてから処理を始める
+    transaction.on_commit(submit)
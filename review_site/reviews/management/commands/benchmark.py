@@ -0,0 +1,469 @@
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from io import BytesIO, StringIO
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment
+from django.urls import URLPattern, reverse
+from PIL import Image
+
+from reviews import urls as review_urls
+from reviews.blobstore import get_blob_store
+from reviews.image_processing import STORE_IMAGE_SIZE, process_image
+from reviews.models import (
+    Conversation, DirectMessage, Follow, Notification, Reaction, Review, Store, Tag, UserProfile,
+)
+from reviews.notification_fanout import fan_out_review, wait_for_pending
+
+# ストリーミング（SSE）のビューは終わらないので計測しない
+SKIPPED = {
+    'notification_stream': 'SSEのストリーミング',
+    'dm_stream': 'SSEのストリーミング',
+    'logout': 'セッションを破棄するため',
+}
+
+AREAS = ['渋谷', '新宿', '池袋', '上野', '品川', '梅田', '難波', '天神', '栄', '札幌']
+GENRES = ['ラーメン', 'カレー', '寿司', '焼肉', 'カフェ', '居酒屋', 'パン', '蕎麦', '中華', 'イタリアン']
+
+
+class SQLTimer:
+    """connection.execute_wrapper() に渡してSQLの実行時間を合計する（connection.queriesの時間はミリ秒単位に丸められている）"""
+
+    def __init__(self):
+        self.total = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.total += time.perf_counter() - started
+
+
+class Fixture:
+    """計測に使うオブジェクト（ビューのURL引数やPOSTの対象）"""
+
+    def __init__(self, user, other_user, store, review, tag, conversation, blob_key):
+        self.user = user
+        self.other_user = other_user
+        self.store = store
+        self.review = review
+        self.tag = tag
+        self.conversation = conversation
+        self.blob_key = blob_key
+
+    def url_kwargs(self):
+        """URLの引数名ごとの既定値"""
+        return {
+            'store_id': self.store.id,
+            'review_id': self.review.id,
+            'user_id': self.other_user.id,
+            'conversation_id': self.conversation.id,
+            'message_id': self.conversation.messages.filter(sender=self.user).values_list('id', flat=True).first(),
+            'key': self.blob_key,
+        }
+
+
+def _new_review(fixture):
+    review = Review.objects.create(store=fixture.store, user=fixture.user, rating=3, comment='削除用')
+    return {'review_id': review.id}
+
+
+def _new_message(fixture):
+    message = DirectMessage.objects.create(conversation=fixture.conversation, sender=fixture.user, content='削除用')
+    return {'message_id': message.id}
+
+
+def _new_store(fixture):
+    store = Store.objects.create(name='削除用', address='削除用', created_by=fixture.user)
+    return {'store_id': store.id}
+
+
+def _store_tag_ids(fixture):
+    return list(Store.tags.through.objects.filter(store=fixture.store).values_list('tag_id', flat=True)[:2])
+
+
+# URL名ごとの計測方法（書いていないURLは引数の既定値でGETする）
+# data / query は fixture を受け取る関数でもよい。setup は毎回呼ばれ、URL引数を上書きする。
+# teardown は毎回の計測の後に呼ばれる（計測時間には含めない）。
+VARIANTS = {
+    'store_list': [
+        {},
+        {'label': 'store_list (anonymous)', 'anonymous': True},
+        {'label': 'store_list (search)', 'query': {'q': 'ラーメン'}},
+        {'label': 'store_list (tags)', 'query': lambda f: {'tag': _store_tag_ids(f)}},
+        {'label': 'store_list (tags, any)', 'query': lambda f: {'tag': _store_tag_ids(f), 'match': 'any'}},
+        {'label': 'store_list (search + tag)', 'query': lambda f: {'q': 'ラーメン', 'tag': _store_tag_ids(f)[:1]}},
+    ],
+    'store_detail': [
+        {},
+        {'label': 'store_detail (anonymous)', 'anonymous': True},
+        # フォロワーへの通知はリクエストの外で作るので、次の計測の前に終わるのを待つ
+        {'label': 'store_detail (post review)', 'method': 'POST', 'data': {'rating': 4, 'comment': 'ベンチマーク'},
+         'teardown': lambda f: wait_for_pending()},
+    ],
+    'store_new': [
+        {},
+        {'label': 'store_new (post)', 'method': 'POST',
+         'data': lambda f: {'name': 'ベンチマーク店', 'address': '東京都', 'tags': [f.tag.id]}},
+    ],
+    'store_edit': [
+        {},
+        {'label': 'store_edit (post)', 'method': 'POST',
+         'data': lambda f: {'name': f.store.name, 'address': f.store.address, 'tags': [f.tag.id]}},
+    ],
+    'store_delete': [
+        {},
+        {'label': 'store_delete (post)', 'method': 'POST', 'setup': _new_store},
+    ],
+    'review_delete': [{'method': 'POST', 'setup': _new_review}],
+    'delete_dm': [{'setup': _new_message}],
+    'add_tag_to_store': [{'method': 'POST', 'data': lambda f: {'tag_id': f.tag.id}}],
+    'remove_tag_from_store': [{'method': 'POST', 'data': lambda f: {'tag_id': f.tag.id}}],
+    'add_reaction': [{'method': 'POST', 'data': {'reaction_type': 'good'}}],
+    'follow_user': [{'method': 'POST'}],
+    'send_dm': [
+        {},
+        {'label': 'send_dm (post)', 'method': 'POST', 'query': {'format': 'json'}, 'data': {'content': 'ベンチマーク'}},
+    ],
+    'dm_mark_read': [{'method': 'POST'}],
+    'dm_messages': [{'query': lambda f: {'since': 0}}],
+    'user_list': [
+        {},
+        {'label': 'user_list (search)', 'query': {'q': 'bench0001'}},
+    ],
+    'api_store_list': [
+        {'anonymous': True},
+        {'label': 'api_store_list (fields)', 'anonymous': True, 'query': {'fields': 'id,name,rating'}},
+        {'label': 'api_store_list (tag)', 'anonymous': True, 'query': lambda f: {'tag': f.tag.id}},
+    ],
+    'api_store_reviews': [
+        {'anonymous': True},
+        {'label': 'api_store_reviews (fields)', 'anonymous': True, 'query': {'fields': 'id,rating,created_at'}},
+    ],
+    'login': [{'anonymous': True}],
+    'signup': [{'anonymous': True}],
+}
+
+
+class Command(BaseCommand):
+    help = '合成データを作成して reviews の全URLを計測し、クエリ数・SQL時間・応答時間・サイズをJSONで出力します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='50,500', help='店舗数（カンマ区切りで複数指定すると規模ごとに計測する）')
+        parser.add_argument('--reviews-per-store', type=int, default=10)
+        parser.add_argument('--reactions-per-review', type=int, default=3)
+        parser.add_argument('--follows-per-user', type=int, default=10)
+        parser.add_argument('--tags', type=int, default=30)
+        parser.add_argument('--messages-per-conversation', type=int, default=20)
+        parser.add_argument('--image-ratio', type=float, default=0.5, help='画像を持つ店舗の割合')
+        parser.add_argument('--repeat', type=int, default=5, help='URLごとの計測回数（1回目をcold、残りの中央値をwarmとする）')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='結果のJSONを書き出すファイル（省略時は標準出力）')
+        parser.add_argument('--baseline', help='以前の結果のJSON。クエリ数が増えたビューがあればエラーにする')
+
+    def handle(self, *args, **options):
+        try:
+            scales = [int(value) for value in options['scales'].split(',') if value.strip()]
+        except ValueError:
+            raise CommandError('--scales は店舗数をカンマ区切りで指定してください')
+        # URLの引数に使う店舗が必要なので、どの規模も1件以上にする
+        if not scales or min(scales) < 1:
+            raise CommandError('--scales の店舗数は1以上にしてください')
+
+        # リクエストごとのSQLログは出さない（クエリ数の上限を超えた警告だけ出す）
+        logging.getLogger('reviews.sql').setLevel(logging.WARNING)
+        logging.getLogger('reviews.notifications').setLevel(logging.WARNING)
+
+        results = {'scales': []}
+        setup_test_environment()
+        try:
+            for stores in scales:
+                results['scales'].append(self._run_scale(stores, options))
+        finally:
+            teardown_test_environment()
+
+        output = json.dumps(results, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output)
+            self.stderr.write(f'結果を{options["output"]}に書き出しました')
+        else:
+            self.stdout.write(output)
+
+        if options['baseline']:
+            self._compare(options['baseline'], results)
+
+    def _run_scale(self, stores, options):
+        """テスト用のDBを作成し、データを投入して計測する（本来のDBには触れない）"""
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            # SQLiteのメモリDBは前の規模のデータが残ることがあるので空にしてから始める
+            call_command('flush', interactive=False, verbosity=0)
+            # 画像・推薦の配列とキャッシュも本来の保存先とは別にする
+            with tempfile.TemporaryDirectory() as blob_root, override_settings(
+                BLOB_STORAGE_ROOT=blob_root,
+                RECOMMENDATION_ROOT=os.path.join(blob_root, 'recommendations'),
+                IMAGE_PROCESSING_ASYNC=False,
+                RECOMMENDATION_UPDATE_ASYNC=False,
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark'}},
+            ):
+                get_blob_store.cache_clear()
+                cache.clear()
+                started = time.perf_counter()
+                rng = random.Random(options['seed'])
+                fixture, counts = self._seed(rng, stores, options)
+                seed_seconds = time.perf_counter() - started
+                self.stderr.write(f'店舗{stores}件: データ作成 {seed_seconds:.1f}秒 {counts}')
+
+                views = self._measure(fixture, options['repeat'])
+                fanout = self._measure_fanout(fixture)
+        finally:
+            get_blob_store.cache_clear()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        return {
+            'stores': stores, 'counts': counts, 'seed_seconds': round(seed_seconds, 3), 'views': views, 'fanout': fanout,
+        }
+
+    def _seed(self, rng, store_count, options):
+        user_count = max(20, store_count // 2)
+        password = make_password('benchmark')
+        users = User.objects.bulk_create([
+            User(username=f'bench{i:05d}', password=password) for i in range(user_count)
+        ])
+        UserProfile.objects.bulk_create([UserProfile(user=user) for user in users])
+
+        tags = Tag.objects.bulk_create([
+            Tag(name=f'{GENRES[i % len(GENRES)]}{i}', color=Tag.COLOR_CHOICES[i % len(Tag.COLOR_CHOICES)][0],
+                created_by=rng.choice(users))
+            for i in range(options['tags'])
+        ])
+
+        # 画像は1枚だけ作って使い回す（キーが同じなら中身も同じ）
+        buffer = BytesIO()
+        Image.new('RGB', (1200, 900), (200, 120, 60)).save(buffer, 'JPEG')
+        blob_key = get_blob_store().put(process_image(buffer.getvalue(), STORE_IMAGE_SIZE))
+
+        stores = Store.objects.bulk_create([
+            Store(
+                name=f'{rng.choice(GENRES)}{rng.choice(AREAS)}店{i}',
+                address=f'{rng.choice(AREAS)}{i}丁目',
+                comment=f'{rng.choice(GENRES)}がおいしいお店',
+                created_by=users[0] if i == 0 else rng.choice(users),
+                image_key=blob_key if rng.random() < options['image_ratio'] else None,
+            )
+            for i in range(store_count)
+        ])
+        Store.tags.through.objects.bulk_create([
+            Store.tags.through(store_id=store.id, tag_id=tag.id)
+            for store in stores for tag in rng.sample(tags, min(3, len(tags)))
+        ])
+
+        # リアクションを先に決めてから、Reviewのカウンタ列に件数を入れて作成する
+        reviews = []
+        planned_reactions = []
+        for store in stores:
+            for reviewer in rng.sample(users, min(options['reviews_per_store'], len(users))):
+                review = Review(store=store, user=reviewer, rating=rng.randint(1, 5), comment='ベンチマーク用のレビュー')
+                reactors = rng.sample(users, min(options['reactions_per_review'], len(users)))
+                types = [rng.choice(['good', 'bad', 'question']) for _ in reactors]
+                review.good_count = types.count('good')
+                review.bad_count = types.count('bad')
+                review.question_count = types.count('question')
+                reviews.append(review)
+                planned_reactions.append(list(zip(reactors, types)))
+        reviews = Review.objects.bulk_create(reviews, batch_size=1000)
+        Reaction.objects.bulk_create([
+            Reaction(review=review, user=reactor, reaction_type=reaction_type)
+            for review, reactions in zip(reviews, planned_reactions)
+            for reactor, reaction_type in reactions
+        ], batch_size=1000)
+
+        follows = set()
+        for user in users:
+            for target in rng.sample(users, min(options['follows_per_user'], len(users))):
+                if target.id != user.id:
+                    follows.add((user.id, target.id))
+        Follow.objects.bulk_create([Follow(follower_id=a, following_id=b) for a, b in follows], batch_size=1000)
+        Notification.objects.bulk_create([
+            Notification(user_id=b, from_user_id=a, notification_type='follow', message='フォローされました')
+            for a, b in follows
+        ], batch_size=1000)
+
+        # 計測するユーザー（users[0]）との会話を作る
+        partners = users[1:user_count // 2]
+        conversations = Conversation.objects.bulk_create([
+            Conversation(low_user_id=min(users[0].id, partner.id), high_user_id=max(users[0].id, partner.id))
+            for partner in partners
+        ])
+        Conversation.participants.through.objects.bulk_create([
+            Conversation.participants.through(conversation_id=conversation.id, user_id=user_id)
+            for conversation in conversations
+            for user_id in (conversation.low_user_id, conversation.high_user_id)
+        ])
+        DirectMessage.objects.bulk_create([
+            DirectMessage(
+                conversation=conversation,
+                sender_id=rng.choice([conversation.low_user_id, conversation.high_user_id]),
+                content=f'メッセージ{i}',
+                is_read=rng.random() < 0.5,
+            )
+            for conversation in conversations
+            for i in range(options['messages_per_conversation'])
+        ], batch_size=1000)
+
+        # 非正規化した集計と検索インデックスは既存のコマンドで作る
+        call_command('rebuild_rating_summaries', stdout=StringIO())
+        call_command('rebuild_search_index', stdout=StringIO())
+        call_command('rebuild_tag_counts', stdout=StringIO())
+        call_command('rebuild_follow_counts', stdout=StringIO())
+        call_command('build_people_suggestions', stdout=StringIO())
+        call_command('build_store_recommendations', stdout=StringIO())
+
+        user = users[0]
+        store = stores[0]
+        fixture = Fixture(
+            user=user,
+            other_user=partners[0],
+            store=store,
+            review=Review.objects.filter(store=store).exclude(user=user).first(),
+            tag=tags[0],
+            conversation=Conversation.objects.get(id=conversations[0].id),
+            blob_key=blob_key,
+        )
+        counts = {
+            'users': len(users),
+            'stores': len(stores),
+            'tags': len(tags),
+            'reviews': len(reviews),
+            'reactions': Reaction.objects.count(),
+            'follows': len(follows),
+            'conversations': len(conversations),
+            'messages': DirectMessage.objects.count(),
+        }
+        return fixture, counts
+
+    def _measure(self, fixture, repeat):
+        user_client = Client()
+        user_client.force_login(fixture.user)
+        anonymous_client = Client()
+        defaults = fixture.url_kwargs()
+
+        views = {}
+        for pattern in review_urls.urlpatterns:
+            if not isinstance(pattern, URLPattern) or not pattern.name:
+                continue
+            name = pattern.name
+            if name in SKIPPED:
+                views[name] = {'skipped': SKIPPED[name]}
+                continue
+            for variant in VARIANTS.get(name, [{}]):
+                label = variant.get('label', name)
+                client = anonymous_client if variant.get('anonymous') else user_client
+                runs = []
+                for _ in range(max(1, repeat)):
+                    kwargs = {key: defaults[key] for key in pattern.pattern.regex.groupindex}
+                    if 'setup' in variant:
+                        kwargs.update(variant['setup'](fixture))
+                    runs.append(self._request(client, name, kwargs, variant, fixture))
+                    if 'teardown' in variant:
+                        variant['teardown'](fixture)
+                views[label] = self._summarize(runs)
+        return views
+
+    def _measure_fanout(self, fixture):
+        """
+        全員にフォローされているユーザーがレビューを2回投稿したときのファンアウト（その場で実行して計測する）。
+        2回目は1回目の通知にまとめられる。
+        """
+        author = fixture.other_user
+        Follow.objects.bulk_create([
+            Follow(follower_id=user_id, following_id=author.id)
+            for user_id in User.objects.exclude(id=author.id).values_list('id', flat=True)
+        ], batch_size=1000, ignore_conflicts=True)
+
+        results = []
+        for store in Store.objects.order_by('id')[:2]:
+            review = Review.objects.create(store=store, user=author, rating=4, comment='ファンアウト')
+            with CaptureQueriesContext(connection) as queries:
+                result = fan_out_review(review.id, author.id, author.username, store.name)
+            results.append({**result.as_dict(), 'queries': len(queries)})
+        return results
+
+    def _request(self, client, name, kwargs, variant, fixture):
+        data = variant.get('data', {})
+        query = variant.get('query', {})
+        if callable(data):
+            data = data(fixture)
+        if callable(query):
+            query = query(fixture)
+        method = variant.get('method', 'GET')
+        path = reverse(name, kwargs=kwargs)
+
+        timer = SQLTimer()
+        with CaptureQueriesContext(connection) as queries, connection.execute_wrapper(timer):
+            started = time.perf_counter()
+            if method == 'POST':
+                path_with_query = path + ('?' + '&'.join(f'{k}={v}' for k, v in query.items()) if query else '')
+                response = client.post(path_with_query, data)
+            else:
+                response = client.get(path, query)
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+            wall = time.perf_counter() - started
+
+        return {
+            'method': method,
+            'path': path,
+            'status': response.status_code,
+            'queries': len(queries),
+            'sql_ms': round(timer.total * 1000, 3),
+            'wall_ms': round(wall * 1000, 3),
+            'bytes': len(content),
+        }
+
+    def _summarize(self, runs):
+        """1回目（キャッシュなし）と、2回目以降の中央値（キャッシュあり）"""
+        result = {'cold': runs[0]}
+        if len(runs) > 1:
+            warm = runs[1:]
+            result['warm'] = {
+                'status': warm[-1]['status'],
+                'queries': int(statistics.median(run['queries'] for run in warm)),
+                'sql_ms': round(statistics.median(run['sql_ms'] for run in warm), 3),
+                'wall_ms': round(statistics.median(run['wall_ms'] for run in warm), 3),
+                'bytes': int(statistics.median(run['bytes'] for run in warm)),
+            }
+        return result
+
+    def _compare(self, baseline_path, results):
+        """規模ごと・ビューごとにクエリ数を比べ、増えていればエラーにする"""
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        before = {scale['stores']: scale['views'] for scale in baseline.get('scales', [])}
+
+        regressions = []
+        for scale in results['scales']:
+            for label, result in scale['views'].items():
+                old = before.get(scale['stores'], {}).get(label)
+                if not old or 'cold' not in result or 'cold' not in old:
+                    continue
+                for phase in ('cold', 'warm'):
+                    if phase in result and phase in old and result[phase]['queries'] > old[phase]['queries']:
+                        regressions.append(
+                            f'店舗{scale["stores"]}件 {label} ({phase}): '
+                            f'{old[phase]["queries"]} → {result[phase]["queries"]}クエリ'
+                        )
+        if regressions:
+            raise CommandError('クエリ数が増えたビューがあります:\n' + '\n'.join(regressions))
+        self.stderr.write(self.style.SUCCESS('クエリ数が増えたビューはありません'))
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from reviews import people_suggestions
+
+
+class Command(BaseCommand):
+    help = '全ユーザーの「知り合いかも」（友達の友達）を計算し直し、RECOMMENDATION_ROOT に保存します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='進捗を表示する間隔（人数）')
+        parser.add_argument('--top-k', type=int, default=people_suggestions.TOP_K, help='ユーザーごとに保存する件数')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['top_k'] < 1:
+            raise CommandError('--batch-size と --top-k には1以上を指定してください')
+
+        def progress(done, total):
+            if options['verbosity'] >= 2:
+                self.stdout.write(f'  {done}/{total}人')
+
+        started = time.perf_counter()
+        index = people_suggestions.rebuild(
+            batch_size=options['batch_size'], top_k=options['top_k'], progress=progress,
+        )
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(index.graph.user_ids)}人分の推薦（{len(index.users)}件）を {elapsed:.2f}秒で作成しました: '
+            f'{people_suggestions.index_path()}'
+        ))
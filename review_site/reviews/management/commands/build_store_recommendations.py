@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from reviews import store_recommendations
+
+
+class Command(BaseCommand):
+    help = 'レビューの評価から店舗同士の類似度を計算し直し、RECOMMENDATION_ROOT に保存します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=store_recommendations.BATCH_SIZE,
+            help='一度に類似度を計算する店舗数（メモリは batch-size × 店舗数 に比例する）',
+        )
+        parser.add_argument('--top-k', type=int, default=store_recommendations.TOP_K, help='店舗ごとに保存する件数')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['top_k'] < 1:
+            raise CommandError('--batch-size と --top-k には1以上を指定してください')
+
+        def progress(done, total):
+            if options['verbosity'] >= 2:
+                self.stdout.write(f'  {done}/{total}店舗')
+
+        started = time.perf_counter()
+        index = store_recommendations.rebuild(
+            top_k=options['top_k'], batch_size=options['batch_size'], progress=progress,
+        )
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(index.store_ids)}店舗の類似店舗（{int((index.neighbors >= 0).sum())}件）を {elapsed:.2f}秒で作成しました: '
+            f'{store_recommendations.index_root() / index.build_id}'
+        ))
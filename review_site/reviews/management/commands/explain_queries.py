@@ -0,0 +1,165 @@
+import re
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Avg, Count, Exists, OuterRef, Q
+from django.utils import timezone
+
+from reviews.direct_messages import messages_since
+from reviews.models import Conversation, DirectMessage, Follow, Notification, Reaction, Review, Store, Tag
+from reviews.tag_facets import filter_stores_by_tags
+
+# 全表走査を示す実行計画の行（SQLite: インデックスなしのSCAN、PostgreSQL: Seq Scan）
+_SQLITE_FULL_SCAN_RE = re.compile(r'\bSCAN (\w+)(?! USING (?:COVERING )?INDEX)(?!.*USING (?:COVERING )?INDEX)')
+_SQLITE_TEMP_SORT_RE = re.compile(r'USE TEMP B-TREE FOR (?:ORDER BY|RIGHT PART OF ORDER BY)')
+_POSTGRES_SEQ_SCAN_RE = re.compile(r'Seq Scan on (\w+)')
+
+
+class Command(BaseCommand):
+    help = '各ビューの主なクエリの実行計画（EXPLAIN）を表示し、インデックスが使われているかを確認します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--view', action='append', help='対象のビュー名（複数指定可。省略時はすべて）')
+        parser.add_argument('--sql', action='store_true', help='SQLも表示する')
+        parser.add_argument('--analyze', action='store_true', help='実際に実行して計測する（PostgreSQLのみ）')
+        parser.add_argument(
+            '--check', action='store_true',
+            help='全表走査やインデックスを使わない並べ替えがあればエラーにする'
+                 '（PostgreSQLではテーブルが小さくても判定できるようにSeq Scanを無効にして計画を立てる）',
+        )
+
+    def handle(self, *args, **options):
+        vendor = connection.vendor
+        if vendor not in ('sqlite', 'postgresql'):
+            raise CommandError(f'{vendor} には対応していません（SQLiteとPostgreSQLのみ）')
+
+        problems = []
+        for view, label, queryset, *allowed in self._queries():
+            if options['view'] and view not in options['view']:
+                continue
+            plan = self._explain(queryset, vendor, options)
+            issues = self._find_issues(plan, vendor, allow_sort='sort' in allowed)
+
+            self.stdout.write(self.style.MIGRATE_HEADING(f'[{view}] {label}'))
+            if options['sql']:
+                self.stdout.write(str(queryset.query))
+            for line in plan.splitlines():
+                self.stdout.write(f'  {line}')
+            for issue in issues:
+                self.stdout.write(self.style.WARNING(f'  ! {issue}'))
+                problems.append(f'[{view}] {label}: {issue}')
+            self.stdout.write('')
+
+        if options['check'] and problems:
+            raise CommandError('インデックスを使っていないクエリがあります:\n' + '\n'.join(problems))
+        if problems:
+            self.stdout.write(self.style.WARNING(f'{len(problems)}件の注意点があります'))
+        else:
+            self.stdout.write(self.style.SUCCESS('すべてのクエリがインデックスを使っています'))
+
+    def _explain(self, queryset, vendor, options):
+        explain_options = {}
+        if options['analyze']:
+            if vendor != 'postgresql':
+                raise CommandError('--analyze はPostgreSQLでのみ使えます')
+            explain_options['analyze'] = True
+        with transaction.atomic():
+            if vendor == 'postgresql' and options['check']:
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+            return queryset.explain(**explain_options)
+
+    def _find_issues(self, plan, vendor, allow_sort=False):
+        issues = []
+        if vendor == 'sqlite':
+            for line in plan.splitlines():
+                match = _SQLITE_FULL_SCAN_RE.search(line)
+                if match:
+                    issues.append(f'{match.group(1)} を全件走査しています')
+                if not allow_sort and _SQLITE_TEMP_SORT_RE.search(line):
+                    issues.append('並べ替えにインデックスを使っていません')
+        else:
+            for table in _POSTGRES_SEQ_SCAN_RE.findall(plan):
+                issues.append(f'{table} を全件走査しています')
+        return issues
+
+    def _sample_ids(self):
+        """実行計画を作るためのID（データがなければ1を使う。存在しないIDでもEXPLAINはできる）"""
+        def first(model, **filters):
+            return model.objects.filter(**filters).order_by('pk').values_list('pk', flat=True).first() or 1
+
+        store_id = first(Store)
+        conversation = Conversation.objects.filter(low_user__isnull=False).order_by('pk').first()
+        return {
+            'user': first(User),
+            'store': store_id,
+            'review': first(Review),
+            'tag': first(Tag),
+            'conversation': conversation.pk if conversation else 1,
+            'conversation_user': conversation.low_user_id if conversation else 1,
+        }
+
+    def _queries(self):
+        """
+        ビューごとの主なクエリ（ビューと同じ条件・並び順で組み立てる）。
+        4番目の要素に 'sort' があるものは、絞り込んだ後の少ない行（1ユーザーの会話・1タグの店舗）を並べ替えるだけなので、
+        インデックスなしの並べ替えを許す。
+        """
+        ids = self._sample_ids()
+        now = timezone.now()
+        review_ids = list(Review.objects.filter(store_id=ids['store']).values_list('id', flat=True)[:20]) or [1]
+        store_ids = list(Store.objects.values_list('id', flat=True)[:500]) or [1]
+
+        stores = Store.objects.select_related('created_by', 'created_by__profile', 'rating_summary')
+        reviews = Review.objects.select_related('user', 'user__profile')
+        return [
+            ('store_list', '1ページ目', stores.order_by('-created_at', '-id')[:21]),
+            ('store_list', '2ページ目以降（カーソル）', stores.filter(
+                Q(created_at__lt=now) | Q(created_at=now, id__lt=ids['store'])
+            ).order_by('-created_at', '-id')[:21]),
+            ('store_detail', 'レビュー一覧', reviews.filter(store_id=ids['store']).order_by('-created_at', '-id')[:21]),
+            ('store_list', 'おすすめ用の最近のレビュー', Review.objects.filter(user_id=ids['user'])
+                .order_by('-created_at').values_list('store_id', 'rating')[:50]),
+            ('store_recommendations', '類似店舗の再計算', Review.objects.filter(
+                user_id__in=Review.objects.filter(store_id=ids['store']).values('user_id'),
+            ).order_by().values('user_id', 'store_id').annotate(rating=Avg('rating'))),
+            ('store_detail', '自分のリアクション', Reaction.objects.filter(review_id__in=review_ids, user_id=ids['user'])),
+            ('user_profile', '登録したお店', Store.objects.filter(created_by_id=ids['user']).order_by('-created_at')[:5]),
+            ('user_profile', '最近のレビュー', Review.objects.filter(user_id=ids['user']).order_by('-created_at')[:5]),
+            ('follow_graph', 'フォロワー', Follow.objects.filter(following_id=ids['user']).values('follower_id')),
+            ('follow_graph', 'フォロー中', Follow.objects.filter(follower_id=ids['user']).values('following_id')),
+            ('user_list', 'ユーザー名の前方一致', User.objects.exclude(id=ids['user']).filter(username__startswith='u')
+                .order_by('username').values('id', 'username', 'profile__avatar_key')[:21]),
+            ('user_list', 'ページ内のフォロー状態', Follow.objects.filter(
+                Q(follower_id=ids['user'], following_id__in=[1, 2, 3]) | Q(following_id=ids['user'], follower_id__in=[1, 2, 3])
+            ).values('follower_id', 'following_id')),
+            ('notifications', '通知一覧', Notification.objects.filter(user_id=ids['user'])
+                .select_related('from_user', 'from_user__profile').order_by('-created_at', '-id')[:21]),
+            ('notifications', '通知一覧（カーソル）', Notification.objects.filter(user_id=ids['user']).filter(
+                Q(created_at__lt=now) | Q(created_at=now, id__lt=ids['review'])
+            ).order_by('-created_at', '-id')[:21]),
+            ('purge_notifications', '古い既読の通知', Notification.objects.filter(is_read=True, created_at__lt=now)
+                .order_by('created_at').values_list('id', flat=True)[:1000]),
+            ('purge_notifications', '上限を超えた既読の通知', Notification.objects.filter(user_id=ids['user'], is_read=True)
+                .order_by('-created_at', '-id').values_list('id', flat=True)[200:1200]),
+            ('notifications', '未読', Notification.objects.filter(user_id=ids['user'], is_read=False).values('id')),
+            ('notification_fanout', 'フォロワーのチャンク', Follow.objects.filter(following_id=ids['user'], follower_id__gt=0)
+                .annotate(has_recent=Exists(Notification.objects.filter(
+                    user_id=OuterRef('follower_id'), from_user_id=ids['user'], notification_type='review',
+                    is_read=False, created_at__gte=now,
+                ))).order_by('follower_id').values_list('follower_id', 'has_recent')[:500]),
+            ('send_dm', '会話のメッセージ', DirectMessage.objects.filter(conversation_id=ids['conversation']).order_by('id')),
+            ('dm_messages', '差分取得', messages_since(ids['conversation'], 0)),
+            ('send_dm', '未読（既読化）', DirectMessage.objects.filter(
+                conversation_id=ids['conversation'], is_read=False,
+            ).exclude(sender_id=ids['conversation_user']).values('id')),
+            ('dm_inbox', '受信箱', Conversation.objects.inbox_for(User(id=ids['conversation_user'])), 'sort'),
+            ('rebuild_rating_summaries', '評価ごとの件数', Review.objects.filter(store_id__in=store_ids)
+                .order_by().values('store_id', 'rating').annotate(count=Count('id'))),
+            ('api_store_list', 'タグで絞り込み', filter_stores_by_tags(Store.objects.all(), [ids['tag']])
+                .order_by('-created_at', '-id').values('id', 'created_at', 'name')[:21], 'sort'),
+            ('add_reaction', '種類ごとのリアクション数', Reaction.objects.filter(
+                review_id=ids['review'], reaction_type='good',
+            ).values('id')),
+        ]
@@ -0,0 +1,91 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from reviews.models import Notification
+
+
+class Command(BaseCommand):
+    help = (
+        '古い既読の通知と、ユーザーごとの上限を超えた既読の通知を削除します'
+        '（少しずつ削除してテーブルを長くロックしない。未読の通知は削除しない）'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=getattr(settings, 'NOTIFICATION_RETENTION_DAYS', 90),
+            help='この日数より古い既読の通知を削除する',
+        )
+        parser.add_argument(
+            '--per-user-limit', type=int, default=getattr(settings, 'NOTIFICATION_HISTORY_LIMIT', 200),
+            help='ユーザーごとに残す既読の通知の数（0なら上限なし）',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='1回のDELETEで削除する件数')
+        parser.add_argument('--sleep', type=float, default=0.05, help='DELETEの間に待つ秒数（他の書き込みを待たせないため）')
+        parser.add_argument('--max-batches', type=int, default=0, help='この回数だけ削除したら終わる（0なら最後まで）')
+        parser.add_argument('--dry-run', action='store_true', help='削除せず、対象の件数だけを表示する')
+
+    def handle(self, *args, **options):
+        if options['days'] < 0 or options['per_user_limit'] < 0 or options['batch_size'] < 1:
+            raise CommandError('--days と --per-user-limit には0以上、--batch-size には1以上を指定してください')
+        self.options = options
+        self.batches = 0
+
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        expired = Notification.objects.filter(is_read=True, created_at__lt=cutoff)
+        if options['dry_run']:
+            self.stdout.write(f'{options["days"]}日より古い既読の通知: {expired.count()}件')
+        else:
+            deleted = self._delete_in_batches(lambda: expired.order_by('created_at').values_list('id', flat=True))
+            self.stdout.write(f'{options["days"]}日より古い既読の通知を{deleted}件削除しました')
+
+        limit = options['per_user_limit']
+        if not limit:
+            return
+        over_limit = list(
+            Notification.objects.filter(is_read=True)
+            .order_by().values('user_id').annotate(count=Count('id'))
+            .filter(count__gt=limit).values_list('user_id', 'count')
+        )
+        if options['dry_run']:
+            excess = sum(count - limit for _, count in over_limit)
+            self.stdout.write(f'上限（{limit}件）を超えた既読の通知: {len(over_limit)}人・{excess}件')
+            return
+
+        trimmed = 0
+        for user_id, _ in over_limit:
+            # 新しい順に limit 件より後ろの既読の通知（削除するたびに次の分が繰り上がる）
+            history = (Notification.objects.filter(user_id=user_id, is_read=True)
+                       .order_by('-created_at', '-id').values_list('id', flat=True))
+            trimmed += self._delete_in_batches(lambda: history[limit:])
+            if self._exhausted():
+                break
+        self.stdout.write(self.style.SUCCESS(
+            f'上限（{limit}件）を超えた既読の通知を{len(over_limit)}人分・{trimmed}件削除しました'
+        ))
+
+    def _exhausted(self):
+        return bool(self.options['max_batches']) and self.batches >= self.options['max_batches']
+
+    def _delete_in_batches(self, candidate_ids):
+        """candidate_ids() が返すIDを batch_size 件ずつ、短いトランザクションで削除する"""
+        deleted = 0
+        while not self._exhausted():
+            ids = list(candidate_ids()[:self.options['batch_size']])
+            if not ids:
+                break
+            with transaction.atomic():
+                count, _ = Notification.objects.filter(id__in=ids).delete()
+            deleted += count
+            self.batches += 1
+            if self.options['verbosity'] >= 2:
+                self.stdout.write(f'  {deleted}件削除')
+            if len(ids) < self.options['batch_size']:
+                break
+            time.sleep(self.options['sleep'])
+        return deleted
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from reviews.models import Follow, UserProfile
+
+COUNT_FIELDS = ['followers_count', 'following_count']
+
+
+class Command(BaseCommand):
+    help = 'UserProfileのフォロワー数・フォロー数をFollowテーブルから数え直し・検証します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help='書き込みはせず、件数のずれだけを報告する')
+        parser.add_argument('--batch-size', type=int, default=500, help='一度に書き込む件数')
+
+    def handle(self, *args, **options):
+        followers = self._counts('following_id')
+        following = self._counts('follower_id')
+
+        profiles = {profile.user_id: profile for profile in UserProfile.objects.only('id', 'user_id', *COUNT_FIELDS)}
+        mismatched = []
+        missing = []
+        for user_id in set(followers) | set(following) | set(profiles):
+            expected = {'followers_count': followers.get(user_id, 0), 'following_count': following.get(user_id, 0)}
+            profile = profiles.get(user_id)
+            if profile is None:
+                # フォロー関係があるのにプロフィールがないユーザー
+                missing.append(UserProfile(user_id=user_id, **expected))
+            elif any(getattr(profile, field) != value for field, value in expected.items()):
+                for field, value in expected.items():
+                    setattr(profile, field, value)
+                mismatched.append(profile)
+
+        if options['verify']:
+            if mismatched or missing:
+                user_ids = [profile.user_id for profile in mismatched + missing]
+                raise CommandError(f'{len(user_ids)}人のフォロワー数・フォロー数がずれています: user_id={user_ids[:20]}')
+            self.stdout.write(self.style.SUCCESS(f'{len(profiles)}人のフォロワー数・フォロー数はすべて正しいです'))
+            return
+
+        with transaction.atomic():
+            UserProfile.objects.bulk_update(mismatched, COUNT_FIELDS, batch_size=options['batch_size'])
+            UserProfile.objects.bulk_create(missing, batch_size=options['batch_size'], ignore_conflicts=True)
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(mismatched)}人のカウンタを更新し、{len(missing)}人のプロフィールを作成しました'
+        ))
+
+    def _counts(self, column):
+        return dict(Follow.objects.order_by().values(column).annotate(count=Count('id')).values_list(column, 'count'))
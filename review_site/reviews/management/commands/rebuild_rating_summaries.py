@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from reviews.models import Review, Store, StoreRatingSummary
+
+SUMMARY_FIELDS = ['review_count', 'rating_average', 'last_review_at'] + [
+    f'rating_{rating_value}_count' for rating_value, _ in Review.RATING_CHOICES
+]
+
+
+class Command(BaseCommand):
+    help = '店舗ごとの評価集計（StoreRatingSummary）をReviewテーブルから再構築・検証します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help='書き込みはせず、集計のずれだけを報告する')
+        parser.add_argument('--batch-size', type=int, default=500, help='一度に書き込む件数')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        verify = options['verify']
+
+        current = {summary.store_id: summary for summary in StoreRatingSummary.objects.all()}
+        mismatched = []
+        batch = []
+        total = 0
+
+        for expected in StoreRatingSummary.build_from_reviews(Store.objects.all()):
+            total += 1
+            actual = current.get(expected.store_id)
+            if actual is None or any(getattr(actual, f) != getattr(expected, f) for f in SUMMARY_FIELDS):
+                mismatched.append(expected.store_id)
+                batch.append(expected)
+            if not verify and len(batch) >= batch_size:
+                self._write(batch, batch_size)
+                batch = []
+
+        if not verify and batch:
+            self._write(batch, batch_size)
+
+        if verify:
+            if mismatched:
+                raise CommandError(f'{len(mismatched)}/{total}件の集計がずれています: store_id={mismatched[:20]}')
+            self.stdout.write(self.style.SUCCESS(f'{total}件の集計はすべて正しいです'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'{total}件中{len(mismatched)}件の集計を更新しました'))
+
+    def _write(self, summaries, batch_size):
+        with transaction.atomic():
+            StoreRatingSummary.objects.bulk_create(
+                summaries,
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=['store'],
+                update_fields=SUMMARY_FIELDS + ['updated_at'],
+            )
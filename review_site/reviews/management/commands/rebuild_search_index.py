@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from reviews.models import Store
+from reviews.search import build_search_document, get_search_backend
+
+
+class Command(BaseCommand):
+    help = '店舗の検索用テキストと検索インデックスを作り直します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='一度に読み込む店舗数')
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        stores = Store.objects.prefetch_related('tags').order_by('id')
+
+        # 先に検索用テキストを更新してから、インデックスをまとめて作り直す
+        with transaction.atomic():
+            changed = []
+            for store in stores.iterator(chunk_size=options['batch_size']):
+                document = build_search_document(store)
+                if document != store.search_document:
+                    store.search_document = document
+                    changed.append(store)
+            Store.objects.bulk_update(changed, ['search_document'], batch_size=options['batch_size'])
+            backend.rebuild(Store.objects.only('id', 'search_document').iterator(chunk_size=options['batch_size']))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{type(backend).__name__}: {len(changed)}件の検索用テキストを更新し、インデックスを作り直しました'
+        ))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from reviews.models import Tag
+from reviews.tag_facets import count_stores_by_tag
+
+
+class Command(BaseCommand):
+    help = 'タグごとの店舗数（Tag.store_count）を店舗とタグの関連から数え直し・検証します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help='書き込みはせず、件数のずれだけを報告する')
+
+    def handle(self, *args, **options):
+        counts = count_stores_by_tag()
+        tags = list(Tag.objects.only('id', 'store_count'))
+        mismatched = [tag for tag in tags if tag.store_count != counts.get(tag.id, 0)]
+
+        if options['verify']:
+            if mismatched:
+                details = [f'{tag.id}: {tag.store_count} → {counts.get(tag.id, 0)}' for tag in mismatched[:20]]
+                raise CommandError(f'{len(mismatched)}/{len(tags)}件のタグの店舗数がずれています: {details}')
+            self.stdout.write(self.style.SUCCESS(f'{len(tags)}件のタグの店舗数はすべて正しいです'))
+            return
+
+        for tag in mismatched:
+            tag.store_count = counts.get(tag.id, 0)
+        with transaction.atomic():
+            Tag.objects.bulk_update(mismatched, ['store_count'], batch_size=500)
+        self.stdout.write(self.style.SUCCESS(f'{len(tags)}件中{len(mismatched)}件のタグの店舗数を更新しました'))
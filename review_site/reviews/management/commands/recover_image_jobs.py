@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from reviews.image_queue import find_stale_images, recover_stale_images
+from reviews.models import Store, UserProfile
+from reviews.page_cache import bump_store_version, bump_user_store_versions
+
+
+class Command(BaseCommand):
+    help = (
+        '再起動などで処理が失われ「処理中」のまま残った画像を「失敗」にします'
+        '（デプロイ後や定期実行で使う。元の画像は残っていないので再処理はしない）'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--minutes', type=int, default=getattr(settings, 'IMAGE_PROCESSING_STALE_MINUTES', 30),
+            help='予約からこの分数が過ぎても「処理中」の画像を対象にする（0なら「処理中」のものすべて）',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='更新せず、対象の件数だけを表示する')
+
+    def handle(self, *args, **options):
+        if options['minutes'] < 0:
+            raise CommandError('--minutes には0以上を指定してください')
+
+        if options['dry_run']:
+            for model, _, queryset in find_stale_images(options['minutes']):
+                self.stdout.write(f'{model.__name__}: 処理中のまま残っている画像 {queryset.count()}件')
+            return
+
+        recovered = recover_stale_images(options['minutes'])
+        for model, pks in recovered.items():
+            self.stdout.write(f'{model.__name__}: {len(pks)}件を失敗にしました')
+
+        # 「処理中」の表示がキャッシュに残らないように、関係する店舗のバージョンを上げる
+        if recovered.get(Store):
+            bump_store_version(*recovered[Store])
+        for user_id in UserProfile.objects.filter(pk__in=recovered.get(UserProfile, [])).values_list('user_id', flat=True):
+            bump_user_store_versions(user_id)
+        self.stdout.write(self.style.SUCCESS(f'{sum(map(len, recovered.values()))}件の画像を失敗にしました'))
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0010_conversation_directmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='store',
+            name='image_key',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='お店の画像（ブロブキー）'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='avatar_key',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='プロフィール画像（ブロブキー）'),
+        ),
+    ]
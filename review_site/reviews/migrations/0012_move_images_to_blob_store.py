@@ -0,0 +1,72 @@
+# Base64で保存されていた画像をブロブストレージに移す
+
+import base64
+import binascii
+
+from django.db import migrations
+
+from reviews.blobstore import get_blob_store
+
+BATCH_SIZE = 100
+
+
+def _move_to_blob_store(queryset, data_field, key_field):
+    """移した行の画像を消し、デコードできなかった行のIDを返す"""
+    store = get_blob_store()
+    undecodable = []
+    rows = queryset.filter(**{f'{data_field}__isnull': False}).exclude(**{data_field: ''})
+    # 1行ずつ大きなテキストを読むので、IDだけ先に取得してバッチで処理する
+    ids = list(rows.values_list('id', flat=True))
+    for start in range(0, len(ids), BATCH_SIZE):
+        for obj in queryset.filter(id__in=ids[start:start + BATCH_SIZE]).only('id', data_field):
+            try:
+                data = base64.b64decode(getattr(obj, data_field), validate=True)
+            except (binascii.Error, ValueError):
+                undecodable.append(obj.id)
+                continue
+            queryset.filter(id=obj.id).update(**{key_field: store.put(data), data_field: None})
+    return undecodable
+
+
+def _restore_from_blob_store(queryset, data_field, key_field):
+    store = get_blob_store()
+    for obj in queryset.filter(**{f'{key_field}__isnull': False}).only('id', key_field).iterator():
+        try:
+            data = store.read(getattr(obj, key_field))
+        except (FileNotFoundError, ValueError):
+            continue
+        queryset.filter(id=obj.id).update(**{data_field: base64.b64encode(data).decode('utf-8')})
+
+
+def forwards(apps, schema_editor):
+    Store = apps.get_model('reviews', 'Store')
+    UserProfile = apps.get_model('reviews', 'UserProfile')
+    undecodable = {
+        'Store.image_data': _move_to_blob_store(Store.objects.all(), 'image_data', 'image_key'),
+        'UserProfile.avatar_data': _move_to_blob_store(UserProfile.objects.all(), 'avatar_data', 'avatar_key'),
+    }
+    # 次のマイグレーションで列を削除するので、移せなかった画像があれば黙って捨てずに中止する
+    # （トランザクションごと戻るので、画像は元の列に残る。直すか空にしてから再実行する）
+    failed = {field: ids for field, ids in undecodable.items() if ids}
+    if failed:
+        raise RuntimeError('Base64としてデコードできない画像があるため中止しました: ' + ', '.join(
+            f'{field} id={ids[:20]}（{len(ids)}件）' for field, ids in failed.items()
+        ))
+
+
+def backwards(apps, schema_editor):
+    Store = apps.get_model('reviews', 'Store')
+    UserProfile = apps.get_model('reviews', 'UserProfile')
+    _restore_from_blob_store(Store.objects.all(), 'image_data', 'image_key')
+    _restore_from_blob_store(UserProfile.objects.all(), 'avatar_data', 'avatar_key')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0011_store_image_key_userprofile_avatar_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.1 on 2026-10-18 10:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0012_move_images_to_blob_store'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='store',
+            name='image_data',
+        ),
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='avatar_data',
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.1 on 2026-10-18 10:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0013_remove_store_image_data_remove_userprofile_avatar_data'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoreRatingSummary',
+            fields=[
+                ('store', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rating_summary', serialize=False, to='reviews.store', verbose_name='店')),
+                ('review_count', models.PositiveIntegerField(default=0, verbose_name='レビュー数')),
+                ('rating_1_count', models.PositiveIntegerField(default=0, verbose_name='評価1の件数')),
+                ('rating_2_count', models.PositiveIntegerField(default=0, verbose_name='評価2の件数')),
+                ('rating_3_count', models.PositiveIntegerField(default=0, verbose_name='評価3の件数')),
+                ('rating_4_count', models.PositiveIntegerField(default=0, verbose_name='評価4の件数')),
+                ('rating_5_count', models.PositiveIntegerField(default=0, verbose_name='評価5の件数')),
+                ('rating_average', models.FloatField(default=0, verbose_name='平均評価')),
+                ('last_review_at', models.DateTimeField(blank=True, null=True, verbose_name='最終レビュー日')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日')),
+            ],
+        ),
+    ]
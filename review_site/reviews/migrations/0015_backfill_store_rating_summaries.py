@@ -0,0 +1,49 @@
+# 既存のレビューから店舗ごとの評価集計を作成する
+
+from django.db import migrations
+from django.db.models import Count, Max, Q
+
+RATINGS = [1, 2, 3, 4, 5]
+
+
+def forwards(apps, schema_editor):
+    Store = apps.get_model('reviews', 'Store')
+    StoreRatingSummary = apps.get_model('reviews', 'StoreRatingSummary')
+
+    annotations = {
+        'total_reviews': Count('reviews'),
+        'last_review': Max('reviews__created_at'),
+    }
+    for rating in RATINGS:
+        annotations[f'rating_{rating}_count'] = Count('reviews', filter=Q(reviews__rating=rating))
+
+    summaries = []
+    for store in Store.objects.annotate(**annotations).iterator():
+        summary = StoreRatingSummary(
+            store_id=store.id,
+            review_count=store.total_reviews,
+            last_review_at=store.last_review,
+        )
+        total = 0
+        for rating in RATINGS:
+            count = getattr(store, f'rating_{rating}_count')
+            setattr(summary, f'rating_{rating}_count', count)
+            total += rating * count
+        summary.rating_average = total / store.total_reviews if store.total_reviews else 0
+        summaries.append(summary)
+    StoreRatingSummary.objects.bulk_create(summaries, batch_size=500)
+
+
+def backwards(apps, schema_editor):
+    apps.get_model('reviews', 'StoreRatingSummary').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0014_storeratingsummary'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
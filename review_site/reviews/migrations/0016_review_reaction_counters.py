@@ -0,0 +1,28 @@
+# Generated by Django 5.2.1 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0015_backfill_store_rating_summaries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='review',
+            name='bad_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='👎の数'),
+        ),
+        migrations.AddField(
+            model_name='review',
+            name='good_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='👍の数'),
+        ),
+        migrations.AddField(
+            model_name='review',
+            name='question_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='❓の数'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# 既存のリアクションからReviewのリアクション数を計算する
+
+from django.db import migrations
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+REACTION_TYPES = ['good', 'bad', 'question']
+
+
+def forwards(apps, schema_editor):
+    Review = apps.get_model('reviews', 'Review')
+    Reaction = apps.get_model('reviews', 'Reaction')
+
+    # リアクションの種類ごとに1回のUPDATEで全レビューを更新する
+    for reaction_type in REACTION_TYPES:
+        counts = (
+            Reaction.objects.filter(review=OuterRef('pk'), reaction_type=reaction_type)
+            .values('review')
+            .annotate(c=Count('id'))
+            .values('c')
+        )
+        Review.objects.update(**{
+            f'{reaction_type}_count': Coalesce(Subquery(counts, output_field=IntegerField()), Value(0)),
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0016_review_reaction_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
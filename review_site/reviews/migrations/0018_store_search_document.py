@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0017_backfill_review_reaction_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='store',
+            name='search_document',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='検索用テキスト'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# 店舗検索用のインデックスを作成し、既存の店舗を登録する
+# SQLiteではFTS5の仮想テーブル、PostgreSQLではpg_trgmのGINインデックスを使う
+
+from django.db import migrations
+
+from reviews.search import FTS_TABLE, build_search_document, ngram_tokens
+
+TRGM_INDEX = 'reviews_store_search_trgm'
+
+
+def create_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(document)')
+    elif vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {TRGM_INDEX} ON reviews_store USING gin (search_document gin_trgm_ops)'
+        )
+
+
+def drop_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+    elif vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX IF EXISTS {TRGM_INDEX}')
+
+
+def populate(apps, schema_editor):
+    Store = apps.get_model('reviews', 'Store')
+    vendor = schema_editor.connection.vendor
+    for store in Store.objects.prefetch_related('tags').iterator(chunk_size=500):
+        document = build_search_document(store)
+        Store.objects.filter(id=store.id).update(search_document=document)
+        if vendor == 'sqlite':
+            schema_editor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, document) VALUES (%s, %s)',
+                [store.id, ' '.join(ngram_tokens(document))],
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0018_store_search_document'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+        migrations.RunPython(populate, migrations.RunPython.noop),
+    ]
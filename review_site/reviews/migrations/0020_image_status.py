@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0019_store_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='store',
+            name='image_status',
+            field=models.CharField(choices=[('ready', '完了'), ('processing', '処理中'), ('failed', '失敗')], default='ready', max_length=20, verbose_name='お店の画像の状態'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='avatar_status',
+            field=models.CharField(choices=[('ready', '完了'), ('processing', '処理中'), ('failed', '失敗')], default='ready', max_length=20, verbose_name='プロフィール画像の状態'),
+        ),
+    ]
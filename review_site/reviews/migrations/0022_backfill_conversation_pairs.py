@@ -0,0 +1,44 @@
+# 既存の会話に (low_user, high_user) を設定し、同じ2人の重複した会話を1つにまとめる
+
+from collections import defaultdict
+
+from django.db import migrations
+from django.db.models import Max
+
+
+def forwards(apps, schema_editor):
+    Conversation = apps.get_model('reviews', 'Conversation')
+    DirectMessage = apps.get_model('reviews', 'DirectMessage')
+    Participant = Conversation.participants.through
+
+    participants = defaultdict(set)
+    for conversation_id, user_id in Participant.objects.values_list('conversation_id', 'user_id').iterator():
+        participants[conversation_id].add(user_id)
+
+    # 参加者が2人の会話だけを対象にする（それ以外はキーなしのまま残す）
+    by_pair = defaultdict(list)
+    for conversation_id, user_ids in participants.items():
+        if len(user_ids) == 2:
+            by_pair[tuple(sorted(user_ids))].append(conversation_id)
+
+    for (low_id, high_id), conversation_ids in by_pair.items():
+        conversation_ids.sort()
+        keeper_id, duplicate_ids = conversation_ids[0], conversation_ids[1:]
+        if duplicate_ids:
+            # 一番古い会話にメッセージを移して、残りは削除する
+            DirectMessage.objects.filter(conversation_id__in=duplicate_ids).update(conversation_id=keeper_id)
+            latest = Conversation.objects.filter(id__in=conversation_ids).aggregate(latest=Max('updated_at'))['latest']
+            Conversation.objects.filter(id__in=duplicate_ids).delete()
+            Conversation.objects.filter(id=keeper_id).update(updated_at=latest)
+        Conversation.objects.filter(id=keeper_id).update(low_user_id=low_id, high_user_id=high_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0021_conversation_pair_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0022_backfill_conversation_pairs'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('low_user', 'high_user'), name='unique_conversation_pair'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.CheckConstraint(condition=models.Q(('low_user__lt', models.F('high_user'))), name='conversation_pair_ordered'),
+        ),
+    ]
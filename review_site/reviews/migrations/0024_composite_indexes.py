@@ -0,0 +1,59 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:00
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0023_conversation_pair_constraints'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='directmessage',
+            index=models.Index(fields=['conversation', 'created_at'], name='dm_conversation_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='directmessage',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['conversation', 'sender'], name='dm_conversation_unread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='follow',
+            index=models.Index(fields=['following', 'follower'], name='follow_following_follower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', '-created_at'], name='notif_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['user'], name='notif_user_unread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reaction',
+            index=models.Index(fields=['review', 'reaction_type'], name='reaction_review_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['store', '-created_at', '-id'], name='review_store_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['store', 'rating'], name='review_store_rating_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['user', '-created_at'], name='review_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='store',
+            index=models.Index(fields=['-created_at', '-id'], name='store_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='store',
+            index=models.Index(fields=['created_by', '-created_at'], name='store_creator_created_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0024_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='store_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='店舗数'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# 既存の店舗とタグの関連からタグごとの店舗数を計算する
+
+from django.db import migrations
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def forwards(apps, schema_editor):
+    Tag = apps.get_model('reviews', 'Tag')
+    Store = apps.get_model('reviews', 'Store')
+    through = Store.tags.through
+
+    counts = (
+        through.objects.filter(tag_id=OuterRef('pk'))
+        .values('tag_id')
+        .annotate(c=Count('id'))
+        .values('c')
+    )
+    Tag.objects.update(store_count=Coalesce(Subquery(counts, output_field=IntegerField()), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0025_tag_store_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0026_backfill_tag_store_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='followers_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='フォロワー数'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='following_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='フォロー数'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# 既存のフォロー関係からUserProfileのフォロワー数・フォロー数を計算する
+
+from django.db import migrations
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def forwards(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    UserProfile = apps.get_model('reviews', 'UserProfile')
+    Follow = apps.get_model('reviews', 'Follow')
+
+    # フォロー関係があるのにプロフィールがないユーザーには、プロフィールを作っておく
+    missing = (User.objects
+               .filter(Q(following__isnull=False) | Q(followers__isnull=False), profile__isnull=True)
+               .values_list('id', flat=True)
+               .distinct())
+    UserProfile.objects.bulk_create([UserProfile(user_id=user_id) for user_id in missing])
+
+    for field, column in [('followers_count', 'following'), ('following_count', 'follower')]:
+        counts = (
+            Follow.objects.filter(**{column: OuterRef('user_id')})
+            .values(column)
+            .annotate(c=Count('id'))
+            .values('c')
+        )
+        UserProfile.objects.update(**{
+            field: Coalesce(Subquery(counts, output_field=IntegerField()), Value(0)),
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0027_userprofile_follow_counts'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0029_notification_retention_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='store',
+            name='image_queued_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='お店の画像の処理の予約日時'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='avatar_queued_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='プロフィール画像の処理の予約日時'),
+        ),
+    ]
@@ -1,16 +1,28 @@
 # reviews/models.py
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Case, Count, Q, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Cast, Coalesce, Greatest, Now
 from django.contrib.auth.models import User
-import base64
-import io
-from PIL import Image
+from django.urls import reverse
+
+# アップロード画像の処理状態
+IMAGE_STATUS_CHOICES = [
+    ('ready', '完了'),
+    ('processing', '処理中'),
+    ('failed', '失敗'),
+]
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, verbose_name="ユーザー", on_delete=models.CASCADE, related_name='profile')
     bio = models.TextField("自己紹介", blank=True, null=True, max_length=500)
-    avatar_data = models.TextField("プロフィール画像（Base64）", blank=True, null=True)
+    avatar_key = models.CharField("プロフィール画像（ブロブキー）", max_length=64, blank=True, null=True)
+    avatar_status = models.CharField("プロフィール画像の状態", max_length=20, choices=IMAGE_STATUS_CHOICES, default='ready')
+    avatar_queued_at = models.DateTimeField("プロフィール画像の処理の予約日時", blank=True, null=True, editable=False)
     location = models.CharField("住所", max_length=100, blank=True, null=True)
     birth_date = models.DateField("生年月日", blank=True, null=True)
+    # フォロワー数・フォロー数（Follow.toggle()で更新する非正規化カウンタ）
+    followers_count = models.PositiveIntegerField("フォロワー数", default=0, editable=False)
+    following_count = models.PositiveIntegerField("フォロー数", default=0, editable=False)
     created_at = models.DateTimeField("作成日", auto_now_add=True)
     updated_at = models.DateTimeField("更新日", auto_now=True)
 
@@ -18,9 +30,9 @@ class UserProfile(models.Model):
         return f"{self.user.username}のプロフィール"
     
     def get_avatar_url(self):
-        """Base64画像データをdata URLとして返す"""
-        if self.avatar_data:
-            return f"data:image/jpeg;base64,{self.avatar_data}"
+        """ブロブストレージに保存した画像のURLを返す"""
+        if self.avatar_key:
+            return reverse('blob_image', args=[self.avatar_key])
         return None
 
 class Follow(models.Model):
@@ -30,10 +42,55 @@ class Follow(models.Model):
 
     class Meta:
         unique_together = ('follower', 'following')
+        indexes = [
+            # フォロワーの一覧・数（unique_togetherのインデックスはフォローする側から引く場合だけ使える）
+            models.Index(fields=['following', 'follower'], name='follow_following_follower_idx'),
+        ]
         
     def __str__(self):
         return f"{self.follower.username} → {self.following.username}"
 
+    @classmethod
+    def toggle(cls, follower_id, following_id):
+        """
+        フォロー・フォロー解除を切り替え、両者のUserProfileのカウンタも同じトランザクションでF()式で更新する。
+        先にDELETEして、消えなければフォローとしてINSERTする（存在確認のSELECTやセーブポイントを使わない）。
+        戻り値は (フォローした状態ならTrue, フォローされる側のフォロワー数)。
+        同時に同じフォローが作られてこの呼び出しでは何も変わらなかった場合は、最初の要素がNoneになる。
+        """
+        try:
+            with transaction.atomic():
+                deleted, _ = cls.objects.filter(follower_id=follower_id, following_id=following_id).delete()
+                if not deleted:
+                    cls.objects.create(follower_id=follower_id, following_id=following_id)
+                delta = -1 if deleted else 1
+                cls._apply_count(following_id, 'followers_count', delta)
+                cls._apply_count(follower_id, 'following_count', delta)
+                return delta > 0, cls._followers_count(following_id)
+        except IntegrityError:
+            # 同時に同じフォローが作られた場合（カウンタはもう一方のリクエストで更新済み）
+            return None, cls._followers_count(following_id)
+
+    @classmethod
+    def _followers_count(cls, user_id):
+        count = UserProfile.objects.filter(user_id=user_id).values_list('followers_count', flat=True).first()
+        return count or 0
+
+    @classmethod
+    def _apply_count(cls, user_id, field, delta):
+        updated = UserProfile.objects.filter(user_id=user_id).update(**{field: Greatest(F(field) + delta, 0)})
+        if not updated:
+            # プロフィールがまだないユーザーは、Followテーブルから数えて作る（変更後の件数になる）
+            UserProfile.objects.get_or_create(user_id=user_id, defaults=cls.count_for(user_id))
+
+    @classmethod
+    def count_for(cls, user_id):
+        """Followテーブルから数えたフォロワー数・フォロー数"""
+        return {
+            'followers_count': cls.objects.filter(following_id=user_id).count(),
+            'following_count': cls.objects.filter(follower_id=user_id).count(),
+        }
+
 class Notification(models.Model):
     NOTIFICATION_TYPES = [
         ('follow', 'フォロー'),
@@ -50,28 +107,69 @@ class Notification(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # ユーザーごとの通知一覧（新しい順。キーセットページネーション）
+            models.Index(fields=['user', '-created_at', '-id'], name='notif_user_created_id_idx'),
+            # 未読数と既読化（未読の行だけを持つ部分インデックス）
+            models.Index(fields=['user'], condition=Q(is_read=False), name='notif_user_unread_idx'),
+            # 古い既読の通知の削除（manage.py purge_notifications）
+            models.Index(fields=['created_at'], condition=Q(is_read=True), name='notif_read_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.from_user.username}から{self.user.username}への{self.get_notification_type_display()}"
 
+class StoreQuerySet(models.QuerySet):
+    def with_rating_stats(self):
+        """レビュー総数と評価ごとの件数を1回の集計クエリでアノテートする"""
+        annotations = {'total_reviews': Count('reviews')}
+        for rating_value, _ in Review.RATING_CHOICES:
+            annotations[f'rating_{rating_value}_count'] = Count('reviews', filter=Q(reviews__rating=rating_value))
+        return self.annotate(**annotations)
+
 # ... Storeモデルは変更なし ...
 class Store(models.Model):
     name = models.CharField("店名", max_length=100)
     address = models.CharField("住所", max_length=200)
-    image_data = models.TextField("お店の画像（Base64）", blank=True, null=True)
+    image_key = models.CharField("お店の画像（ブロブキー）", max_length=64, blank=True, null=True)
+    image_status = models.CharField("お店の画像の状態", max_length=20, choices=IMAGE_STATUS_CHOICES, default='ready')
+    image_queued_at = models.DateTimeField("お店の画像の処理の予約日時", blank=True, null=True, editable=False)
     created_by = models.ForeignKey(User, verbose_name="登録者", on_delete=models.CASCADE)
     tags = models.ManyToManyField('Tag', verbose_name="タグ", blank=True)
     comment = models.TextField("コメント", blank=True, null=True)
     website_url = models.URLField("公式サイトURL", blank=True, null=True)
     created_at = models.DateTimeField("登録日", auto_now_add=True)
+    # 検索用テキスト（店名・住所・コメント・タグ名。reviews.search.update_search_index()で更新）
+    search_document = models.TextField("検索用テキスト", blank=True, default='', editable=False)
+
+    objects = StoreQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # 店一覧のキーセットページネーション (created_at, id) の新しい順
+            models.Index(fields=['-created_at', '-id'], name='store_created_idx'),
+            # プロフィールの「登録したお店」
+            models.Index(fields=['created_by', '-created_at'], name='store_creator_created_idx'),
+        ]
 
     def __str__(self):
         return self.name
+
+    def get_rating_summary(self):
+        """評価の集計テーブルの行を返す（まだレビューがなければ空の集計）"""
+        try:
+            return self.rating_summary
+        except StoreRatingSummary.DoesNotExist:
+            return StoreRatingSummary(store=self)
+
+    def get_rating_stats(self, limit=None):
+        """評価統計を集計テーブルから作る（件数の多い順、limitで上位のみ）"""
+        return self.get_rating_summary().get_rating_stats(limit=limit)
     
     def get_image_url(self):
-        """Base64画像データをdata URLとして返す"""
-        if self.image_data:
-            return f"data:image/jpeg;base64,{self.image_data}"
+        """ブロブストレージに保存した画像のURLを返す"""
+        if self.image_key:
+            return reverse('blob_image', args=[self.image_key])
         return None
 
 # タグモデル
@@ -93,6 +191,8 @@ class Tag(models.Model):
     color = models.CharField("色", max_length=7, choices=COLOR_CHOICES, default='#4ECDC4')
     created_by = models.ForeignKey(User, verbose_name="作成者", on_delete=models.CASCADE)
     created_at = models.DateTimeField("作成日", auto_now_add=True)
+    # このタグが付いた店舗の数（reviews.tag_facetsで店舗へのタグの追加・削除のたびに差分だけ更新する）
+    store_count = models.PositiveIntegerField("店舗数", default=0, editable=False)
     
     def __str__(self):
         return self.name
@@ -116,10 +216,122 @@ class Review(models.Model):
     rating = models.IntegerField("評価", choices=RATING_CHOICES, default=3)
     comment = models.TextField("コメント", blank=True, null=True)
     created_at = models.DateTimeField("投稿日", auto_now_add=True)
+    # リアクション数（Reaction.toggle()で更新する非正規化カウンタ）
+    good_count = models.PositiveIntegerField("👍の数", default=0)
+    bad_count = models.PositiveIntegerField("👎の数", default=0)
+    question_count = models.PositiveIntegerField("❓の数", default=0)
+
+    class Meta:
+        indexes = [
+            # 店の詳細のレビュー一覧（キーセットページネーション）
+            models.Index(fields=['store', '-created_at', '-id'], name='review_store_created_idx'),
+            # 店ごと・評価ごとの集計（評価集計の再構築）
+            models.Index(fields=['store', 'rating'], name='review_store_rating_idx'),
+            # プロフィールの「最近のレビュー」
+            models.Index(fields=['user', '-created_at'], name='review_user_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.store.name}への{self.user.username}のレビュー"
 
+    def get_reaction_counts(self):
+        return {
+            'good': self.good_count,
+            'bad': self.bad_count,
+            'question': self.question_count,
+        }
+
+class StoreRatingSummary(models.Model):
+    """
+    店舗ごとの評価の集計（非正規化テーブル）。
+    レビューの投稿・削除のたびに差分だけ更新するので、一覧や詳細ではこの1行を読むだけで済む。
+    """
+    store = models.OneToOneField(Store, verbose_name="店", on_delete=models.CASCADE, primary_key=True, related_name='rating_summary')
+    review_count = models.PositiveIntegerField("レビュー数", default=0)
+    rating_1_count = models.PositiveIntegerField("評価1の件数", default=0)
+    rating_2_count = models.PositiveIntegerField("評価2の件数", default=0)
+    rating_3_count = models.PositiveIntegerField("評価3の件数", default=0)
+    rating_4_count = models.PositiveIntegerField("評価4の件数", default=0)
+    rating_5_count = models.PositiveIntegerField("評価5の件数", default=0)
+    rating_average = models.FloatField("平均評価", default=0)
+    last_review_at = models.DateTimeField("最終レビュー日", blank=True, null=True)
+    updated_at = models.DateTimeField("更新日", auto_now=True)
+
+    def __str__(self):
+        return f"{self.store}の評価集計"
+
+    def get_rating_stats(self, limit=None):
+        rating_stats = {}
+        for rating_value, rating_label in Review.RATING_CHOICES:
+            count = getattr(self, f'rating_{rating_value}_count')
+            if count > 0:
+                rating_stats[rating_value] = {
+                    'label': rating_label,
+                    'count': count
+                }
+        sorted_ratings = sorted(rating_stats.items(), key=lambda x: x[1]['count'], reverse=True)
+        return dict(sorted_ratings[:limit])
+
+    def _compute_average(self):
+        if not self.review_count:
+            return 0
+        total = sum(value * getattr(self, f'rating_{value}_count') for value, _ in Review.RATING_CHOICES)
+        return total / self.review_count
+
+    @classmethod
+    def _apply(cls, store_id, rating, delta, **fields):
+        """
+        評価ratingの件数・レビュー数・平均評価を1回のUPDATEでF()式で更新する（読み込んでから書かないので同時の更新を失わない）。
+        更新した行数を返す。fieldsは同じUPDATEで設定するほかの列。
+        """
+        total = sum((value * F(f'rating_{value}_count') for value, _ in Review.RATING_CHOICES), Value(rating * delta))
+        # 平均は更新前の値から計算する（列を左から順に更新するDBでも結果が変わらないよう先頭に置く）
+        average = Case(
+            When(review_count__gt=-delta, then=Cast(total, models.FloatField()) / (F('review_count') + delta)),
+            default=Value(0.0),
+        )
+        field = f'rating_{rating}_count'
+        return cls.objects.filter(store_id=store_id).update(
+            rating_average=average,
+            **{field: Greatest(F(field) + delta, 0)},
+            review_count=Greatest(F('review_count') + delta, 0),
+            updated_at=Now(),
+            **fields,
+        )
+
+    @classmethod
+    def record_review(cls, review):
+        """レビュー投稿時に集計へ1件加える（呼び出し側のトランザクション内で実行する）"""
+        last_review_at = Case(
+            When(Q(last_review_at__isnull=True) | Q(last_review_at__lt=review.created_at), then=Value(review.created_at)),
+            default=F('last_review_at'),
+        )
+        if not cls._apply(review.store_id, review.rating, 1, last_review_at=last_review_at):
+            # 最初のレビューなら空の集計行を作ってから加える（同時に作られていれば作成はしない）
+            cls.objects.get_or_create(store_id=review.store_id)
+            cls._apply(review.store_id, review.rating, 1, last_review_at=last_review_at)
+
+    @classmethod
+    def discard_review(cls, review):
+        """レビュー削除時に集計から1件引く（レビューを削除した後に、呼び出し側のトランザクション内で実行する）"""
+        # 最新のレビューが消えた場合だけ、最終レビュー日を残りのレビューから取り直す
+        latest = Review.objects.filter(store_id=OuterRef('store_id')).order_by('-created_at').values('created_at')[:1]
+        cls._apply(review.store_id, review.rating, -1, last_review_at=Case(
+            When(last_review_at=review.created_at, then=Subquery(latest)),
+            default=F('last_review_at'),
+        ))
+
+    @classmethod
+    def build_from_reviews(cls, stores):
+        """Reviewテーブルを集計して、店舗ごとの正しい集計行（未保存）を作る"""
+        stores = stores.with_rating_stats().annotate(last_review=models.Max('reviews__created_at'))
+        for store in stores.iterator():
+            summary = cls(store_id=store.id, review_count=store.total_reviews, last_review_at=store.last_review)
+            for rating_value, _ in Review.RATING_CHOICES:
+                setattr(summary, f'rating_{rating_value}_count', getattr(store, f'rating_{rating_value}_count'))
+            summary.rating_average = summary._compute_average()
+            yield summary
+
 class Reaction(models.Model):
     REACTION_CHOICES = [
         ('good', '👍 ぐっと'),
@@ -134,21 +346,120 @@ class Reaction(models.Model):
 
     class Meta:
         unique_together = ('review', 'user')  # 1つのレビューに対して1人1つのリアクションのみ
+        indexes = [
+            # レビューごと・種類ごとのリアクション数（カウンタの再計算）
+            models.Index(fields=['review', 'reaction_type'], name='reaction_review_type_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username}が{self.review}に{self.get_reaction_type_display()}"
 
+    @classmethod
+    def toggle(cls, review_id, user, reaction_type):
+        """
+        リアクションを追加・取り消し・変更し、Reviewのカウンタも同じトランザクションでF()式で更新する。
+        レビュー行をロックしてから処理するので、同時にクリックされてもカウンタがずれない。
+        戻り値は (action, リアクション数のdict)。
+        """
+        with transaction.atomic():
+            list(Review.objects.select_for_update().filter(id=review_id).values_list('id', flat=True))
+            existing = cls.objects.filter(review_id=review_id, user=user).first()
+            deltas = {}
+
+            if existing is None:
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(review_id=review_id, user=user, reaction_type=reaction_type)
+                    deltas[reaction_type] = 1
+                    action = 'added'
+                except IntegrityError:
+                    # 行ロックのないDB（SQLite）で同時に作成された場合は、既存のリアクションとして扱う
+                    existing = cls.objects.get(review_id=review_id, user=user)
+
+            if existing is not None:
+                if existing.reaction_type == reaction_type:
+                    # 同じリアクションなら削除（取り消し）
+                    existing.delete()
+                    deltas[reaction_type] = -1
+                    action = 'removed'
+                else:
+                    # 違うリアクションなら更新
+                    deltas[existing.reaction_type] = -1
+                    deltas[reaction_type] = 1
+                    existing.reaction_type = reaction_type
+                    existing.save(update_fields=['reaction_type'])
+                    action = 'updated'
+
+            # カウンタがずれていても負にはしない
+            Review.objects.filter(id=review_id).update(**{
+                f'{key}_count': Greatest(F(f'{key}_count') + delta, 0) for key, delta in deltas.items()
+            })
+            review = Review.objects.only('good_count', 'bad_count', 'question_count').get(id=review_id)
+
+        return action, review.get_reaction_counts()
+
+class ConversationQuerySet(models.QuerySet):
+    def inbox_for(self, user):
+        """
+        ユーザーの受信箱（メッセージのある会話を新しい順）を返す。
+        最後のメッセージと未読数はサブクエリでアノテートするので、会話が何件あってもクエリは1回。
+        """
+        last_message = DirectMessage.objects.filter(conversation=OuterRef('pk')).order_by('-id')
+        unread = (DirectMessage.objects
+                  .filter(conversation=OuterRef('pk'), is_read=False)
+                  .exclude(sender_id=user.id)
+                  .order_by()
+                  .values('conversation')
+                  .annotate(count=Count('id'))
+                  .values('count'))
+        return (self.filter(Q(low_user_id=user.id) | Q(high_user_id=user.id))
+                .select_related('low_user__profile', 'high_user__profile')
+                .annotate(
+                    last_message_content=Subquery(last_message.values('content')[:1]),
+                    last_message_sender_id=Subquery(last_message.values('sender_id')[:1]),
+                    last_message_at=Subquery(last_message.values('created_at')[:1]),
+                    unread_count=Coalesce(Subquery(unread), 0),
+                )
+                .filter(last_message_at__isnull=False)
+                .order_by('-updated_at', '-id'))
+
 class Conversation(models.Model):
     """
     ユーザー間の会話を表すモデル。
     参加者を2人に限定する。
     """
     participants = models.ManyToManyField(User, related_name='conversations')
+    # 参加者2人をIDの小さい順に並べたキー（2人の会話を1回のインデックス検索で見つけるため）
+    low_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', null=True, blank=True)
+    high_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ConversationQuerySet.as_manager()
+
     class Meta:
         ordering = ['-updated_at']
+        constraints = [
+            models.UniqueConstraint(fields=['low_user', 'high_user'], name='unique_conversation_pair'),
+            models.CheckConstraint(condition=Q(low_user__lt=F('high_user')), name='conversation_pair_ordered'),
+        ]
+
+    @classmethod
+    def get_or_create_between(cls, user_a, user_b):
+        """
+        2人の会話を取得し、なければ作成する。
+        (low_user, high_user) の一意制約があるので、同時に最初のメッセージが送られても会話は1つだけになる。
+        """
+        low_id, high_id = sorted([user_a.id, user_b.id])
+        with transaction.atomic():
+            conversation, created = cls.objects.get_or_create(low_user_id=low_id, high_user_id=high_id)
+            if created:
+                conversation.participants.add(low_id, high_id)
+        return conversation
+
+    def get_other_user(self, user):
+        """会話の相手（low_user/high_userはselect_relatedしておくこと）"""
+        return self.high_user if self.low_user_id == user.id else self.low_user
 
     def __str__(self):
         users = self.participants.all()
@@ -168,6 +479,12 @@ class DirectMessage(models.Model):
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # 会話のメッセージ一覧
+            models.Index(fields=['conversation', 'created_at'], name='dm_conversation_created_idx'),
+            # 受信箱の未読数と既読化（未読の行だけを持つ部分インデックス）
+            models.Index(fields=['conversation', 'sender'], condition=Q(is_read=False), name='dm_conversation_unread_idx'),
+        ]
 
     def __str__(self):
         return f"From {self.sender.username} at {self.created_at:%Y-%m-%d %H:%M}"
\ No newline at end of file
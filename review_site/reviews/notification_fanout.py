@@ -0,0 +1,235 @@
+# reviews/notification_fanout.py
+"""
+レビューを投稿したときの、投稿者のフォロワーへの通知（ファンアウト）。
+
+フォロワーが多い人でも投稿のリクエストを遅くしないように、通知の作成はコミット後にワーカースレッドで行う。
+フォロワーは follower_id のキーセットで NOTIFICATION_FANOUT_CHUNK_SIZE 人ずつ読み、
+チャンクごとに bulk_create でまとめて作成する（1人ずつ INSERT しない）。
+
+同じ投稿者からの未読のレビュー通知が NOTIFICATION_COALESCE_SECONDS 以内にあるフォロワーには新しい通知を作らず、
+その通知を「〜ほかのお店のレビュー」に書き換えて新しい日時にする（連続して投稿しても通知が積み上がらない）。
+
+ファンアウトごとに、投稿から完了までの時間・チャンクの大きさ・作成/まとめた件数を
+JSON形式のログ（reviews.notifications）に出し、プロセス内の集計を get_metrics() で返す。
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .models import Follow, Notification
+from .notifications import incr_unread_counts
+
+logger = logging.getLogger('reviews.notifications')
+
+NOTIFICATION_TYPE = 'review'
+# get_metrics() の遅延の集計に使う直近のファンアウトの数
+RECENT_RESULTS = 200
+
+
+def _chunk_size():
+    return getattr(settings, 'NOTIFICATION_FANOUT_CHUNK_SIZE', 500)
+
+
+def _coalesce_window():
+    return timedelta(seconds=getattr(settings, 'NOTIFICATION_COALESCE_SECONDS', 600))
+
+
+def review_message(username, store_name):
+    return f'{username}さんが{store_name}のレビューを投稿しました。'
+
+
+def coalesced_message(username, store_name):
+    return f'{username}さんが{store_name}ほかのお店のレビューを投稿しました。'
+
+
+class FanoutResult:
+    def __init__(self, review_id, author_id):
+        self.review_id = review_id
+        self.author_id = author_id
+        self.created = 0
+        self.coalesced = 0
+        self.chunk_sizes = []
+        self.queued_ms = 0.0
+        self.duration_ms = 0.0
+
+    @property
+    def latency_ms(self):
+        """投稿（コミット）から通知の作成が終わるまで"""
+        return self.queued_ms + self.duration_ms
+
+    def as_dict(self):
+        return {
+            'review_id': self.review_id,
+            'author_id': self.author_id,
+            'followers': sum(self.chunk_sizes),
+            'created': self.created,
+            'coalesced': self.coalesced,
+            'chunks': len(self.chunk_sizes),
+            'chunk_sizes': self.chunk_sizes,
+            'queued_ms': round(self.queued_ms, 2),
+            'duration_ms': round(self.duration_ms, 2),
+            'latency_ms': round(self.latency_ms, 2),
+        }
+
+
+def fan_out_review(review_id, author_id, username, store_name, queued_at=None):
+    """投稿者のフォロワー全員にレビューの通知を作成する（その場で実行する）"""
+    result = FanoutResult(review_id, author_id)
+    started = time.perf_counter()
+    if queued_at is not None:
+        result.queued_ms = (started - queued_at) * 1000
+
+    chunk_size = _chunk_size()
+    now = timezone.now()
+    recent = Notification.objects.filter(
+        from_user_id=author_id,
+        notification_type=NOTIFICATION_TYPE,
+        is_read=False,
+        created_at__gte=now - _coalesce_window(),
+    )
+    followers = (Follow.objects
+                 .filter(following_id=author_id)
+                 .annotate(has_recent=Exists(recent.filter(user_id=OuterRef('follower_id'))))
+                 .order_by('follower_id'))
+    message = review_message(username, store_name)
+
+    last_follower_id = 0
+    while True:
+        with transaction.atomic():
+            rows = list(followers.filter(follower_id__gt=last_follower_id)
+                        .values_list('follower_id', 'has_recent')[:chunk_size])
+            if not rows:
+                break
+            last_follower_id = rows[-1][0]
+            coalesced_ids = set()
+            candidate_ids = [follower_id for follower_id, has_recent in rows if has_recent]
+            # 読んでから書くまでに既読にされた通知は更新されないので、
+            # 実際に書き換えた（日時が now になった）通知の受け取り手だけをまとめた扱いにする
+            if candidate_ids and recent.filter(user_id__in=candidate_ids).update(
+                message=coalesced_message(username, store_name), created_at=now,
+            ):
+                coalesced_ids = set(Notification.objects.filter(
+                    from_user_id=author_id, notification_type=NOTIFICATION_TYPE,
+                    user_id__in=candidate_ids, created_at=now,
+                ).values_list('user_id', flat=True))
+            new_ids = [follower_id for follower_id, _ in rows if follower_id not in coalesced_ids]
+            Notification.objects.bulk_create([
+                Notification(user_id=follower_id, from_user_id=author_id,
+                             notification_type=NOTIFICATION_TYPE, message=message)
+                for follower_id in new_ids
+            ], batch_size=chunk_size)
+        result.coalesced += len(coalesced_ids)
+        result.created += len(new_ids)
+        result.chunk_sizes.append(len(rows))
+
+        # まとめた通知は未読のままなので未読数は変わらない
+        if new_ids:
+            incr_unread_counts(new_ids)
+        if len(rows) < chunk_size:
+            break
+
+    result.duration_ms = (time.perf_counter() - started) * 1000
+    _record(result)
+    return result
+
+
+_metrics_lock = threading.Lock()
+_totals = {'jobs': 0, 'failed': 0, 'created': 0, 'coalesced': 0, 'chunks': 0, 'max_chunk_size': 0}
+_recent = deque(maxlen=RECENT_RESULTS)
+
+
+def _record(result):
+    logger.info(json.dumps({'event': 'review_fanout', **result.as_dict()}, ensure_ascii=False))
+    with _metrics_lock:
+        _totals['jobs'] += 1
+        _totals['created'] += result.created
+        _totals['coalesced'] += result.coalesced
+        _totals['chunks'] += len(result.chunk_sizes)
+        _totals['max_chunk_size'] = max([_totals['max_chunk_size'], *result.chunk_sizes])
+        _recent.append(result)
+
+
+def _percentile(values, ratio):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * ratio))], 2) if values else None
+
+
+def get_metrics():
+    """このプロセスでのファンアウトの集計（件数の合計と、直近の遅延の中央値・95パーセンタイル）"""
+    with _metrics_lock:
+        totals = dict(_totals)
+        recent = list(_recent)
+    latencies = [result.latency_ms for result in recent]
+    return {
+        **totals,
+        'pending': len(_pending),
+        'avg_chunk_size': round((totals['created'] + totals['coalesced']) / totals['chunks'], 1) if totals['chunks'] else None,
+        'latency_ms_p50': _percentile(latencies, 0.5),
+        'latency_ms_p95': _percentile(latencies, 0.95),
+        'duration_ms_p95': _percentile([result.duration_ms for result in recent], 0.95),
+    }
+
+
+_executor_lock = threading.Lock()
+_executor = None
+_pending = set()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='notification-fanout')
+        return _executor
+
+
+def _fan_out_in_background(*args):
+    try:
+        fan_out_review(*args)
+    except Exception:
+        logger.exception('レビュー通知のファンアウトに失敗しました: review_id=%s', args[0])
+        with _metrics_lock:
+            _totals['failed'] += 1
+    finally:
+        # ワーカースレッドのDB接続は使い終わったら閉じる
+        connection.close()
+
+
+def enqueue_review_fanout(review):
+    """
+    コミット後にレビューの通知のファンアウトを予約する
+    （NOTIFICATION_FANOUT_ASYNC が False ならその場で行う）。
+    """
+    args = (review.id, review.user_id, review.user.username, review.store.name)
+
+    def submit():
+        if not getattr(settings, 'NOTIFICATION_FANOUT_ASYNC', True):
+            fan_out_review(*args)
+            return
+        future = _get_executor().submit(_fan_out_in_background, *args, time.perf_counter())
+        with _executor_lock:
+            _pending.add(future)
+        future.add_done_callback(_discard_pending)
+
+    transaction.on_commit(submit)
+
+
+def _discard_pending(future):
+    with _executor_lock:
+        _pending.discard(future)
+
+
+def wait_for_pending(timeout=None):
+    """予約済みのファンアウトが終わるまで待つ（終了処理や計測で使う）"""
+    with _executor_lock:
+        pending = list(_pending)
+    wait(pending, timeout=timeout)
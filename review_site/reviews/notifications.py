@@ -0,0 +1,98 @@
+# reviews/notifications.py
+"""
+通知の作成と未読数の管理。
+
+未読数はユーザーごとにキャッシュしたカウンタで持ち、通知の作成・既読化のたびに更新して
+Pub/Subでそのユーザーのチャンネルに送る（SSEの接続がこれを受け取ってブラウザに流す）。
+キャッシュにない場合だけCOUNTクエリで数え直す。
+
+既読にした通知も履歴として残す。古い既読の通知と、ユーザーごとの上限（NOTIFICATION_HISTORY_LIMIT）を
+超えた既読の通知は manage.py purge_notifications で少しずつ削除する。
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+
+from .models import Notification
+from .pubsub import publish
+
+CACHE_KEY = 'unread_notifications:{user_id}'
+
+
+def notification_channel(user_id):
+    return f'notifications:{user_id}'
+
+
+def _timeout():
+    return getattr(settings, 'NOTIFICATION_COUNT_CACHE_TIMEOUT', 300)
+
+
+def get_unread_count(user_id):
+    key = CACHE_KEY.format(user_id=user_id)
+    count = cache.get(key)
+    if count is None:
+        count = Notification.objects.filter(user_id=user_id, is_read=False).count()
+        cache.set(key, count, _timeout())
+    return count
+
+
+def _publish_count(user_id):
+    publish(notification_channel(user_id), {'unread_count': get_unread_count(user_id)})
+
+
+def incr_unread_count(user_id, delta=1):
+    """未読数を増やして購読者に知らせる（キャッシュにない場合は次の読み込みで数え直す）"""
+    key = CACHE_KEY.format(user_id=user_id)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        pass
+    _publish_count(user_id)
+
+
+def incr_unread_counts(user_ids):
+    """複数のユーザーの未読数を1ずつ増やして知らせる（キャッシュにないユーザーの分は1回の集計で数え直す）"""
+    counts = {}
+    missing = []
+    for user_id in user_ids:
+        try:
+            counts[user_id] = cache.incr(CACHE_KEY.format(user_id=user_id))
+        except ValueError:
+            missing.append(user_id)
+    if missing:
+        recounted = dict(
+            Notification.objects.filter(user_id__in=missing, is_read=False)
+            .order_by().values('user_id').annotate(count=Count('id')).values_list('user_id', 'count')
+        )
+        for user_id in missing:
+            counts[user_id] = recounted.get(user_id, 0)
+        cache.set_many({CACHE_KEY.format(user_id=user_id): counts[user_id] for user_id in missing}, _timeout())
+    for user_id, count in counts.items():
+        publish(notification_channel(user_id), {'unread_count': count})
+
+
+def mark_all_read(user_id):
+    """未読の通知をすべて既読にする（未読の部分インデックスを使う1回のUPDATE）。既読にした件数を返す"""
+    marked = Notification.objects.filter(user_id=user_id, is_read=False).update(is_read=True)
+    if marked:
+        transaction.on_commit(lambda: reset_unread_count(user_id))
+    return marked
+
+
+def reset_unread_count(user_id):
+    """すべて既読になったときに呼ぶ"""
+    cache.set(CACHE_KEY.format(user_id=user_id), 0, _timeout())
+    _publish_count(user_id)
+
+
+def notify(user, from_user, notification_type, message):
+    """通知を作成し、コミット後に未読数を更新する"""
+    notification = Notification.objects.create(
+        user=user,
+        from_user=from_user,
+        notification_type=notification_type,
+        message=message,
+    )
+    transaction.on_commit(lambda: incr_unread_count(user.id))
+    return notification
@@ -0,0 +1,155 @@
+# reviews/page_cache.py
+"""
+店舗ページのキャッシュ。
+
+店舗ごとのバージョン番号と、全体のバージョン番号をキャッシュに持ち、
+キャッシュのキーにバージョンを含めることで、書き込み時はバージョンを上げるだけで古いキャッシュを使わなくする。
+
+- 店舗カード・店舗情報の断片（fragment）: 店舗のバージョンをキーに含める。
+  全員に同じHTMLを返すので、友達バッジやオーナー用の操作など個人ごとの部分は断片の外に置く。
+- 未ログインユーザー向けのページ全体: 店舗一覧は全体のバージョン、詳細は店舗のバージョンをキーに含める。
+
+店舗・レビュー・タグ・リアクションを変更したら bump_store_version() を呼ぶ。
+バージョン番号は全ワーカーで共有するキャッシュに置くこと（locmem で複数ワーカーにすると reviews.E001 になる）。
+"""
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .models import Store
+
+GLOBAL_VERSION_KEY = 'store_pages:version'
+STORE_VERSION_KEY = 'store_pages:store:{store_id}:version'
+FRAGMENT_KEY = 'store_pages:fragment:{name}:{store_id}:{version}'
+PAGE_KEY = 'store_pages:page:{name}:{version}:{path}'
+
+
+def _timeout():
+    return getattr(settings, 'STORE_PAGE_CACHE_TIMEOUT', 600)
+
+
+def _new_version():
+    # バージョンのキーが追い出された後も以前の番号に戻らないように、時刻から作る
+    return time.time_ns()
+
+
+def _get_versions(keys):
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _new_version(), None)
+            versions[key] = cache.get(key, _new_version())
+    return versions
+
+
+def get_global_version():
+    return _get_versions([GLOBAL_VERSION_KEY])[GLOBAL_VERSION_KEY]
+
+
+def get_store_versions(store_ids):
+    """店舗IDごとのバージョンをまとめて取得する"""
+    keys = {store_id: STORE_VERSION_KEY.format(store_id=store_id) for store_id in store_ids}
+    versions = _get_versions(list(keys.values()))
+    return {store_id: versions[key] for store_id, key in keys.items()}
+
+
+def get_store_version(store_id):
+    return get_store_versions([store_id])[store_id]
+
+
+def bump_store_version(*store_ids):
+    """コミット後に店舗と全体のバージョンを上げる（コミット前に上げると古い内容が新しいキーで保存されうる）"""
+    def bump():
+        # incr はファイルのキャッシュでは読んでから書くので、同時に上げると同じ番号になりうる。
+        # 毎回新しい番号を書き込めば、同時に上げてもそれまでのどの番号とも重ならない
+        cache.set_many({
+            **{STORE_VERSION_KEY.format(store_id=store_id): _new_version() for store_id in store_ids},
+            GLOBAL_VERSION_KEY: _new_version(),
+        }, None)
+    transaction.on_commit(bump)
+
+
+def bump_user_store_versions(user_id):
+    """ユーザー名やアイコンが表示される店舗（登録した店・レビューした店）のバージョンを上げる"""
+    store_ids = (Store.objects
+                 .filter(Q(created_by_id=user_id) | Q(reviews__user_id=user_id))
+                 .values_list('id', flat=True)
+                 .distinct())
+    bump_store_version(*store_ids)
+
+
+def store_list_version(request):
+    return get_global_version()
+
+
+def store_detail_version(request, store_id):
+    return get_store_version(store_id)
+
+
+def render_store_fragments(name, stores, template_name, prepare=None):
+    """
+    店舗ごとの断片をキャッシュから取得し、なかったものだけ描画して保存する。
+    prepare(stores) は描画が必要な店舗だけに対して呼ばれる（タグのプリフェッチなど）。
+    {店舗ID: HTML} を返す。
+    """
+    versions = get_store_versions([store.id for store in stores])
+    keys = {store.id: FRAGMENT_KEY.format(name=name, store_id=store.id, version=versions[store.id])
+            for store in stores}
+    cached = cache.get_many(list(keys.values()))
+
+    fragments = {}
+    missed = []
+    for store in stores:
+        html = cached.get(keys[store.id])
+        if html is None:
+            missed.append(store)
+        else:
+            fragments[store.id] = mark_safe(html)
+
+    if missed:
+        if prepare is not None:
+            prepare(missed)
+        rendered = {}
+        for store in missed:
+            html = render_to_string(template_name, {'store': store})
+            rendered[keys[store.id]] = html
+            fragments[store.id] = mark_safe(html)
+        cache.set_many(rendered, _timeout())
+    return fragments
+
+
+def cache_anonymous_page(name, get_version):
+    """
+    未ログインユーザーへのGETレスポンスをバージョン付きのキーでキャッシュするデコレータ。
+    get_version(request, *args, **kwargs) がページの内容を決めるバージョンを返す。
+    ログインユーザーには個人ごとの表示があるので、キャッシュせずに毎回ビューを呼ぶ。
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET' or request.user.is_authenticated:
+                return view_func(request, *args, **kwargs)
+
+            # バージョンは描画前に読む（描画中に更新されても古い内容は古いキーに入るだけ）
+            version = get_version(request, *args, **kwargs)
+            path = hashlib.sha1(request.get_full_path().encode('utf-8')).hexdigest()
+            key = PAGE_KEY.format(name=name, version=version, path=path)
+            cached = cache.get(key)
+            if cached is not None:
+                content, content_type = cached
+                return HttpResponse(content, content_type=content_type)
+
+            response = view_func(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming:
+                cache.set(key, (response.content, response['Content-Type']), _timeout())
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,131 @@
+# reviews/pagination.py
+"""
+キーセット（カーソル）方式のページネーション。
+
+OFFSETを使わず「前のページの最後の (created_at, id) より古いもの」を取得するので、
+深いページでも先頭から読み飛ばすスキャンが発生しない。
+カーソルは最後の行の (created_at, id) をURLセーフなBase64にした文字列。
+ユーザー名順のように一意な列で並べる一覧には paginate_by_field() を使う。
+"""
+import base64
+import binascii
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+# カーソルに入れられるIDの上限（BigAutoFieldの最大値）
+MAX_ID = 2 ** 63 - 1
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(created_at, pk):
+    raw = f'{created_at.isoformat()}|{pk}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """カーソルを (created_at, id) に戻す（不正な値ならNone）"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        created_at, pk = raw.split('|', 1)
+        created_at, pk = datetime.fromisoformat(created_at), int(pk)
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+    # encode_cursor() が作らない値（タイムゾーンのない日時・範囲外のID）は改ざんされたものとして扱う
+    if settings.USE_TZ and timezone.is_naive(created_at):
+        return None
+    if not 0 < pk <= MAX_ID:
+        return None
+    return created_at, pk
+
+
+def get_page_size(request, default=DEFAULT_PAGE_SIZE):
+    """?page_size= を読み取り、1〜MAX_PAGE_SIZEの範囲に収める"""
+    try:
+        page_size = int(request.GET.get('page_size', default))
+    except (TypeError, ValueError):
+        page_size = default
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def paginate_by_keyset(queryset, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    querysetを (created_at, id) の新しい順に並べて1ページ分を返す。
+    不正なカーソルは先頭ページとして扱う。
+    .values() のquerysetも渡せる（その場合は created_at と id を取得する列に含めること）。
+    """
+    queryset = queryset.order_by('-created_at', '-id')
+    position = decode_cursor(cursor)
+    if position is not None:
+        created_at, pk = position
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    # 1件多く取得して、次のページがあるかを判定する
+    rows = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        if isinstance(last, dict):
+            next_cursor = encode_cursor(last['created_at'], last['id'])
+        else:
+            next_cursor = encode_cursor(last.created_at, last.pk)
+    return KeysetPage(rows, next_cursor)
+
+
+def encode_value_cursor(value):
+    return base64.urlsafe_b64encode(str(value).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_value_cursor(cursor):
+    """カーソルを列の値（文字列）に戻す（不正な値ならNone）"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+    # NUL文字は文字列の列と比較できないDBがある
+    return None if '\x00' in value else value
+
+
+def paginate_by_field(queryset, field, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    一意な文字列の列 field の昇順で1ページ分を返す（ユーザー名順の一覧など）。
+    カーソルは前のページの最後の行の値。.values() のquerysetなら field を取得する列に含めること。
+    """
+    queryset = queryset.order_by(field)
+    position = decode_value_cursor(cursor)
+    if position is not None:
+        queryset = queryset.filter(**{f'{field}__gt': position})
+
+    rows = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = encode_value_cursor(last[field] if isinstance(last, dict) else getattr(last, field))
+    return KeysetPage(rows, next_cursor)
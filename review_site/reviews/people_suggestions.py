@@ -0,0 +1,346 @@
+# reviews/people_suggestions.py
+"""
+「知り合いかも」（友達の友達）の推薦。
+
+Followテーブルとレビューした店舗を整数の配列（CSR形式: 行iの列は indices[indptr[i]:indptr[i + 1]]）にして
+NumPyで持ち、フォローしている人がフォローしている人（2ホップ先）を次の重みで採点する。
+
+- 共通のフォロー: 自分がフォローしている人のうち、その人をフォローしている人の数
+- フォローバック: その人が自分をフォローしている
+- 共通の店舗: 2人ともレビューした店舗の数
+
+全ユーザーの上位 TOP_K 件は manage.py build_people_suggestions でまとめて計算し、
+settings.RECOMMENDATION_ROOT に保存する。各プロセスは最初に使うときに読み込み（ファイルが更新されたら読み直す）、
+1人分の推薦は配列のスライスで返すのでDBにもアクセスしない。
+
+フォロー・フォロー解除したときは apply_follow_change() で両者の分だけ計算し直し、キャッシュに上書きしておく
+（次の全体の再構築までの差分。DBは読まない）。
+"""
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from .models import Follow, Review
+
+INDEX_FILENAME = 'people_suggestions.npz'
+OVERRIDE_KEY = 'people_suggestions:{build_id}:{user_id}'
+
+# ユーザーごとに保存する推薦の件数
+TOP_K = 20
+
+MUTUAL_WEIGHT = 1.0
+FOLLOWS_YOU_WEIGHT = 2.0
+SHARED_STORE_WEIGHT = 0.5
+
+_EMPTY = np.zeros(0, dtype=np.int32)
+
+
+class CSR:
+    """行ごとの隣接リスト（各行の列は昇順）"""
+
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def from_pairs(cls, rows, cols, n_rows):
+        order = np.lexsort((cols, rows))
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+        return cls(indptr, cols[order].astype(np.int32))
+
+    def row(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def gather(self, rows):
+        """複数の行の列をつなげて返す（各要素がrowsの何番目の行から来たかのラベルも返す）"""
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return _EMPTY, np.zeros(0, dtype=np.int64)
+        labels = np.repeat(np.arange(len(rows)), lengths)
+        offsets = np.arange(total) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return self.indices[offsets], labels
+
+
+class SocialGraph:
+    """ユーザーIDを添字（0..n-1）に置き換えたフォロー関係とレビューした店舗"""
+
+    def __init__(self, user_ids, following, followers, reviewed, n_stores):
+        self.user_ids = user_ids
+        self.following = following
+        self.followers = followers
+        self.reviewed = reviewed
+        self.n_stores = n_stores
+
+    @classmethod
+    def from_database(cls):
+        user_ids = np.fromiter(User.objects.order_by('id').values_list('id', flat=True), dtype=np.int64)
+        n = len(user_ids)
+
+        pairs = np.array(list(Follow.objects.values_list('follower_id', 'following_id')), dtype=np.int64).reshape(-1, 2)
+        follower, following = cls._to_index(user_ids, pairs[:, 0]), cls._to_index(user_ids, pairs[:, 1])
+        known = (follower >= 0) & (following >= 0)
+        follower, following = follower[known], following[known]
+
+        reviews = np.array(
+            list(Review.objects.order_by().values_list('user_id', 'store_id').distinct()), dtype=np.int64,
+        ).reshape(-1, 2)
+        reviewer = cls._to_index(user_ids, reviews[:, 0])
+        store_ids, store_index = np.unique(reviews[:, 1], return_inverse=True)
+        known = reviewer >= 0
+
+        return cls(
+            user_ids,
+            CSR.from_pairs(follower, following, n),
+            CSR.from_pairs(following, follower, n),
+            CSR.from_pairs(reviewer[known], store_index[known], n),
+            len(store_ids),
+        )
+
+    @staticmethod
+    def _to_index(user_ids, ids):
+        """IDを添字にする（見つからないIDは-1）"""
+        index = np.searchsorted(user_ids, ids)
+        index[index >= len(user_ids)] = 0
+        return np.where(user_ids[index] == ids, index, -1) if len(user_ids) else np.full(len(ids), -1)
+
+    def index_of(self, user_id):
+        i = int(np.searchsorted(self.user_ids, user_id))
+        if i < len(self.user_ids) and self.user_ids[i] == user_id:
+            return i
+        return None
+
+    def indexes_of(self, user_ids):
+        index = self._to_index(self.user_ids, np.asarray(list(user_ids), dtype=np.int64))
+        return np.unique(index[index >= 0]).astype(np.int32)
+
+    def score(self, u, following=None, followers=None, store_mask=None, top_k=TOP_K):
+        """
+        ユーザー（添字u。グラフにいない新しいユーザーならNone）の候補を採点し、
+        スコアの高い順に (添字, スコア, 共通のフォロー数, 共通の店舗数) の配列を返す。
+        following / followers（添字の配列）を渡すと、グラフの行の代わりに使う。
+        """
+        if following is None:
+            following = self.following.row(u)
+        if followers is None:
+            followers = self.followers.row(u)
+
+        two_hop, _ = self.following.gather(following)
+        reached, mutual = np.unique(two_hop, return_counts=True)
+
+        # 自分とフォロー済みの人は除き、フォローしてくれている人は候補に加える
+        candidates = np.union1d(reached, followers)
+        keep = ~np.isin(candidates, following)
+        if u is not None:
+            keep &= candidates != u
+        candidates = candidates[keep]
+        if not len(candidates):
+            return _EMPTY, np.zeros(0, dtype=np.float32), _EMPTY, _EMPTY
+
+        mutual_counts = np.zeros(len(candidates), dtype=np.int32)
+        reached_kept = np.isin(reached, candidates)
+        mutual_counts[np.searchsorted(candidates, reached[reached_kept])] = mutual[reached_kept]
+        follows_you = np.isin(candidates, followers)
+
+        shared = np.zeros(len(candidates), dtype=np.int32)
+        my_stores = self.reviewed.row(u) if u is not None else _EMPTY
+        if len(my_stores):
+            mask = store_mask if store_mask is not None else np.zeros(self.n_stores, dtype=bool)
+            mask[my_stores] = True
+            their_stores, labels = self.reviewed.gather(candidates)
+            shared = np.bincount(labels, weights=mask[their_stores], minlength=len(candidates)).astype(np.int32)
+            mask[my_stores] = False
+
+        scores = (MUTUAL_WEIGHT * mutual_counts + FOLLOWS_YOU_WEIGHT * follows_you
+                  + SHARED_STORE_WEIGHT * shared).astype(np.float32)
+        if len(candidates) > top_k:
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            top = np.arange(len(candidates))
+        # スコアの高い順、同点ならIDの小さい順
+        top = top[np.lexsort((candidates[top], -scores[top]))]
+        return candidates[top].astype(np.int32), scores[top], mutual_counts[top], shared[top]
+
+
+class Suggestion:
+    def __init__(self, user_id, score, mutual_count, shared_store_count):
+        self.user_id = user_id
+        self.score = score
+        self.mutual_count = mutual_count
+        self.shared_store_count = shared_store_count
+
+
+class SuggestionIndex:
+    """全ユーザーの推薦（CSR形式）と、差分の再計算に使うグラフ"""
+
+    def __init__(self, graph, indptr, users, scores, mutual, shared, build_id):
+        self.graph = graph
+        self.indptr = indptr
+        self.users = users
+        self.scores = scores
+        self.mutual = mutual
+        self.shared = shared
+        self.build_id = build_id
+
+    @classmethod
+    def build(cls, graph, batch_size=1000, top_k=TOP_K, progress=None):
+        """全ユーザー分を計算する（batch_size人ごとに配列をまとめ、progress(済んだ人数, 全体) を呼ぶ）"""
+        n = len(graph.user_ids)
+        store_mask = np.zeros(graph.n_stores, dtype=bool)
+        counts = np.zeros(n, dtype=np.int64)
+        parts = []
+        for start in range(0, n, batch_size):
+            batch = [graph.score(u, store_mask=store_mask, top_k=top_k) for u in range(start, min(start + batch_size, n))]
+            for offset, result in enumerate(batch):
+                counts[start + offset] = len(result[0])
+            parts.extend(batch)
+            if progress is not None:
+                progress(min(start + batch_size, n), n)
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        columns = [np.concatenate([part[i] for part in parts]) if parts else np.zeros(0) for i in range(4)]
+        return cls(
+            graph, indptr,
+            columns[0].astype(np.int32), columns[1].astype(np.float32),
+            columns[2].astype(np.int32), columns[3].astype(np.int32),
+            build_id=str(time.time_ns()),
+        )
+
+    def save(self, path):
+        """一時ファイルに書いてから置き換える（読み込み中のプロセスが壊れたファイルを読まないように）"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        graph = self.graph
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(
+                    f,
+                    user_ids=graph.user_ids,
+                    following_indptr=graph.following.indptr, following_indices=graph.following.indices,
+                    followers_indptr=graph.followers.indptr, followers_indices=graph.followers.indices,
+                    reviewed_indptr=graph.reviewed.indptr, reviewed_indices=graph.reviewed.indices,
+                    n_stores=np.int64(graph.n_stores),
+                    indptr=self.indptr, users=self.users, scores=self.scores, mutual=self.mutual, shared=self.shared,
+                    build_id=np.array(self.build_id),
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            graph = SocialGraph(
+                data['user_ids'],
+                CSR(data['following_indptr'], data['following_indices']),
+                CSR(data['followers_indptr'], data['followers_indices']),
+                CSR(data['reviewed_indptr'], data['reviewed_indices']),
+                int(data['n_stores']),
+            )
+            return cls(graph, data['indptr'], data['users'], data['scores'], data['mutual'], data['shared'],
+                       build_id=str(data['build_id']))
+
+    def suggestions_for(self, user_id, limit):
+        u = self.graph.index_of(user_id)
+        if u is None:
+            return []
+        start, end = self.indptr[u], min(self.indptr[u + 1], self.indptr[u] + limit)
+        user_ids = self.graph.user_ids[self.users[start:end]]
+        return [
+            Suggestion(int(uid), float(score), int(mutual), int(shared))
+            for uid, score, mutual, shared in zip(user_ids, self.scores[start:end],
+                                                  self.mutual[start:end], self.shared[start:end])
+        ]
+
+
+def index_path():
+    return Path(getattr(settings, 'RECOMMENDATION_ROOT')) / INDEX_FILENAME
+
+
+_lock = threading.Lock()
+_loaded = None
+
+
+def get_index():
+    """保存済みの推薦を返す（まだ作られていなければNone）。ファイルが置き換えられたら読み直す"""
+    global _loaded
+    path = index_path()
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _loaded is None or _loaded[0] != (path, mtime):
+        with _lock:
+            if _loaded is None or _loaded[0] != (path, mtime):
+                _loaded = ((path, mtime), SuggestionIndex.load(path))
+    return _loaded[1]
+
+
+def rebuild(batch_size=1000, top_k=TOP_K, progress=None):
+    """DBから全体を計算し直して保存する"""
+    index = SuggestionIndex.build(SocialGraph.from_database(), batch_size=batch_size, top_k=top_k, progress=progress)
+    index.save(index_path())
+    return index
+
+
+def _override_key(index, user_id):
+    return OVERRIDE_KEY.format(build_id=index.build_id, user_id=user_id)
+
+
+def suggestions_for(user_id, limit=5):
+    """ユーザーへの推薦（フォローの変更で計算し直した分があればそちらを使う）"""
+    index = get_index()
+    if index is None:
+        return []
+    override = cache.get(_override_key(index, user_id))
+    if override is not None:
+        return [Suggestion(*row) for row in override['suggestions'][:limit]]
+    return index.suggestions_for(user_id, limit)
+
+
+def apply_follow_change(follower_id, following_id, followed):
+    """
+    フォロー・フォロー解除を、両者の推薦に反映する（フォローした側はフォロー先、された側はフォロワーが変わる）。
+    フォロー関係はキャッシュにある差分（なければ保存済みのグラフ）に今回の変更を加えて使う。
+    """
+    index = get_index()
+    if index is None:
+        return
+    graph = index.graph
+    timeout = getattr(settings, 'PEOPLE_SUGGESTIONS_OVERRIDE_TIMEOUT', 60 * 60 * 24)
+    for user_id, field, other_id in ((follower_id, 'following', following_id), (following_id, 'followers', follower_id)):
+        key = _override_key(index, user_id)
+        u = graph.index_of(user_id)
+        state = cache.get(key)
+        if state is None:
+            state = {
+                'following': [int(i) for i in graph.user_ids[graph.following.row(u)]] if u is not None else [],
+                'followers': [int(i) for i in graph.user_ids[graph.followers.row(u)]] if u is not None else [],
+            }
+        ids = set(state[field])
+        if followed:
+            ids.add(other_id)
+        else:
+            ids.discard(other_id)
+        state[field] = sorted(ids)
+
+        candidates, scores, mutual, shared = graph.score(
+            u, following=graph.indexes_of(state['following']), followers=graph.indexes_of(state['followers']),
+        )
+        state['suggestions'] = [
+            (int(uid), float(score), int(m), int(s))
+            for uid, score, m, s in zip(graph.user_ids[candidates], scores, mutual, shared)
+        ]
+        cache.set(key, state, timeout)
@@ -0,0 +1,92 @@
+# reviews/pubsub.py
+"""
+サーバー内のPub/Sub。
+
+SSEの接続（asyncioのイベントループ上）がチャンネルを購読し、
+通常のビュー（同期スレッド）から publish() でメッセージを送る。
+InProcessBroker は同じプロセス内の購読者にしか届かないので、
+複数プロセスで動かす場合は settings.PUBSUB_BACKEND で共有バックエンド（Redisなど）に差し替える。
+"""
+import asyncio
+import threading
+from collections import defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class Subscription:
+    def __init__(self, broker, channel, loop, maxsize):
+        self.broker = broker
+        self.channel = channel
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def deliver(self, message):
+        """どのスレッドからでも呼べる（イベントループ上でキューに入れる）"""
+        def put():
+            if self.queue.full():
+                # 読むのが遅いクライアントは古いメッセージを捨てて最新を優先する
+                self.queue.get_nowait()
+            self.queue.put_nowait(message)
+        try:
+            self.loop.call_soon_threadsafe(put)
+        except RuntimeError:
+            # イベントループが既に閉じている
+            self.close()
+
+    async def get(self, timeout=None):
+        """次のメッセージを待つ（timeout秒で届かなければNone）"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class InProcessBroker:
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, channel):
+        """イベントループ上から呼ぶ"""
+        subscription = Subscription(self, channel, asyncio.get_running_loop(), self.maxsize)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.deliver(message)
+        return len(subscriptions)
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    backend = getattr(settings, 'PUBSUB_BACKEND', 'reviews.pubsub.InProcessBroker')
+    return import_string(backend)()
+
+
+def publish(channel, message):
+    return get_broker().publish(channel, message)
@@ -0,0 +1,147 @@
+# reviews/search.py
+"""
+店舗検索のバックエンド。
+
+検索対象（店名・住所・コメント・タグ名）は Store.search_document にまとめて保存し、
+DBごとに次のインデックスで検索する。
+
+- SQLite（ローカル開発）: FTS5の仮想テーブル reviews_store_fts
+  日本語は単語の区切りがないため、文字のバイグラム（2-gram）に分割して登録し、
+  検索語もバイグラムのフレーズにして候補を絞り、search_document の部分一致で確かめる
+  （語の区切りをまたいだバイグラムのフレーズが、元の文字列にない検索語に一致することがあるため）。
+- PostgreSQL（本番）: search_document に pg_trgm のGINインデックスを張り、LIKEで検索する。
+
+店舗の作成・編集・削除やタグの変更時は update_search_index() / remove_from_search_index() を呼ぶ。
+"""
+import re
+import unicodedata
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+FTS_TABLE = 'reviews_store_fts'
+
+# 英数字・かな・漢字以外（記号や空白）で区切る
+_SEPARATOR_RE = re.compile(r'[^\w]+')
+
+
+def normalize(text):
+    """全角英数字などをそろえて小文字にする"""
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def build_search_document(store, tag_names=None):
+    """店舗の検索対象テキストを作る"""
+    if tag_names is None:
+        tag_names = [tag.name for tag in store.tags.all()]
+    parts = [store.name, store.address, store.comment or ''] + list(tag_names)
+    return normalize(' '.join(part for part in parts if part))
+
+
+def ngram_tokens(text, n=2):
+    """テキストを記号や空白で区切り、それぞれをn-gramに分割する（n文字未満の語はそのまま）"""
+    tokens = []
+    for segment in _SEPARATOR_RE.split(normalize(text)):
+        if not segment:
+            continue
+        if len(segment) <= n:
+            tokens.append(segment)
+            continue
+        tokens.extend(segment[i:i + n] for i in range(len(segment) - n + 1))
+    return tokens
+
+
+class BaseSearchBackend:
+    def filter(self, queryset, query):
+        """querysetを検索語で絞り込む"""
+        raise NotImplementedError
+
+    def index(self, store):
+        """店舗をインデックスに登録・更新する（search_documentは保存済みであること）"""
+
+    def remove(self, store_id):
+        """店舗をインデックスから削除する"""
+
+    def rebuild(self, stores):
+        """インデックスを作り直す"""
+        for store in stores:
+            self.index(store)
+
+
+class IContainsSearchBackend(BaseSearchBackend):
+    """専用インデックスを使わないフォールバック（search_documentの部分一致）"""
+
+    def filter(self, queryset, query):
+        return queryset.filter(search_document__contains=normalize(query))
+
+
+class SQLiteFTS5SearchBackend(BaseSearchBackend):
+    """SQLiteのFTS5仮想テーブルにバイグラムを登録して検索する"""
+
+    def filter(self, queryset, query):
+        tokens = ngram_tokens(query)
+        # 1文字の検索語はバイグラムにならないので部分一致で探す
+        if not tokens or any(len(token) < 2 for token in tokens):
+            return IContainsSearchBackend().filter(queryset, query)
+        match = ' AND '.join(
+            '"{}"'.format(' '.join(ngram_tokens(segment)))
+            for segment in _SEPARATOR_RE.split(normalize(query)) if segment
+        )
+        candidates = queryset.filter(id__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [match]))
+        # 「ab bc」は「ab」「bc」と登録されるので「abc」のフレーズにも一致してしまう。部分一致で確かめる
+        return IContainsSearchBackend().filter(candidates, query)
+
+    def index(self, store):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [store.id])
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, document) VALUES (%s, %s)',
+                [store.id, ' '.join(ngram_tokens(store.search_document))],
+            )
+
+    def remove(self, store_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [store_id])
+
+    def rebuild(self, stores):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        super().rebuild(stores)
+
+
+class PostgresTrigramSearchBackend(BaseSearchBackend):
+    """
+    pg_trgmのGINインデックス（reviews_store_search_trgm）を使って部分一致検索する。
+    search_documentは保存時に更新されるので、インデックスの更新はPostgreSQLに任せる。
+    """
+
+    def filter(self, queryset, query):
+        return queryset.filter(search_document__contains=normalize(query))
+
+
+_DEFAULT_BACKENDS = {
+    'sqlite': 'reviews.search.SQLiteFTS5SearchBackend',
+    'postgresql': 'reviews.search.PostgresTrigramSearchBackend',
+}
+
+
+@lru_cache(maxsize=None)
+def get_search_backend():
+    """settings.SEARCH_BACKENDか、DBの種類に合ったバックエンドを返す"""
+    backend = getattr(settings, 'SEARCH_BACKEND', None) or _DEFAULT_BACKENDS.get(
+        connection.vendor, 'reviews.search.IContainsSearchBackend')
+    return import_string(backend)()
+
+
+def update_search_index(store):
+    """店舗の検索対象テキストを作り直してインデックスに反映する"""
+    store.search_document = build_search_document(store)
+    type(store).objects.filter(id=store.id).update(search_document=store.search_document)
+    get_search_backend().index(store)
+
+
+def remove_from_search_index(store_id):
+    get_search_backend().remove(store_id)
@@ -0,0 +1,156 @@
+# reviews/sql_instrumentation.py
+"""
+リクエストごとのSQL計測。
+
+SQLInstrumentationMiddleware がリクエストの間だけDB接続に execute_wrapper を差し込み、
+クエリ数・SQLの合計時間・同じ形のクエリ（フィンガープリント）の重複を数える。
+結果はDEBUGレベルのJSON形式のログ（reviews.sql）に出し、settings.SQL_SERVER_TIMING が True（開発時）なら
+Server-Timing ヘッダー（ブラウザの開発者ツールで見られる）にも出す。ヘッダーは誰にでも見えるので本番では出さない。
+同じフィンガープリントが何度も出ていれば、ループの中でクエリを発行している（N+1）可能性が高い。
+
+ビューには @query_budget(n) でクエリ数の上限を宣言できる。
+上限を超えた場合、settings.QUERY_BUDGET_RAISE が True（テスト時）なら QueryBudgetExceeded を送出し、
+それ以外（本番）は警告をログに出すだけにする。
+"""
+import json
+import logging
+import re
+import time
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger('reviews.sql')
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def fingerprint(sql):
+    """値やINリストの長さを取り除き、同じ形のクエリが同じ文字列になるようにする"""
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = _IN_LIST_RE.sub('(...)', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+
+def query_budget(max_queries):
+    """ビューのクエリ数の上限を宣言するデコレータ（セッション・ユーザーの読み込みも含めた数）"""
+    def decorator(view_func):
+        view_func.query_budget = max_queries
+        return view_func
+    return decorator
+
+
+class QueryStats:
+    """connection.execute_wrappers に入れてクエリを数える"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.total_time += time.perf_counter() - started
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def duplicates(self, limit=5):
+        return [(sql, count) for sql, count in self.fingerprints.most_common(limit) if count > 1]
+
+
+def _install(stats):
+    connection.execute_wrappers.append(stats)
+
+
+def _uninstall(stats):
+    if stats in connection.execute_wrappers:
+        connection.execute_wrappers.remove(stats)
+
+
+class SQLInstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'SQL_INSTRUMENTATION', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        stats = QueryStats()
+        started = time.perf_counter()
+        _install(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            _uninstall(stats)
+        return self._report(request, response, stats, started)
+
+    async def __acall__(self, request):
+        # ASGIでは同期ビューのDBアクセスはリクエストごとのスレッドで行われるので、そのスレッドの接続に差し込む
+        stats = QueryStats()
+        started = time.perf_counter()
+        await sync_to_async(_install)(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(_uninstall)(stats)
+        return self._report(request, response, stats, started)
+
+    def _report(self, request, response, stats, started):
+        total_time = time.perf_counter() - started
+        duplicates = stats.duplicates()
+        match = getattr(request, 'resolver_match', None)
+        view_func = match.func if match else None
+        view_name = match.view_name if match else None
+
+        if getattr(settings, 'SQL_SERVER_TIMING', False):
+            timings = [
+                f'db;desc="{stats.count} queries";dur={stats.total_time * 1000:.2f}',
+                f'app;dur={total_time * 1000:.2f}',
+            ]
+            if duplicates:
+                timings.append(f'dup;desc="{sum(count for _, count in duplicates)} duplicated"')
+            response['Server-Timing'] = ', '.join(timings)
+
+        # リクエストごとの行はDEBUGレベル（SQL_LOG_LEVEL=DEBUG のときだけJSONを組み立てて出す）
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'view': view_name,
+                'status': response.status_code,
+                'queries': stats.count,
+                'sql_ms': round(stats.total_time * 1000, 2),
+                'total_ms': round(total_time * 1000, 2),
+                'duplicates': [{'sql': sql, 'count': count} for sql, count in duplicates],
+            }, ensure_ascii=False))
+
+        budget = getattr(view_func, 'query_budget', None)
+        if budget is not None and stats.count > budget:
+            message = f'{view_name}: クエリ数 {stats.count} が上限 {budget} を超えました ({request.method} {request.path})'
+            if getattr(settings, 'QUERY_BUDGET_RAISE', False):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message, extra={'duplicates': duplicates})
+        return response
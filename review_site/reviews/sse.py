@@ -0,0 +1,33 @@
+# reviews/sse.py
+"""
+Server-Sent Events（SSE）のレスポンス。
+
+SSEは接続を保持し続けるので、ASGIで動いているときだけ送る。
+WSGIでは終わらない非同期ジェネレータを async_to_sync で読み続けることになり、
+接続ごとにワーカー（スレッド）を占有してしまう。その場合は 204 を返して
+ブラウザの EventSource に再接続をやめさせ、ページ側はポーリングで更新する。
+"""
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
+
+
+def can_stream(request):
+    """接続を保持したまま送れるか（ASGIで動いているときだけ）"""
+    return isinstance(request, ASGIRequest)
+
+
+def stream_unavailable():
+    """SSEを使えないときのレスポンス（204を受け取ったEventSourceは再接続しない）"""
+    return HttpResponse(status=204)
+
+
+def event_stream_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def sse_context(request):
+    """テンプレートでEventSourceを使うか（使えなければポーリングする）"""
+    return {'sse_enabled': can_stream(request)}
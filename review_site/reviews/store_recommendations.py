@@ -0,0 +1,414 @@
+# reviews/store_recommendations.py
+"""
+「このお店が好きな人はこんなお店も」（アイテム間の協調フィルタリング）。
+
+レビューの評価から ユーザー×店舗 の疎行列を作り、各ユーザーの平均評価を引いた値で
+店舗同士の調整コサイン類似度を求める。類似度は店舗をまとめて（BATCH_SIZE件ずつ）NumPyで計算し、
+店舗ごとに上位 TOP_K 件だけを settings.RECOMMENDATION_ROOT/store_similarity/<build_id>/ に .npy で保存する。
+CURRENT ファイルが使う build_id を指し、各プロセスは最初に使うときにメモリマップで読み込む（更新されたら読み直す）。
+
+- 全体の再構築: manage.py build_store_recommendations
+- レビューが投稿されたら、その店舗の類似店舗と、相手側の店舗の一覧をバックグラウンドで計算し直し、
+  キャッシュに上書きしておく（次の全体の再構築までの差分）
+- リクエストでは保存済みの上位の一覧を読むだけ（表示する店舗の行もキャッシュする）
+"""
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Avg
+from django.urls import reverse
+
+from .models import Review, Store
+from .page_cache import bump_store_version, get_store_version
+from .people_suggestions import CSR
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIRNAME = 'store_similarity'
+CURRENT_FILENAME = 'CURRENT'
+# 読み込み中のプロセスがあるかもしれないので、古い版もいくつか残しておく
+KEEP_BUILDS = 2
+
+# 店舗ごとに保存する類似店舗の件数
+TOP_K = 20
+# 一度に類似度を計算する店舗数の目安（BATCH_SIZE × 店舗数 の行列を作る）
+BATCH_SIZE = 256
+# おすすめに使うユーザーの最近のレビュー数
+USER_HISTORY = 50
+# おすすめの重みは (評価 - NEUTRAL_RATING)。「まあまあ」より低い店に似た店は下げる
+NEUTRAL_RATING = 3
+
+OVERRIDE_KEY = 'store_recommendations:{build_id}:neighbors:{store_id}'
+SIMILAR_ROWS_KEY = 'store_recommendations:{build_id}:similar:{store_id}:{version}'
+USER_ROWS_KEY = 'store_recommendations:{build_id}:user:{user_id}'
+
+
+class RatingMatrix:
+    """ユーザー×店舗 の評価（ユーザーの平均を引いた値）を、店舗ごと（CSC）とユーザーごと（CSR）の両方で持つ"""
+
+    def __init__(self, store_ids, by_store, by_user, values_by_store, values_by_user):
+        self.store_ids = store_ids
+        self.by_store = by_store
+        self.by_user = by_user
+        self.values_by_store = values_by_store
+        self.values_by_user = values_by_user
+
+    @classmethod
+    def from_rows(cls, user_ids, store_ids, ratings):
+        users, user_index = np.unique(user_ids, return_inverse=True)
+        stores, store_index = np.unique(store_ids, return_inverse=True)
+        values = _center(user_index, ratings, len(users))
+
+        # CSR.from_pairs と同じ並び順で値も並べ替える
+        by_store = CSR.from_pairs(store_index, user_index, len(stores))
+        by_user = CSR.from_pairs(user_index, store_index, len(users))
+        return cls(
+            stores, by_store, by_user,
+            values[np.lexsort((user_index, store_index))],
+            values[np.lexsort((store_index, user_index))],
+        )
+
+    @classmethod
+    def from_database(cls):
+        # 同じ店を何度もレビューした場合は平均する
+        rows = np.array(
+            list(Review.objects.order_by().values('user_id', 'store_id').annotate(rating=Avg('rating'))
+                 .values_list('user_id', 'store_id', 'rating')),
+            dtype=np.float64,
+        ).reshape(-1, 3)
+        return cls.from_rows(rows[:, 0].astype(np.int64), rows[:, 1].astype(np.int64), rows[:, 2])
+
+    def norms(self):
+        n = len(self.store_ids)
+        rows = np.repeat(np.arange(n), np.diff(self.by_store.indptr))
+        return np.sqrt(np.bincount(rows, weights=self.values_by_store ** 2, minlength=n)).astype(np.float32)
+
+    def similarities(self, start, end, norms):
+        """店舗 start..end-1 と全店舗の類似度（(end - start) × 店舗数 の行列）"""
+        n = len(self.store_ids)
+        block = np.arange(start, end)
+        # ブロック内の店舗を評価したユーザーと値
+        users, labels = self.by_store.gather(block)
+        values = self.values_by_store[_segment_offsets(self.by_store, block)]
+        # そのユーザーが評価したすべての店舗と値
+        stores, pair = self.by_user.gather(users)
+        products = values[pair] * self.values_by_user[_segment_offsets(self.by_user, users)]
+        dots = np.bincount(labels[pair] * n + stores, weights=products, minlength=len(block) * n).reshape(len(block), n)
+
+        denominator = np.outer(norms[block], norms)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sims = np.where(denominator > 0, dots / denominator, 0).astype(np.float32)
+        sims[np.arange(len(block)), block] = 0
+        return sims
+
+
+def _center(user_index, ratings, n_users):
+    """評価から各ユーザーの平均評価を引く（調整コサイン）"""
+    counts = np.bincount(user_index, minlength=n_users)
+    means = np.bincount(user_index, weights=ratings, minlength=n_users) / np.maximum(counts, 1)
+    return (ratings - means[user_index]).astype(np.float32)
+
+
+def _segment_offsets(csr, rows):
+    """csr.gather(rows) で返した各要素の indices 上の位置"""
+    starts = csr.indptr[rows]
+    lengths = csr.indptr[rows + 1] - starts
+    return np.arange(int(lengths.sum())) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
+
+def _top_k(sims, top_k):
+    """行ごとに類似度の高い上位 top_k 件（正の類似度のみ。足りない分は -1）"""
+    k = min(top_k, sims.shape[1])
+    neighbors = np.full((sims.shape[0], top_k), -1, dtype=np.int32)
+    scores = np.zeros((sims.shape[0], top_k), dtype=np.float32)
+    if k == 0:
+        return neighbors, scores
+    top = np.argpartition(-sims, k - 1, axis=1)[:, :k] if sims.shape[1] > k else np.tile(np.arange(k), (len(sims), 1))
+    top_sims = np.take_along_axis(sims, top, axis=1)
+    order = np.argsort(-top_sims, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1)
+    top_sims = np.take_along_axis(top_sims, order, axis=1)
+    positive = top_sims > 0
+    neighbors[:, :k] = np.where(positive, top, -1)
+    scores[:, :k] = np.where(positive, top_sims, 0)
+    return neighbors, scores
+
+
+class SimilarityIndex:
+    """店舗ごとの類似店舗（neighbors: 店舗の添字、similarities: 類似度）。各行は類似度の高い順"""
+
+    FILES = ('store_ids', 'neighbors', 'similarities', 'norms')
+
+    def __init__(self, store_ids, neighbors, similarities, norms, build_id):
+        self.store_ids = store_ids
+        self.neighbors = neighbors
+        self.similarities = similarities
+        self.norms = norms
+        self.build_id = build_id
+
+    @classmethod
+    def build(cls, matrix, top_k=TOP_K, batch_size=BATCH_SIZE, progress=None):
+        n = len(matrix.store_ids)
+        norms = matrix.norms()
+        neighbors = np.full((n, top_k), -1, dtype=np.int32)
+        similarities = np.zeros((n, top_k), dtype=np.float32)
+        for start in range(0, n, batch_size):
+            end = min(start + batch_size, n)
+            neighbors[start:end], similarities[start:end] = _top_k(matrix.similarities(start, end, norms), top_k)
+            if progress is not None:
+                progress(end, n)
+        return cls(matrix.store_ids, neighbors, similarities, norms, build_id=str(time.time_ns()))
+
+    def save(self, root):
+        """build_id のディレクトリに書いてから CURRENT を置き換える"""
+        root = Path(root)
+        directory = root / self.build_id
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in self.FILES:
+            np.save(directory / f'{name}.npy', getattr(self, name))
+        tmp_path = root / f'{CURRENT_FILENAME}.{self.build_id}'
+        tmp_path.write_text(self.build_id)
+        os.replace(tmp_path, root / CURRENT_FILENAME)
+
+        builds = sorted((path for path in root.iterdir() if path.is_dir()), key=lambda path: path.name)
+        for old in builds[:-KEEP_BUILDS]:
+            shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, root, build_id):
+        directory = Path(root) / build_id
+        arrays = {name: np.load(directory / f'{name}.npy', mmap_mode='r') for name in cls.FILES}
+        return cls(build_id=build_id, **arrays)
+
+    def position(self, store_id):
+        i = int(np.searchsorted(self.store_ids, store_id))
+        if i < len(self.store_ids) and self.store_ids[i] == store_id:
+            return i
+        return None
+
+    def neighbors_of(self, store_id):
+        """保存済みの類似店舗の [(店舗ID, 類似度), ...]"""
+        i = self.position(store_id)
+        if i is None:
+            return []
+        row = self.neighbors[i]
+        valid = row >= 0
+        return list(zip(self.store_ids[row[valid]].tolist(), self.similarities[i][valid].tolist()))
+
+
+def index_root():
+    return Path(getattr(settings, 'RECOMMENDATION_ROOT')) / INDEX_DIRNAME
+
+
+_lock = threading.Lock()
+_loaded = None
+
+
+def get_index():
+    """保存済みの類似度を返す（まだ作られていなければNone）。CURRENT が置き換えられたら読み直す"""
+    global _loaded
+    root = index_root()
+    current = root / CURRENT_FILENAME
+    try:
+        mtime = os.stat(current).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _loaded is None or _loaded[0] != (root, mtime):
+        with _lock:
+            if _loaded is None or _loaded[0] != (root, mtime):
+                _loaded = ((root, mtime), SimilarityIndex.load(root, current.read_text().strip()))
+    return _loaded[1]
+
+
+def index_version():
+    """ページのキャッシュ・ETagに含める版（全体を再構築すると変わる）"""
+    index = get_index()
+    return index.build_id if index is not None else ''
+
+
+def rebuild(top_k=TOP_K, batch_size=BATCH_SIZE, progress=None):
+    """DBから全体を計算し直して保存する"""
+    index = SimilarityIndex.build(RatingMatrix.from_database(), top_k=top_k, batch_size=batch_size, progress=progress)
+    index.save(index_root())
+    return index
+
+
+def _neighbors_many(index, store_ids):
+    """{店舗ID: [(店舗ID, 類似度), ...]}（差分で計算し直した店舗はキャッシュの方を使う）"""
+    keys = {store_id: OVERRIDE_KEY.format(build_id=index.build_id, store_id=store_id) for store_id in store_ids}
+    overrides = cache.get_many(list(keys.values()))
+    return {
+        store_id: overrides[key] if key in overrides else index.neighbors_of(store_id)
+        for store_id, key in keys.items()
+    }
+
+
+def _store_rows(store_ids):
+    """表示に使う店舗の列（store_ids の順。削除された店舗は除く）"""
+    rows = {
+        row['id']: row
+        for row in Store.objects.filter(id__in=store_ids).values('id', 'name', 'image_key', 'rating_summary__rating_average')
+    }
+    return [
+        {
+            'id': row['id'],
+            'name': row['name'],
+            'image_url': reverse('blob_image', args=[row['image_key']]) if row['image_key'] else None,
+            'rating_average': round(row['rating_summary__rating_average'] or 0, 1),
+        }
+        for row in (rows.get(store_id) for store_id in store_ids) if row is not None
+    ]
+
+
+def _timeout():
+    return getattr(settings, 'STORE_PAGE_CACHE_TIMEOUT', 600)
+
+
+def similar_stores(store_id, limit=5):
+    """店舗に似た店舗（表示用の行。店舗のバージョンごとにキャッシュする）"""
+    index = get_index()
+    if index is None:
+        return []
+    key = SIMILAR_ROWS_KEY.format(build_id=index.build_id, store_id=store_id, version=get_store_version(store_id))
+    rows = cache.get(key)
+    if rows is None:
+        rows = _store_rows([neighbor_id for neighbor_id, _ in _neighbors_many(index, [store_id])[store_id]])
+        cache.set(key, rows, _timeout())
+    return rows[:limit]
+
+
+def recommended_stores(user_id, limit=5):
+    """
+    ユーザーへのおすすめ（表示用の行）。最近レビューした店舗の類似店舗を
+    (評価 - NEUTRAL_RATING) × 類似度 で足し合わせ、まだレビューしていない店舗を高い順に返す。
+    結果はユーザーがレビューを投稿するまでキャッシュする。
+    """
+    index = get_index()
+    if index is None:
+        return []
+    key = USER_ROWS_KEY.format(build_id=index.build_id, user_id=user_id)
+    rows = cache.get(key)
+    if rows is not None:
+        return rows[:limit]
+
+    # 同じ店を何度もレビューしていれば新しい評価を使う
+    history = dict(reversed(
+        Review.objects.filter(user_id=user_id).order_by('-created_at')
+        .values_list('store_id', 'rating')[:USER_HISTORY]
+    ))
+    scores = {}
+    for store_id, neighbors in _neighbors_many(index, list(history)).items():
+        weight = history[store_id] - NEUTRAL_RATING
+        if not weight:
+            continue
+        for neighbor_id, similarity in neighbors:
+            if neighbor_id not in history:
+                scores[neighbor_id] = scores.get(neighbor_id, 0) + weight * similarity
+    ranked = sorted((store_id for store_id, score in scores.items() if score > 0), key=lambda store_id: -scores[store_id])
+    # 削除された店舗の分だけ多めに読んで TOP_K 件をキャッシュする
+    rows = _store_rows(ranked[:TOP_K * 2])[:TOP_K] if ranked else []
+    cache.set(key, rows, _timeout())
+    return rows[:limit]
+
+
+def update_store(store_id, top_k=TOP_K):
+    """
+    店舗の類似店舗を、その店舗を評価したユーザーのレビューだけから計算し直す。
+    相手側の店舗の一覧でもこの店舗の類似度を置き換え、両方をキャッシュに上書きする。
+    相手側の店舗のノルムは保存済みの値を使う（保存後に増えた店舗は次の全体の再構築まで対象外）。
+    """
+    index = get_index()
+    if index is None:
+        return []
+    raters = Review.objects.filter(store_id=store_id).values('user_id')
+    rows = np.array(
+        list(Review.objects.filter(user_id__in=raters).order_by().values('user_id', 'store_id')
+             .annotate(rating=Avg('rating')).values_list('user_id', 'store_id', 'rating')),
+        dtype=np.float64,
+    ).reshape(-1, 3)
+    users, user_index = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+    stores = rows[:, 1].astype(np.int64)
+    values = _center(user_index, rows[:, 2], len(users))
+
+    # この店舗の (ユーザーごとの) 値と、それを掛けた全店舗の内積
+    own = stores == store_id
+    own_values = np.zeros(len(users), dtype=np.float32)
+    own_values[user_index[own]] = values[own]
+    norm = float(np.sqrt((own_values ** 2).sum()))
+    positions = np.searchsorted(index.store_ids, stores)
+    positions[positions >= len(index.store_ids)] = 0
+    known = (index.store_ids[positions] == stores) & ~own if len(index.store_ids) else np.zeros(len(stores), dtype=bool)
+    dots = np.bincount(positions[known], weights=own_values[user_index[known]] * values[known],
+                       minlength=len(index.store_ids))
+
+    denominator = norm * np.asarray(index.norms, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sims = np.where(denominator > 0, dots / denominator, 0).astype(np.float32)
+    neighbors, scores = _top_k(sims[np.newaxis, :], top_k)
+    valid = neighbors[0] >= 0
+    new_neighbors = list(zip(index.store_ids[neighbors[0][valid]].tolist(), scores[0][valid].tolist()))
+
+    # 相手側の店舗の一覧（以前この店舗が入っていた店舗も含む）でこの店舗の類似度を置き換える
+    similarity_of = dict(new_neighbors)
+    current = _neighbors_many(index, [store_id])[store_id]
+    affected = set(similarity_of) | {neighbor_id for neighbor_id, _ in current}
+    updates = {OVERRIDE_KEY.format(build_id=index.build_id, store_id=store_id): new_neighbors}
+    for other_id, others in _neighbors_many(index, affected).items():
+        merged = [(neighbor_id, sim) for neighbor_id, sim in others if neighbor_id != store_id]
+        if similarity_of.get(other_id, 0) > 0:
+            merged.append((store_id, similarity_of[other_id]))
+        merged.sort(key=lambda neighbor: -neighbor[1])
+        updates[OVERRIDE_KEY.format(build_id=index.build_id, store_id=other_id)] = merged[:top_k]
+    cache.set_many(updates, None)
+    bump_store_version(store_id, *affected)
+    return new_neighbors
+
+
+_executor_lock = threading.Lock()
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='store-recommendations')
+        return _executor
+
+
+def _update_in_background(store_id):
+    try:
+        update_store(store_id)
+    except Exception:
+        logger.exception('類似店舗の更新に失敗しました: store_id=%s', store_id)
+    finally:
+        # ワーカースレッドのDB接続は使い終わったら閉じる
+        connection.close()
+
+
+def record_review(review):
+    """
+    レビューの投稿をおすすめに反映する（コミット後に実行）。
+    投稿者のおすすめのキャッシュを消し、店舗の類似度の再計算をバックグラウンドで行う
+    （RECOMMENDATION_UPDATE_ASYNC が False ならその場で行う）。
+    """
+    def submit():
+        index = get_index()
+        if index is None:
+            return
+        cache.delete(USER_ROWS_KEY.format(build_id=index.build_id, user_id=review.user_id))
+        if getattr(settings, 'RECOMMENDATION_UPDATE_ASYNC', True):
+            _get_executor().submit(_update_in_background, review.store_id)
+        else:
+            update_store(review.store_id)
+
+    transaction.on_commit(submit)
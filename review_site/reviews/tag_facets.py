@@ -0,0 +1,129 @@
+# reviews/tag_facets.py
+"""
+タグによる店舗の絞り込みとファセット（タグごとの店舗数）。
+
+タグごとの店舗数は Tag.store_count に持ち、店舗へのタグの追加・削除のたびに差分だけ更新する。
+店一覧を表示するたびに中間テーブル（reviews_store_tags）を GROUP BY しないで済む。
+検索語で絞り込んでいる場合だけ、検索結果の店舗に限って数える（検索結果ごとに件数が違うため）。
+
+店舗のタグを変えるときは中間テーブルを直接触らず、ここの関数を使う（あわせて bump_store_version() も呼ぶ）。
+ずれた場合は manage.py rebuild_tag_counts で数え直せる。
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F
+
+from .models import Store, Tag
+from .page_cache import get_global_version
+
+MATCH_ALL = 'all'
+MATCH_ANY = 'any'
+
+StoreTag = Store.tags.through
+
+FACETS_KEY = 'store_pages:tag_facets:{version}'
+
+
+def parse_tag_ids(values):
+    """?tag= の値をタグIDのリストにする（数値でないものは無視する）"""
+    tag_ids = []
+    for value in values:
+        try:
+            tag_ids.append(int(value))
+        except (TypeError, ValueError):
+            continue
+    return list(dict.fromkeys(tag_ids))
+
+
+def filter_stores_by_tags(stores, tag_ids, match=MATCH_ALL):
+    """タグで店舗を絞り込む（MATCH_ALL: すべてのタグを持つ店舗、MATCH_ANY: いずれかのタグを持つ店舗）"""
+    if not tag_ids:
+        return stores
+    if match == MATCH_ANY:
+        return stores.filter(id__in=StoreTag.objects.filter(tag_id__in=tag_ids).values('store_id'))
+    for tag_id in tag_ids:
+        stores = stores.filter(id__in=StoreTag.objects.filter(tag_id=tag_id).values('store_id'))
+    return stores
+
+
+def _change_counts(tag_ids, delta):
+    if not tag_ids:
+        return
+    tags = Tag.objects.filter(id__in=tag_ids)
+    if delta < 0:
+        tags = tags.filter(store_count__gte=-delta)
+    tags.update(store_count=F('store_count') + delta)
+
+
+def add_store_tag(store, tag):
+    """店舗にタグを付け、新しく付いた場合だけ店舗数を1増やす（付いたらTrue）"""
+    with transaction.atomic():
+        _, created = StoreTag.objects.get_or_create(store_id=store.id, tag_id=tag.id)
+        if created:
+            _change_counts([tag.id], 1)
+    return created
+
+
+def remove_store_tag(store, tag):
+    """店舗からタグを外し、外れた場合だけ店舗数を1減らす（外れたらTrue）"""
+    with transaction.atomic():
+        deleted, _ = StoreTag.objects.filter(store_id=store.id, tag_id=tag.id).delete()
+        if deleted:
+            _change_counts([tag.id], -1)
+    return bool(deleted)
+
+
+def save_store_form_tags(form, store):
+    """StoreFormのタグを保存し（save_m2m）、増えたタグ・減ったタグの店舗数を更新する"""
+    with transaction.atomic():
+        before = set(StoreTag.objects.filter(store_id=store.id).values_list('tag_id', flat=True))
+        form.save_m2m()
+        after = {tag.id for tag in form.cleaned_data.get('tags') or []}
+        _change_counts(after - before, 1)
+        _change_counts(before - after, -1)
+
+
+def discard_store_tags(store_id):
+    """店舗を削除する前に、その店舗のタグの店舗数を1ずつ減らす（呼び出し側のトランザクション内で実行する）"""
+    _change_counts(list(StoreTag.objects.filter(store_id=store_id).values_list('tag_id', flat=True)), -1)
+
+
+def count_stores_by_tag(store_ids=None):
+    """中間テーブルを集計して {タグID: 店舗数} を返す（store_ids で対象の店舗を絞れる）"""
+    links = StoreTag.objects.all()
+    if store_ids is not None:
+        links = links.filter(store_id__in=store_ids)
+    return dict(links.order_by().values('tag_id').annotate(count=Count('id')).values_list('tag_id', 'count'))
+
+
+def tag_facets(stores=None):
+    """
+    サイドバーに出すタグと店舗数（店舗数の多い順）。各タグの facet_count に件数を入れる。
+    stores が None（検索していない）なら Tag.store_count を読むだけで集計はせず、
+    結果も店舗ページのバージョンごとにキャッシュする（タグの付け外しでバージョンが上がる）。
+    検索中は検索結果の店舗に付いたタグだけを1回のクエリで数える。
+    """
+    if stores is None:
+        key = FACETS_KEY.format(version=get_global_version())
+        rows = cache.get(key)
+        if rows is None:
+            rows = list(Tag.objects.filter(store_count__gt=0)
+                        .order_by('-store_count', 'name')
+                        .values_list('id', 'name', 'color', 'store_count'))
+            cache.set(key, rows, getattr(settings, 'STORE_PAGE_CACHE_TIMEOUT', 600))
+    else:
+        rows = sorted(
+            StoreTag.objects.filter(store_id__in=stores.order_by().values('id'))
+            .values('tag_id', 'tag__name', 'tag__color')
+            .annotate(count=Count('id'))
+            .values_list('tag_id', 'tag__name', 'tag__color', 'count'),
+            key=lambda row: (-row[3], row[1]),
+        )
+
+    tags = []
+    for tag_id, name, color, count in rows:
+        tag = Tag(id=tag_id, name=name, color=color)
+        tag.facet_count = count
+        tags.append(tag)
+    return tags
@@ -1,3 +1,1398 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from importlib import import_module
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache, caches
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Max, QuerySet
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, reverse
+from django.utils import timezone
+import numpy as np
+from PIL import Image
+
+from .blobstore import get_blob_store
+from .follow_graph import FollowGraph, invalidate_follow_graph
+from .forms import StoreForm, UserProfileForm
+from .direct_messages import MAX_MESSAGES_PER_FETCH
+from .image_processing import STORE_IMAGE_SIZE
+from .image_queue import (
+    IMAGE_STATUS_FAILED, IMAGE_STATUS_PROCESSING, IMAGE_STATUS_READY, enqueue_image, mark_processing,
+)
+from . import api, urls as review_urls, views
+from .models import (
+    Conversation, DirectMessage, Follow, Notification, Reaction, Review, Store, StoreRatingSummary, Tag,
+    UserProfile,
+)
+from . import people_suggestions, store_recommendations
+from .management.commands import benchmark, explain_queries
+from .notification_fanout import fan_out_review
+from .checks import check_shared_cache
+from .page_cache import bump_store_version, get_global_version, get_store_version
+from .pagination import encode_cursor
+from .search import get_search_backend, update_search_index
+from .tag_facets import MATCH_ALL, MATCH_ANY, count_stores_by_tag, filter_stores_by_tags, tag_facets
+from .sql_instrumentation import QueryBudgetExceeded
+
+
+class StoreSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='pass')
+
+    def create_store(self, name, address='東京都'):
+        store = Store.objects.create(name=name, address=address, created_by=self.user)
+        update_search_index(store)
+        return store
+
+    def search(self, query):
+        return set(get_search_backend().filter(Store.objects.all(), query).values_list('name', flat=True))
+
+    def test_matches_substring(self):
+        self.create_store('渋谷ラーメン本店')
+        self.create_store('新宿カレー')
+        self.assertEqual(self.search('ラーメン'), {'渋谷ラーメン本店'})
+        self.assertEqual(self.search('ＲＡＭＥＮ'), set())
+
+    def test_does_not_match_across_word_boundaries(self):
+        """「ab bc」の店は、バイグラムが同じでも「abc」では見つからない"""
+        self.create_store('ab bc')
+        self.create_store('abcd')
+        self.assertEqual(self.search('abc'), {'abcd'})
+        self.assertEqual(self.search('ab bc'), {'ab bc'})
+
+    def test_single_character_query(self):
+        self.create_store('鮨処')
+        self.assertEqual(self.search('鮨'), {'鮨処'})
+
+
+
+class BlobImageTests(TestCase):
+    def setUp(self):
+        blob_root = tempfile.TemporaryDirectory()
+        self.addCleanup(blob_root.cleanup)
+        settings_override = override_settings(BLOB_STORAGE_ROOT=blob_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_blob_store.cache_clear()
+        self.addCleanup(get_blob_store.cache_clear)
+        self.key = get_blob_store().put(b'image')
+        self.missing_key = '0' * 64
+
+    def get(self, key, **headers):
+        return self.client.get(reverse('blob_image', args=[key]), headers=headers)
+
+    def test_serves_blob_with_immutable_caching(self):
+        response = self.get(self.key)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'image')
+        self.assertEqual(response['ETag'], f'"{self.key}"')
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_matching_etag_is_not_modified(self):
+        self.assertEqual(self.get(self.key, if_none_match=f'"other", "{self.key}"').status_code, 304)
+
+    def test_wildcard_only_matches_existing_blob(self):
+        self.assertEqual(self.get(self.key, if_none_match='*').status_code, 304)
+        self.assertEqual(self.get(self.missing_key, if_none_match='*').status_code, 404)
+        self.assertEqual(self.get(self.missing_key).status_code, 404)
+
+
+class StoreRatingSummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'reviewer{i}', password='pass') for i in range(5)]
+        cls.store = Store.objects.create(name='テスト店', address='東京都', created_by=cls.users[0])
+
+    def post_review(self, user, rating):
+        # store_detail へのPOSTと同じく、レビューの保存と集計の更新を1つのトランザクションで行う
+        with transaction.atomic():
+            review = Review.objects.create(store=self.store, user=user, rating=rating)
+            StoreRatingSummary.record_review(review)
+        return review
+
+    def delete_review(self, review):
+        with transaction.atomic():
+            review.delete()
+            StoreRatingSummary.discard_review(review)
+
+    def assertSummaryMatchesReviews(self):
+        store = (Store.objects.with_rating_stats().annotate(last_review=Max('reviews__created_at'))
+                 .get(pk=self.store.pk))
+        summary = StoreRatingSummary.objects.get(store=self.store)
+        self.assertEqual(summary.review_count, store.total_reviews)
+        for value, _ in Review.RATING_CHOICES:
+            self.assertEqual(getattr(summary, f'rating_{value}_count'), getattr(store, f'rating_{value}_count'))
+        ratings = list(Review.objects.filter(store=self.store).values_list('rating', flat=True))
+        self.assertAlmostEqual(summary.rating_average, sum(ratings) / len(ratings) if ratings else 0)
+        self.assertEqual(summary.last_review_at, store.last_review)
+
+    def test_summary_follows_created_and_deleted_reviews(self):
+        reviews = []
+        for user, rating in zip(self.users + self.users[:2], [5, 3, 3, 1, 4, 2, 5]):
+            reviews.append(self.post_review(user, rating))
+            self.assertSummaryMatchesReviews()
+
+        # 古いレビュー、最新のレビュー、残りすべての順に削除する
+        for review in [reviews[1], reviews[-1]] + reviews[2:-1] + reviews[:1]:
+            self.delete_review(review)
+            self.assertSummaryMatchesReviews()
+        self.assertEqual(StoreRatingSummary.objects.get(store=self.store).rating_average, 0)
+
+
+class RatingStatsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner', password='pass')
+        reviewers = [User.objects.create_user(f'reviewer{i}', password='pass') for i in range(6)]
+        cls.tag = Tag.objects.create(name='醤油', created_by=owner)
+        cls.stores = [Store.objects.create(name=f'店{i}', address='東京都', created_by=owner) for i in range(4)]
+        for store in cls.stores[:2]:
+            store.tags.add(cls.tag)
+        # 最後の店舗はレビューなし
+        ratings = {0: [5, 5, 4, 1, 5, 3], 1: [2, 2, 3], 2: [4]}
+        for index, values in ratings.items():
+            for reviewer, rating in zip(reviewers, values):
+                Review.objects.create(store=cls.stores[index], user=reviewer, rating=rating)
+        StoreRatingSummary.objects.bulk_create(StoreRatingSummary.build_from_reviews(Store.objects.all()))
+
+    def expected_counts(self, store):
+        ratings = list(Review.objects.filter(store=store).values_list('rating', flat=True))
+        return len(ratings), {value: ratings.count(value) for value, _ in Review.RATING_CHOICES}
+
+    def test_aggregate_matches_per_rating_counts(self):
+        # 多対多の絞り込みと組み合わせても件数が重複しない
+        for queryset in [Store.objects.all(), filter_stores_by_tags(Store.objects.all(), [self.tag.id])]:
+            for store in queryset.with_rating_stats():
+                with self.subTest(store=store.name):
+                    total, counts = self.expected_counts(store)
+                    self.assertEqual(store.total_reviews, total)
+                    self.assertEqual({value: getattr(store, f'rating_{value}_count') for value in counts}, counts)
+
+    def test_rating_stats_are_ordered_and_limited(self):
+        store = Store.objects.get(pk=self.stores[0].pk)
+        stats = store.get_rating_stats()
+        # 件数の多い順、同数なら評価の高い順
+        self.assertEqual(list(stats), [5, 4, 3, 1])
+        self.assertEqual(stats[5], {'label': dict(Review.RATING_CHOICES)[5], 'count': 3})
+        self.assertEqual(list(store.get_rating_stats(limit=1)), [5])
+        self.assertEqual(self.stores[3].get_rating_stats(), {})
+        for store in Store.objects.all():
+            with self.subTest(store=store.name):
+                total, counts = self.expected_counts(store)
+                self.assertEqual({value: row['count'] for value, row in store.get_rating_stats().items()},
+                                 {value: count for value, count in counts.items() if count})
+
+
+class ReactionToggleTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = [User.objects.create_user(name, password='pass') for name in ['alice', 'bob', 'carol']]
+        store = Store.objects.create(name='テスト店', address='東京都', created_by=cls.alice)
+        cls.review = Review.objects.create(store=store, user=cls.alice, rating=4)
+
+    def counter_values(self):
+        return Review.objects.get(pk=self.review.pk).get_reaction_counts()
+
+    def counted_rows(self):
+        rows = dict(Reaction.objects.filter(review=self.review).values('reaction_type')
+                    .annotate(count=Count('id')).values_list('reaction_type', 'count'))
+        return {key: rows.get(key, 0) for key, _ in Reaction.REACTION_CHOICES}
+
+    def test_add_switch_and_remove_keep_counts(self):
+        steps = [
+            (self.alice, 'good', 'added'),
+            (self.bob, 'good', 'added'),
+            (self.alice, 'bad', 'updated'),
+            (self.carol, 'question', 'added'),
+            (self.bob, 'good', 'removed'),
+            (self.carol, 'good', 'updated'),
+            (self.alice, 'bad', 'removed'),
+        ]
+        for user, reaction_type, expected_action in steps:
+            with self.subTest(user=user.username, reaction_type=reaction_type):
+                action, counts = Reaction.toggle(self.review.id, user, reaction_type)
+                self.assertEqual(action, expected_action)
+                self.assertEqual(counts, self.counted_rows())
+                self.assertEqual(self.counter_values(), counts)
+        self.assertEqual(self.counter_values(), {'good': 1, 'bad': 0, 'question': 0})
+
+    def test_view_returns_updated_counts(self):
+        self.client.force_login(self.bob)
+        response = self.client.post(reverse('add_reaction', args=[self.review.id]), {'reaction_type': 'question'})
+        self.assertEqual(response.json(), {'action': 'added',
+                                           'reaction_counts': {'good': 0, 'bad': 0, 'question': 1}})
+
+    def test_counts_never_go_negative(self):
+        """カウンタが実際の件数よりずれて少なくても、取り消し・変更で負にならない"""
+        Reaction.objects.create(review=self.review, user=self.alice, reaction_type='good')
+        Reaction.objects.create(review=self.review, user=self.bob, reaction_type='bad')
+        Review.objects.filter(pk=self.review.pk).update(good_count=0, bad_count=0)
+
+        self.assertEqual(Reaction.toggle(self.review.id, self.alice, 'good'),
+                         ('removed', {'good': 0, 'bad': 0, 'question': 0}))
+        self.assertEqual(Reaction.toggle(self.review.id, self.bob, 'question'),
+                         ('updated', {'good': 0, 'bad': 0, 'question': 1}))
+
+
+@override_settings(IMAGE_PROCESSING_ASYNC=False)
+class ImageQueueTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='pass')
+
+    def setUp(self):
+        blob_root = tempfile.TemporaryDirectory()
+        self.addCleanup(blob_root.cleanup)
+        settings_override = override_settings(BLOB_STORAGE_ROOT=blob_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_blob_store.cache_clear()
+        self.addCleanup(get_blob_store.cache_clear)
+
+        self.store = Store.objects.create(name='テスト店', address='東京都', created_by=self.user)
+        mark_processing(self.store, 'image_status', 'image_queued_at')
+        self.store.save()
+
+    def upload(self, data):
+        return SimpleUploadedFile('store.png', data, content_type='image/png')
+
+    def png(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (1200, 900), 'red').save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    def test_processing_to_ready(self):
+        completed = []
+        enqueue_image(self.store, self.upload(self.png()), STORE_IMAGE_SIZE, 'image_key', 'image_status',
+                      'image_queued_at', on_complete=completed.append)
+        self.store.refresh_from_db()
+        self.assertEqual(self.store.image_status, IMAGE_STATUS_READY)
+        self.assertTrue(get_blob_store().exists(self.store.image_key))
+        with Image.open(io.BytesIO(get_blob_store().read(self.store.image_key))) as img:
+            self.assertEqual((img.format, img.size), ('JPEG', STORE_IMAGE_SIZE))
+        self.assertEqual(completed, [self.store.pk])
+
+    def test_processing_to_failed(self):
+        completed = []
+        with self.assertLogs('reviews.image_queue', 'ERROR'):
+            enqueue_image(self.store, self.upload(b'not an image'), STORE_IMAGE_SIZE, 'image_key', 'image_status',
+                          'image_queued_at', on_complete=completed.append)
+        self.store.refresh_from_db()
+        self.assertEqual(self.store.image_status, IMAGE_STATUS_FAILED)
+        self.assertIsNone(self.store.image_key)
+        self.assertEqual(completed, [self.store.pk])
+
+    def test_older_job_does_not_overwrite_newer_upload(self):
+        """先に予約した画像の処理が後から終わっても、新しく予約した画像の状態を変えない"""
+        older = Store.objects.get(pk=self.store.pk)
+        mark_processing(self.store, 'image_status', 'image_queued_at')
+        self.store.save()
+
+        enqueue_image(older, self.upload(self.png()), STORE_IMAGE_SIZE, 'image_key', 'image_status', 'image_queued_at')
+        with self.assertLogs('reviews.image_queue', 'ERROR'):
+            enqueue_image(older, self.upload(b'not an image'), STORE_IMAGE_SIZE, 'image_key', 'image_status',
+                          'image_queued_at')
+        self.store.refresh_from_db()
+        self.assertEqual((self.store.image_status, self.store.image_key), (IMAGE_STATUS_PROCESSING, None))
+
+        enqueue_image(self.store, self.upload(self.png()), STORE_IMAGE_SIZE, 'image_key', 'image_status',
+                      'image_queued_at')
+        self.store.refresh_from_db()
+        self.assertEqual(self.store.image_status, IMAGE_STATUS_READY)
+        self.assertIsNotNone(self.store.image_key)
+
+    def test_store_edit_keeps_image_finished_meanwhile(self):
+        """編集フォームの保存は、読み込んだ後に処理が終わった画像を古いキーで戻さない"""
+        is_valid = StoreForm.is_valid
+
+        def finish_meanwhile(form):
+            Store.objects.filter(pk=self.store.pk).update(image_key='a' * 64, image_status=IMAGE_STATUS_READY)
+            return is_valid(form)
+
+        self.client.force_login(self.user)
+        with mock.patch.object(StoreForm, 'is_valid', autospec=True, side_effect=finish_meanwhile):
+            response = self.client.post(reverse('store_edit', args=[self.store.pk]),
+                                        {'name': '新しい店名', 'address': '東京都'})
+        self.assertRedirects(response, reverse('store_detail', args=[self.store.pk]), fetch_redirect_response=False)
+        self.store.refresh_from_db()
+        self.assertEqual(self.store.name, '新しい店名')
+        self.assertEqual((self.store.image_status, self.store.image_key), (IMAGE_STATUS_READY, 'a' * 64))
+
+    def test_recover_stale_processing_rows(self):
+        """予約から時間が過ぎた「処理中」の行だけを失敗にする"""
+        stale = Store.objects.create(name='古い処理', address='東京都', created_by=self.user,
+                                     image_status=IMAGE_STATUS_PROCESSING,
+                                     image_queued_at=timezone.now() - timedelta(hours=1))
+        untracked = Store.objects.create(name='予約日時なし', address='東京都', created_by=self.user,
+                                         image_status=IMAGE_STATUS_PROCESSING)
+
+        version = get_store_version(stale.id)
+        with self.assertLogs('reviews.image_queue', 'WARNING'), self.captureOnCommitCallbacks(execute=True):
+            call_command('recover_image_jobs', '--minutes', '30', stdout=io.StringIO())
+        self.assertGreater(get_store_version(stale.id), version)
+        statuses = dict(Store.objects.values_list('id', 'image_status'))
+        self.assertEqual(statuses[stale.id], IMAGE_STATUS_FAILED)
+        self.assertEqual(statuses[untracked.id], IMAGE_STATUS_FAILED)
+        self.assertEqual(statuses[self.store.id], IMAGE_STATUS_PROCESSING)
+
+
+class ReviewFanoutTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='pass')
+        cls.followers = [User.objects.create_user(f'follower{i}', password='pass') for i in range(3)]
+        for follower in cls.followers:
+            Follow.objects.create(follower=follower, following=cls.author)
+
+    def notifications_for(self, user):
+        return list(Notification.objects.filter(user=user, from_user=self.author).order_by('id')
+                    .values_list('message', 'is_read'))
+
+    @override_settings(NOTIFICATION_FANOUT_CHUNK_SIZE=2)
+    def test_creates_one_notification_per_follower(self):
+        result = fan_out_review(1, self.author.id, 'author', 'A店')
+        self.assertEqual((result.created, result.coalesced, result.chunk_sizes), (3, 0, [2, 1]))
+        for follower in self.followers:
+            self.assertEqual(self.notifications_for(follower), [('authorさんがA店のレビューを投稿しました。', False)])
+
+    def test_coalesces_unread_notifications(self):
+        fan_out_review(1, self.author.id, 'author', 'A店')
+        Notification.objects.filter(user=self.followers[0]).update(is_read=True)
+
+        result = fan_out_review(2, self.author.id, 'author', 'B店')
+        self.assertEqual((result.created, result.coalesced), (1, 2))
+        self.assertEqual(self.notifications_for(self.followers[0]), [
+            ('authorさんがA店のレビューを投稿しました。', True),
+            ('authorさんがB店のレビューを投稿しました。', False),
+        ])
+        self.assertEqual(self.notifications_for(self.followers[1]), [('authorさんがB店ほかのお店のレビューを投稿しました。', False)])
+
+    def test_notification_read_during_fanout_gets_a_new_one(self):
+        """まとめる対象に選んだ後に既読にされた人にも、新しい通知を作る"""
+        fan_out_review(1, self.author.id, 'author', 'A店')
+        reader = self.followers[0]
+        update = QuerySet.update
+
+        def read_before_update(queryset, **kwargs):
+            if queryset.model is Notification and 'message' in kwargs:
+                Notification.objects.filter(user=reader).update(is_read=True)
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', autospec=True, side_effect=read_before_update):
+            result = fan_out_review(2, self.author.id, 'author', 'B店')
+        self.assertEqual((result.created, result.coalesced), (1, 2))
+        self.assertEqual(self.notifications_for(reader), [
+            ('authorさんがA店のレビューを投稿しました。', True),
+            ('authorさんがB店のレビューを投稿しました。', False),
+        ])
+
+
+@override_settings(QUERY_BUDGET_RAISE=True, IMAGE_PROCESSING_ASYNC=False,
+                   NOTIFICATION_FANOUT_ASYNC=False, RECOMMENDATION_UPDATE_ASYNC=False)
+class QueryBudgetTests(TestCase):
+    """
+    @query_budget を付けたビューを、ログインあり・なしと、キャッシュが空のとき・あるときで呼ぶ。
+    上限を超えると SQLInstrumentationMiddleware が QueryBudgetExceeded を送出する。
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.storage = tempfile.TemporaryDirectory()
+        cls.settings_override = override_settings(BLOB_STORAGE_ROOT=cls.storage.name + '/blobs',
+                                                  RECOMMENDATION_ROOT=cls.storage.name + '/recommendations')
+        cls.settings_override.enable()
+        get_blob_store.cache_clear()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.settings_override.disable()
+        get_blob_store.cache_clear()
+        cls.storage.cleanup()
+
+    @classmethod
+    def setUpTestData(cls):
+        users = [User.objects.create_user(f'user{i}', password='pass') for i in range(6)]
+        UserProfile.objects.bulk_create([UserProfile(user=user) for user in users])
+        cls.user, cls.other_user = users[:2]
+
+        buffer = io.BytesIO()
+        Image.new('RGB', (400, 300), 'blue').save(buffer, format='PNG')
+        cls.blob_key = get_blob_store().put(buffer.getvalue())
+
+        tags = [Tag.objects.create(name=f'タグ{i}', created_by=cls.user) for i in range(3)]
+        cls.tag = tags[0]
+        stores = []
+        for i in range(8):
+            store = Store.objects.create(name=f'ラーメン店{i}', address=f'渋谷{i}丁目', created_by=users[i % 3],
+                                         image_key=cls.blob_key if i % 2 else None)
+            store.tags.set(tags[:1 + i % 3])
+            for reviewer in users[:4]:
+                review = Review.objects.create(store=store, user=reviewer, rating=1 + (i + reviewer.id) % 5,
+                                               comment='レビュー')
+                for reactor in users[3:]:
+                    Reaction.objects.create(review=review, user=reactor, reaction_type='good')
+            stores.append(store)
+        cls.store = stores[0]
+
+        for follower in users:
+            for following in users:
+                if follower != following and (follower.id + following.id) % 3:
+                    Follow.objects.create(follower=follower, following=following)
+        Follow.objects.get_or_create(follower=cls.user, following=cls.other_user)
+        Follow.objects.get_or_create(follower=cls.other_user, following=cls.user)
+        Notification.objects.bulk_create([
+            Notification(user=cls.user, from_user=sender, notification_type='follow', message='フォローされました')
+            for sender in users[1:]
+        ])
+
+        cls.conversations = [Conversation.get_or_create_between(cls.user, partner) for partner in users[1:4]]
+        for conversation in cls.conversations:
+            for i in range(3):
+                sender = cls.user if i % 2 else conversation.get_other_user(cls.user)
+                DirectMessage.objects.create(conversation=conversation, sender=sender, content=f'メッセージ{i}')
+
+        for command in ['rebuild_rating_summaries', 'rebuild_search_index', 'rebuild_tag_counts',
+                        'rebuild_follow_counts', 'build_people_suggestions', 'build_store_recommendations']:
+            call_command(command, stdout=io.StringIO())
+
+    def setUp(self):
+        # 1回目はキャッシュが空の状態で数える
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def requests(self):
+        """(URL名, URL引数, メソッド, クエリ/データ) の一覧"""
+        store_id = self.store.id
+        conversation_id = self.conversations[0].id
+        return [
+            ('store_list', {}, 'GET', {}),
+            ('store_list', {}, 'GET', {'q': 'ラーメン'}),
+            ('store_list', {}, 'GET', {'tag': [self.tag.id]}),
+            ('store_detail', {'store_id': store_id}, 'GET', {}),
+            ('tags_api', {}, 'GET', {}),
+            ('user_list', {}, 'GET', {}),
+            ('user_list', {}, 'GET', {'q': 'user'}),
+            ('user_profile', {'user_id': self.other_user.id}, 'GET', {}),
+            ('follow_user', {'user_id': self.other_user.id}, 'POST', {}),
+            ('send_dm', {'user_id': self.other_user.id}, 'GET', {}),
+            ('send_dm', {'user_id': self.other_user.id}, 'POST', {'content': 'こんにちは'}),
+            ('dm_inbox', {}, 'GET', {}),
+            ('dm_inbox', {}, 'GET', {'format': 'json'}),
+            ('dm_messages', {'conversation_id': conversation_id}, 'GET', {'since': 0}),
+            ('api_store_list', {}, 'GET', {}),
+            ('api_store_list', {}, 'GET', {'tag': self.tag.id, 'fields': 'id,name,tags'}),
+            ('api_store_reviews', {'store_id': store_id}, 'GET', {}),
+            ('blob_image', {'key': self.blob_key}, 'GET', {}),
+            ('unread_notifications_count', {}, 'GET', {}),
+            ('notifications', {}, 'GET', {}),
+        ]
+
+    def request(self, name, kwargs, method, data):
+        path = reverse(name, kwargs=kwargs)
+        if method == 'POST':
+            return self.client.post(path, data)
+        return self.client.get(path, data)
+
+    def request_all(self):
+        for name, kwargs, method, data in self.requests():
+            # 同じリクエストを2回（キャッシュが空のときと、あるとき）
+            for attempt in ['cold', 'warm']:
+                with self.subTest(name=name, method=method, data=data, attempt=attempt):
+                    response = self.request(name, kwargs, method, data)
+                    self.assertLess(response.status_code, 400)
+            cache.clear()
+
+    def test_authenticated(self):
+        self.client.force_login(self.user)
+        self.request_all()
+
+    def test_anonymous(self):
+        self.request_all()
+
+    def test_all_budgeted_views_are_requested(self):
+        requested = {name for name, *_ in self.requests()}
+        budgeted = {pattern.name for pattern in review_urls.urlpatterns
+                    if isinstance(pattern, URLPattern) and hasattr(pattern.callback, 'query_budget')}
+        self.assertEqual(budgeted - requested, set())
+
+    def test_server_timing_only_when_enabled(self):
+        """Server-Timingヘッダーは設定したときだけ返し、リクエストごとのログはDEBUGレベルで出す"""
+        self.client.force_login(self.user)
+        with override_settings(SQL_SERVER_TIMING=False):
+            self.assertNotIn('Server-Timing', self.client.get(reverse('tags_api')))
+        with override_settings(SQL_SERVER_TIMING=True), self.assertLogs('reviews.sql', 'DEBUG') as logs:
+            response = self.client.get(reverse('tags_api'))
+        self.assertIn('queries', response['Server-Timing'])
+        self.assertEqual([record.levelname for record in logs.records], ['DEBUG'])
+
+    def test_budget_overrun_raises(self):
+        self.client.force_login(self.user)
+        with mock.patch.object(views.tags_api, 'query_budget', 0), self.assertRaises(QueryBudgetExceeded):
+            self.client.get(reverse('tags_api'))
+
+
+class ConversationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pass')
+        cls.bob = User.objects.create_user('bob', password='pass')
+
+    def test_get_or_create_between_is_symmetric(self):
+        conversation = Conversation.get_or_create_between(self.bob, self.alice)
+        self.assertEqual(Conversation.get_or_create_between(self.alice, self.bob), conversation)
+        self.assertEqual(Conversation.get_or_create_between(self.bob, self.alice), conversation)
+        self.assertEqual(Conversation.objects.count(), 1)
+        self.assertEqual((conversation.low_user_id, conversation.high_user_id), (self.alice.id, self.bob.id))
+        self.assertEqual(set(conversation.participants.values_list('id', flat=True)), {self.alice.id, self.bob.id})
+
+    def test_pair_constraints(self):
+        Conversation.get_or_create_between(self.alice, self.bob)
+        for low, high in [(self.alice, self.bob), (self.bob, self.alice), (self.alice, self.alice)]:
+            with self.subTest(low=low.username, high=high.username):
+                with self.assertRaises(IntegrityError), transaction.atomic():
+                    Conversation.objects.create(low_user=low, high_user=high)
+
+    def test_backfill_merges_duplicate_conversations(self):
+        """0022: 同じ2人の重複した会話を一番古い会話にまとめ、キーを設定する"""
+        carol = User.objects.create_user('carol', password='pass')
+        conversations = []
+        for members in [(self.bob, self.alice), (self.alice, self.bob), (self.alice, carol)]:
+            conversation = Conversation.objects.create()
+            conversation.participants.add(*members)
+            DirectMessage.objects.create(conversation=conversation, sender=members[0], content='こんにちは')
+            conversations.append(conversation)
+
+        import_module('reviews.migrations.0022_backfill_conversation_pairs').forwards(apps, None)
+
+        self.assertEqual(list(Conversation.objects.order_by('id').values_list('id', 'low_user_id', 'high_user_id')), [
+            (conversations[0].id, self.alice.id, self.bob.id),
+            (conversations[2].id, self.alice.id, carol.id),
+        ])
+        self.assertEqual(DirectMessage.objects.filter(conversation=conversations[0]).count(), 2)
+        self.assertEqual(Conversation.get_or_create_between(self.bob, self.alice), conversations[0])
+
+
+class DMStreamTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pass')
+        cls.bob = User.objects.create_user('bob', password='pass')
+        cls.conversation = Conversation.get_or_create_between(cls.alice, cls.bob)
+        DirectMessage.objects.bulk_create([
+            DirectMessage(conversation=cls.conversation, sender=cls.bob, content=f'メッセージ{i}')
+            for i in range(MAX_MESSAGES_PER_FETCH * 2 + 50)
+        ])
+        cls.message_ids = list(cls.conversation.messages.order_by('id').values_list('id', flat=True))
+
+    def test_wsgi_returns_no_content(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('dm_stream', args=[self.conversation.id]))
+        self.assertEqual(response.status_code, 204)
+
+    def test_messages_pages_with_has_more(self):
+        """ポーリングでも上限件数ごとに続きを取得して、すべてのメッセージに追いつく"""
+        self.client.force_login(self.alice)
+        received, since_id, has_more = [], 10, True
+        while has_more:
+            data = self.client.get(reverse('dm_messages', args=[self.conversation.id]), {'since': since_id}).json()
+            self.assertLessEqual(len(data['messages']), MAX_MESSAGES_PER_FETCH)
+            received += [message['id'] for message in data['messages']]
+            since_id, has_more = data['last_id'], data['has_more']
+        self.assertEqual(received, [i for i in self.message_ids if i > 10])
+
+    async def test_asgi_backfills_every_missed_message(self):
+        """Last-Event-ID以降が上限件数より多くても、取りこぼさずすべて送る"""
+        await self.async_client.aforce_login(self.alice)
+        last_seen = self.message_ids[9]
+        missed = self.message_ids[10:]
+        response = await self.async_client.get(reverse('dm_stream', args=[self.conversation.id]),
+                                               headers={'Last-Event-ID': str(last_seen)})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = aiter(response.streaming_content)
+        received = []
+        for _ in missed:
+            event = (await anext(content)).decode()
+            received.append(int(event.split('\n')[0].removeprefix('id: ')))
+        await content.aclose()
+        self.assertEqual(received, missed)
+
+
+class InboxTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.me, cls.bob, cls.carol, cls.dave = [
+            User.objects.create_user(name, password='pass') for name in ['me', 'bob', 'carol', 'dave']
+        ]
+
+    def send(self, sender, recipient, content, is_read=False):
+        conversation = Conversation.get_or_create_between(sender, recipient)
+        message = DirectMessage.objects.create(conversation=conversation, sender=sender, content=content, is_read=is_read)
+        Conversation.objects.filter(id=conversation.id).update(updated_at=message.created_at)
+        return conversation
+
+    def test_unread_counts_and_last_message(self):
+        self.send(self.bob, self.me, '1通目', is_read=True)
+        self.send(self.bob, self.me, '2通目')
+        self.send(self.bob, self.me, '3通目')
+        # 自分が送った未読のメッセージは数えない
+        self.send(self.me, self.carol, 'やあ')
+        self.send(self.carol, self.me, '返信')
+        self.send(self.me, self.carol, '最後')
+        # メッセージのない会話は出さない
+        Conversation.get_or_create_between(self.me, self.dave)
+
+        with self.assertNumQueries(1):
+            inbox = [(c.get_other_user(self.me).username, c.last_message_content, c.unread_count)
+                     for c in Conversation.objects.inbox_for(self.me)]
+        self.assertEqual(inbox, [('carol', '最後', 1), ('bob', '3通目', 2)])
+
+        carol_inbox = Conversation.objects.inbox_for(self.carol).get()
+        self.assertEqual(carol_inbox.unread_count, 2)
+
+
+class FollowCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = [User.objects.create_user(name, password='pass') for name in ['alice', 'bob', 'carol']]
+        UserProfile.objects.create(user=cls.alice)
+        UserProfile.objects.create(user=cls.bob)
+        # carol はプロフィールがまだない
+
+    def counts(self, user):
+        return tuple(UserProfile.objects.filter(user=user).values_list('followers_count', 'following_count').get())
+
+    def test_repeated_toggles_keep_counts(self):
+        results = [Follow.toggle(self.alice.id, self.bob.id) for _ in range(5)]
+        self.assertEqual(results, [(True, 1), (False, 0), (True, 1), (False, 0), (True, 1)])
+        self.assertEqual(self.counts(self.bob), (1, 0))
+        self.assertEqual(self.counts(self.alice), (0, 1))
+
+        Follow.toggle(self.bob.id, self.alice.id)
+        Follow.toggle(self.carol.id, self.bob.id)
+        self.assertEqual(self.counts(self.bob), (2, 1))
+        self.assertEqual(self.counts(self.carol), (0, 1))
+        self.assertEqual(self.counts(self.alice), (1, 1))
+        call_command('rebuild_follow_counts', '--verify', stdout=io.StringIO())
+
+    def test_counts_never_go_negative(self):
+        UserProfile.objects.filter(user=self.bob).update(followers_count=0)
+        Follow.objects.create(follower=self.alice, following=self.bob)
+        self.assertEqual(Follow.toggle(self.alice.id, self.bob.id), (False, 0))
+        self.assertEqual(self.counts(self.bob), (0, 0))
+
+    def test_concurrent_duplicate_follow_changes_nothing(self):
+        """同時に同じフォローが作られたら、後のリクエストは通知もキャッシュの破棄もしない"""
+        Follow.toggle(self.alice.id, self.bob.id)
+        # 先のリクエストがDELETEの後にINSERTした状態（DELETEでは見つからず、INSERTが一意制約に違反する）
+        not_found = mock.patch.object(QuerySet, 'delete', autospec=True, return_value=(0, {}))
+        with not_found:
+            self.assertEqual(Follow.toggle(self.alice.id, self.bob.id), (None, 1))
+
+        self.client.force_login(self.alice)
+        with not_found, mock.patch.object(views, 'invalidate_follow_graph') as invalidate, \
+                self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('follow_user', args=[self.bob.id]))
+        self.assertEqual(response.json()['is_following'], True)
+        self.assertEqual(response.json()['followers_count'], 1)
+        invalidate.assert_not_called()
+        self.assertEqual(callbacks, [])
+        self.assertFalse(Notification.objects.exists())
+        self.assertEqual(self.counts(self.bob), (1, 0))
+        self.assertEqual(self.counts(self.alice), (0, 1))
+
+    def test_profile_edit_keeps_concurrent_counts(self):
+        """プロフィールの保存は、読み込んだ後に更新されたフォロワー数を上書きしない"""
+        is_valid = UserProfileForm.is_valid
+
+        def follow_meanwhile(form):
+            Follow.toggle(self.alice.id, self.bob.id)
+            return is_valid(form)
+
+        self.client.force_login(self.bob)
+        with mock.patch.object(UserProfileForm, 'is_valid', autospec=True, side_effect=follow_meanwhile):
+            response = self.client.post(reverse('profile'), {'bio': 'ラーメンが好きです'})
+        self.assertRedirects(response, reverse('profile'), fetch_redirect_response=False)
+        profile = UserProfile.objects.get(user=self.bob)
+        self.assertEqual(profile.bio, 'ラーメンが好きです')
+        self.assertEqual((profile.followers_count, profile.following_count), (1, 0))
+
+    def test_backfill_counts(self):
+        """0028: フォロー関係からカウンタを計算し、プロフィールがなければ作る"""
+        Follow.objects.create(follower=self.alice, following=self.bob)
+        Follow.objects.create(follower=self.carol, following=self.bob)
+        Follow.objects.create(follower=self.bob, following=self.carol)
+        import_module('reviews.migrations.0028_backfill_follow_counts').forwards(apps, None)
+        self.assertEqual(self.counts(self.bob), (2, 1))
+        self.assertEqual(self.counts(self.carol), (1, 1))
+        self.assertEqual(self.counts(self.alice), (0, 1))
+
+
+class FollowGraphTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol, cls.dave = [User.objects.create_user(name, password='pass')
+                                                   for name in ['alice', 'bob', 'carol', 'dave']]
+        # alice ⇄ bob は相互、alice → carol は片思い、dave → alice はフォローされているだけ
+        for follower, following in [(cls.alice, cls.bob), (cls.bob, cls.alice), (cls.alice, cls.carol),
+                                    (cls.dave, cls.alice)]:
+            Follow.objects.create(follower=follower, following=following)
+
+    def setUp(self):
+        cache.clear()
+
+    def flags(self, graph, users):
+        return {user.username: (graph.is_following(user.id), graph.is_followed_by(user.id), graph.is_friend(user.id))
+                for user in users}
+
+    def test_friend_flags(self):
+        others = [self.bob, self.carol, self.dave]
+        expected = {'bob': (True, True, True), 'carol': (True, False, False), 'dave': (False, True, False)}
+        self.assertEqual(self.flags(FollowGraph.for_user(self.alice), others), expected)
+        # ページ内のユーザーだけを読んでも同じ結果になる
+        self.assertEqual(self.flags(FollowGraph.for_user_ids(self.alice, [u.id for u in others]), others), expected)
+        self.assertFalse(FollowGraph.for_user(self.alice).is_friend(self.alice.id))
+        self.assertEqual(self.flags(FollowGraph.for_user(self.carol), [self.alice])['alice'], (False, True, False))
+
+    def test_anonymous_graph_is_empty(self):
+        graph = FollowGraph.for_user(AnonymousUser())
+        self.assertEqual((graph.following_ids, graph.follower_ids), (frozenset(), frozenset()))
+        self.assertFalse(graph.is_friend(self.alice.id))
+
+    def test_invalidate_after_follow_change(self):
+        self.assertFalse(FollowGraph.for_user(self.carol).is_friend(self.alice.id))
+        Follow.toggle(self.carol.id, self.alice.id)
+        # キャッシュを破棄するまでは前の状態のまま
+        self.assertFalse(FollowGraph.for_user(self.carol).is_friend(self.alice.id))
+        invalidate_follow_graph(self.carol.id, self.alice.id)
+        self.assertTrue(FollowGraph.for_user(self.carol).is_friend(self.alice.id))
+        self.assertTrue(FollowGraph.for_user(self.alice).is_friend(self.carol.id))
+
+    def test_store_detail_marks_friend_reviews(self):
+        storage = tempfile.TemporaryDirectory()
+        self.addCleanup(storage.cleanup)
+        with override_settings(RECOMMENDATION_ROOT=storage.name):
+            store = Store.objects.create(name='テスト店', address='東京都', created_by=self.dave)
+            for user in [self.bob, self.carol, self.dave, self.alice]:
+                Review.objects.create(store=store, user=user, rating=4)
+            self.client.force_login(self.alice)
+            response = self.client.get(reverse('store_detail', args=[store.id]))
+        self.assertEqual({review.user.username: review.is_friend for review in response.context['reviews']},
+                         {'bob': True, 'carol': False, 'dave': False, 'alice': False})
+
+
+class PurgeNotificationsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='pass')
+        cls.alice = User.objects.create_user('alice', password='pass')
+        cls.bob = User.objects.create_user('bob', password='pass')
+
+    def notify(self, user, days_ago, is_read, message=''):
+        notification = Notification.objects.create(user=user, from_user=self.sender, notification_type='follow',
+                                                   message=message, is_read=is_read)
+        Notification.objects.filter(id=notification.id).update(created_at=timezone.now() - timedelta(days=days_ago))
+        return notification.id
+
+    def purge(self, *args):
+        call_command('purge_notifications', '--sleep', '0', '--batch-size', '2', *args, stdout=io.StringIO())
+
+    def remaining(self, user):
+        return set(Notification.objects.filter(user=user).values_list('id', flat=True))
+
+    def test_keeps_newest_read_notifications_per_user(self):
+        alice_read = [self.notify(self.alice, days, True) for days in range(1, 8)]
+        alice_unread = [self.notify(self.alice, days, False) for days in [10, 20]]
+        bob_read = [self.notify(self.bob, days, True) for days in range(1, 3)]
+
+        self.purge('--per-user-limit', '3')
+        # 既読は新しい3件だけ残り、未読と上限以下のユーザーの通知はそのまま
+        self.assertEqual(self.remaining(self.alice), set(alice_read[:3] + alice_unread))
+        self.assertEqual(self.remaining(self.bob), set(bob_read))
+
+    def test_deletes_old_read_notifications_only(self):
+        recent = self.notify(self.alice, 10, True)
+        old_unread = self.notify(self.alice, 100, False)
+        for days in [91, 120, 200]:
+            self.notify(self.alice, days, True)
+
+        self.purge('--days', '90', '--per-user-limit', '0')
+        self.assertEqual(self.remaining(self.alice), {recent, old_unread})
+
+    def test_dry_run_and_max_batches(self):
+        ids = [self.notify(self.alice, days, True) for days in range(100, 106)]
+        self.purge('--days', '90', '--dry-run')
+        self.assertEqual(self.remaining(self.alice), set(ids))
+
+        # 1回のDELETEは --batch-size の2件まで（古い順に消える）
+        self.purge('--days', '90', '--max-batches', '1')
+        self.assertEqual(self.remaining(self.alice), set(ids[:4]))
+
+    def test_notifications_page_marks_read_and_keeps_history(self):
+        ids = [self.notify(self.alice, days, days > 5) for days in range(1, 10)]
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('notifications'))
+        self.assertContains(response, '5件の新しい通知を既読にしました。')
+        self.assertEqual(self.remaining(self.alice), set(ids))
+        self.assertFalse(Notification.objects.filter(user=self.alice, is_read=False).exists())
+
+
+class UserListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.me = User.objects.create_user('me', password='pass')
+        cls.users = {name: User.objects.create_user(name, password='pass')
+                     for name in ['taro', 'taichi', 'takeshi', 'tomoko', 'hanako']}
+        Follow.objects.create(follower=cls.me, following=cls.users['taro'])
+        Follow.objects.create(follower=cls.users['taro'], following=cls.me)
+        Follow.objects.create(follower=cls.me, following=cls.users['takeshi'])
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.me)
+
+    def get(self, **params):
+        response = self.client.get(reverse('user_list'), params)
+        rows = [(row['user']['username'], row['is_following'], row['is_friend'])
+                for row in response.context['users_with_status']]
+        return rows, response.context['page'].next_cursor
+
+    def test_prefix_search_with_follow_status(self):
+        rows, next_cursor = self.get(q='ta')
+        self.assertEqual(rows, [('taichi', False, False), ('takeshi', True, False), ('taro', True, True)])
+        self.assertIsNone(next_cursor)
+
+    def test_pages_follow_username_order(self):
+        names = []
+        cursor = None
+        while True:
+            rows, cursor = self.get(page_size=2, **({'cursor': cursor} if cursor else {}))
+            self.assertLessEqual(len(rows), 2)
+            names.extend(name for name, _, _ in rows)
+            if cursor is None:
+                break
+        self.assertEqual(names, sorted(self.users))
+
+
+class PeopleSuggestionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = {name: User.objects.create_user(name, password='pass')
+                     for name in ['me', 'amy', 'ben', 'cat', 'dan', 'eve']}
+        u = cls.users
+        for follower, following in [('me', 'amy'), ('me', 'ben'), ('amy', 'cat'), ('amy', 'dan'),
+                                    ('ben', 'cat'), ('eve', 'me')]:
+            Follow.objects.create(follower=u[follower], following=u[following])
+        store = Store.objects.create(name='共通の店', address='東京都', created_by=u['me'])
+        for name in ['me', 'dan']:
+            Review.objects.create(store=store, user=u[name], rating=4)
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        settings_override = override_settings(RECOMMENDATION_ROOT=root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.clear()
+        people_suggestions.rebuild()
+
+    def suggested(self, name):
+        return [(User.objects.get(id=s.user_id).username, s.score, s.mutual_count, s.shared_store_count)
+                for s in people_suggestions.suggestions_for(self.users[name].id, limit=10)]
+
+    def test_friends_of_friends(self):
+        # cat: 共通のフォロー2人、eve: フォローしてくれている、dan: 共通のフォロー1人と共通の店舗1つ
+        self.assertEqual(self.suggested('me'), [('cat', 2.0, 2, 0), ('eve', 2.0, 0, 0), ('dan', 1.5, 1, 1)])
+
+    def test_follow_change_updates_both_users(self):
+        people_suggestions.apply_follow_change(self.users['me'].id, self.users['cat'].id, True)
+        self.assertEqual([name for name, *_ in self.suggested('me')], ['eve', 'dan'])
+        # cat から見ると me はフォローしてくれている人
+        self.assertIn(('me', 2.0, 0, 0), self.suggested('cat'))
+
+        people_suggestions.apply_follow_change(self.users['me'].id, self.users['cat'].id, False)
+        self.assertEqual([name for name, *_ in self.suggested('me')], ['cat', 'eve', 'dan'])
+
+
+class StoreRecommendationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        rng = np.random.default_rng(0)
+        owner = User.objects.create_user('owner', password='pass')
+        users = [User.objects.create_user(f'user{i}', password='pass') for i in range(12)]
+        cls.stores = [Store.objects.create(name=f'店{i}', address='東京都', created_by=owner) for i in range(15)]
+        Review.objects.bulk_create([
+            Review(store=store, user=user, rating=int(rng.integers(1, 6)))
+            for user in users for store in cls.stores if rng.random() < 0.4
+        ])
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        settings_override = override_settings(RECOMMENDATION_ROOT=root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.clear()
+        self.index = store_recommendations.rebuild(top_k=5, batch_size=4)
+
+    def brute_force(self):
+        """{(店舗ID, 店舗ID): 調整コサイン類似度} を密行列で計算する"""
+        ratings = list(Review.objects.values_list('user_id', 'store_id', 'rating'))
+        user_ids = sorted({row[0] for row in ratings})
+        store_ids = [store.id for store in self.stores]
+        matrix = np.zeros((len(user_ids), len(store_ids)))
+        rated = np.zeros_like(matrix, dtype=bool)
+        for user_id, store_id, rating in ratings:
+            matrix[user_ids.index(user_id), store_ids.index(store_id)] = rating
+            rated[user_ids.index(user_id), store_ids.index(store_id)] = True
+        means = matrix.sum(axis=1) / np.maximum(rated.sum(axis=1), 1)
+        centered = np.where(rated, matrix - means[:, np.newaxis], 0)
+        norms = np.linalg.norm(centered, axis=0)
+        return {
+            (a, b): centered[:, i] @ centered[:, j] / (norms[i] * norms[j]) if norms[i] and norms[j] else 0
+            for i, a in enumerate(store_ids) for j, b in enumerate(store_ids) if a != b
+        }
+
+    def assertTopNeighbors(self, store_id, neighbors, expected):
+        candidates = sorted((sim for (a, _), sim in expected.items() if a == store_id and sim > 0), reverse=True)
+        np.testing.assert_allclose([sim for _, sim in neighbors], candidates[:5], rtol=1e-4)
+        for neighbor_id, sim in neighbors:
+            self.assertAlmostEqual(sim, expected[store_id, neighbor_id], places=4)
+
+    def test_build_matches_brute_force(self):
+        expected = self.brute_force()
+        for store in self.stores:
+            with self.subTest(store=store.name):
+                self.assertTopNeighbors(store.id, self.index.neighbors_of(store.id), expected)
+
+    def test_update_store_matches_full_build(self):
+        """何も変わっていなければ、1店舗分の再計算は全体の計算と同じ結果になる"""
+        expected = self.brute_force()
+        for store in self.stores:
+            with self.subTest(store=store.name):
+                self.assertTopNeighbors(store.id, store_recommendations.update_store(store.id, top_k=5), expected)
+
+    def test_similar_and_recommended_stores(self):
+        store = self.stores[0]
+        rows = store_recommendations.similar_stores(store.id, limit=3)
+        self.assertEqual([row['id'] for row in rows], [neighbor_id for neighbor_id, _ in self.index.neighbors_of(store.id)][:3])
+
+        recommended_count = 0
+        for user in User.objects.filter(username__startswith='user'):
+            reviewed = set(Review.objects.filter(user=user).values_list('store_id', flat=True))
+            recommended = {row['id'] for row in store_recommendations.recommended_stores(user.id, limit=10)}
+            self.assertFalse(recommended & reviewed)
+            recommended_count += len(recommended)
+        self.assertTrue(recommended_count)
+
+
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pass')
+        cls.bob = User.objects.create_user('bob', password='pass')
+        cls.store = Store.objects.create(name='テスト店', address='東京都', created_by=cls.alice)
+        cls.other_store = Store.objects.create(name='別の店', address='大阪府', created_by=cls.bob)
+        Tag.objects.create(name='醤油', created_by=cls.alice)
+
+    def setUp(self):
+        storage = tempfile.TemporaryDirectory()
+        self.addCleanup(storage.cleanup)
+        settings_override = override_settings(BLOB_STORAGE_ROOT=storage.name + '/blobs',
+                                              RECOMMENDATION_ROOT=storage.name + '/recommendations')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_blob_store.cache_clear()
+        self.addCleanup(get_blob_store.cache_clear)
+        cache.clear()
+
+    def urls(self):
+        return {
+            'store_list': reverse('store_list'),
+            'store_detail': reverse('store_detail', args=[self.store.id]),
+            'tags_api': reverse('tags_api'),
+        }
+
+    def etag(self, url):
+        # 1回目でCSRFのクッキーが発行されるので、2回目のETagを使う
+        self.client.get(url)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def test_matching_etag_returns_not_modified(self):
+        self.client.force_login(self.alice)
+        for name, url in self.urls().items():
+            with self.subTest(name=name):
+                etag = self.etag(url)
+                response = self.client.get(url, headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.content, b'')
+
+    def test_version_bump_changes_etag(self):
+        self.client.force_login(self.alice)
+        list_url, detail_url = self.urls()['store_list'], self.urls()['store_detail']
+        other_detail_url = reverse('store_detail', args=[self.other_store.id])
+        before = {url: self.etag(url) for url in [list_url, detail_url, other_detail_url]}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_store_version(self.store.id)
+        self.assertNotEqual(self.etag(list_url), before[list_url])
+        self.assertNotEqual(self.etag(detail_url), before[detail_url])
+        # 別の店舗の詳細は変わらない
+        self.assertEqual(self.etag(other_detail_url), before[other_detail_url])
+        self.assertEqual(self.client.get(detail_url, headers={'If-None-Match': before[detail_url]}).status_code, 200)
+
+        tags_etag = self.etag(self.urls()['tags_api'])
+        Tag.objects.create(name='味噌', created_by=self.bob)
+        self.assertNotEqual(self.etag(self.urls()['tags_api']), tags_etag)
+
+    def test_etag_differs_per_viewer(self):
+        for name in ['store_list', 'store_detail']:
+            url = self.urls()[name]
+            with self.subTest(name=name):
+                self.client.logout()
+                anonymous = self.etag(url)
+                self.client.force_login(self.alice)
+                alice = self.etag(url)
+                self.client.force_login(self.bob)
+                bob = self.etag(url)
+                self.assertEqual(len({anonymous, alice, bob}), 3)
+                # 他のユーザーのETagでは304にならない
+                self.assertEqual(self.client.get(url, headers={'If-None-Match': alice}).status_code, 200)
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='pass')
+        stores = [Store.objects.create(name=f'店{i}', address='東京都', created_by=cls.user) for i in range(7)]
+        # 作成日時が同じ行がページの境目をまたぐようにする
+        tied = timezone.now() - timedelta(days=1)
+        Store.objects.filter(id__in=[store.id for store in stores[1:6]]).update(created_at=tied)
+        cls.store = stores[0]
+        reviewers = [User.objects.create_user(f'reviewer{i}', password='pass') for i in range(7)]
+        reviews = [Review.objects.create(store=cls.store, user=reviewer, rating=3) for reviewer in reviewers]
+        Review.objects.filter(id__in=[review.id for review in reviews[:5]]).update(created_at=tied)
+
+    def setUp(self):
+        storage = tempfile.TemporaryDirectory()
+        self.addCleanup(storage.cleanup)
+        settings_override = override_settings(BLOB_STORAGE_ROOT=storage.name + '/blobs',
+                                              RECOMMENDATION_ROOT=storage.name + '/recommendations')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_blob_store.cache_clear()
+        self.addCleanup(get_blob_store.cache_clear)
+        self.client.force_login(self.user)
+
+    def pages(self):
+        return [
+            ('store_list', reverse('store_list'), 'stores', Store.objects.all()),
+            ('store_detail', reverse('store_detail', args=[self.store.id]), 'reviews', self.store.reviews.all()),
+        ]
+
+    def get_page(self, url, key, cursor=None):
+        params = {'format': 'json', 'page_size': 2}
+        if cursor is not None:
+            params['cursor'] = cursor
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [row['id'] for row in data[key]], data['next_cursor']
+
+    def test_walks_tied_created_at_without_gaps_or_duplicates(self):
+        for name, url, key, queryset in self.pages():
+            with self.subTest(name=name):
+                expected = list(queryset.order_by('-created_at', '-id').values_list('id', flat=True))
+                seen, cursor = [], None
+                while True:
+                    ids, cursor = self.get_page(url, key, cursor)
+                    seen += ids
+                    if cursor is None:
+                        break
+                self.assertEqual(seen, expected)
+
+    def test_invalid_cursor_returns_first_page(self):
+        for name, url, key, queryset in self.pages():
+            first_page = self.get_page(url, key)
+            # 2ページ目の位置を指すように作り、改ざんを見逃すと先頭ページと区別できるようにする
+            position = queryset.order_by('-created_at', '-id')[1]
+            cursors = [
+                'not-a-cursor', '%%%', 'カーソル', 'YWJj',
+                base64.urlsafe_b64encode(b'2026-01-01T00:00:00+09:00|abc').decode(),
+                base64.urlsafe_b64encode(b'\xff\xfe').decode(),
+                # 範囲外のID・タイムゾーンのない日時は encode_cursor() が作らない
+                encode_cursor(position.created_at, 2 ** 63),
+                encode_cursor(position.created_at, -1),
+                encode_cursor(timezone.make_naive(position.created_at), position.id),
+            ]
+            for cursor in cursors:
+                with self.subTest(name=name, cursor=cursor):
+                    self.assertEqual(self.get_page(url, key, cursor), first_page)
+
+
+class TagFacetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='pass')
+        cls.shoyu, cls.miso, cls.shio = [Tag.objects.create(name=name, created_by=cls.user)
+                                         for name in ['醤油', '味噌', '塩']]
+
+    def setUp(self):
+        storage = tempfile.TemporaryDirectory()
+        self.addCleanup(storage.cleanup)
+        settings_override = override_settings(BLOB_STORAGE_ROOT=storage.name + '/blobs',
+                                              RECOMMENDATION_ROOT=storage.name + '/recommendations')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_blob_store.cache_clear()
+        self.addCleanup(get_blob_store.cache_clear)
+        self.client.force_login(self.user)
+
+    def create_store(self, name, tags):
+        self.client.post(reverse('store_new'), {'name': name, 'address': '東京都', 'tags': [tag.id for tag in tags]})
+        return Store.objects.get(name=name)
+
+    def assertCountsMatchLinks(self, expected):
+        counts = dict(Tag.objects.values_list('id', 'store_count'))
+        self.assertEqual(counts, {tag_id: count_stores_by_tag().get(tag_id, 0) for tag_id in counts})
+        self.assertEqual(counts, {tag.id: count for tag, count in expected.items()})
+
+    def listed(self, tags, match):
+        params = {'format': 'json', 'tag': [tag.id for tag in tags], 'match': match}
+        return {row['name'] for row in self.client.get(reverse('store_list'), params).json()['stores']}
+
+    def test_store_count_follows_create_remove_and_delete(self):
+        both = self.create_store('醤油と味噌', [self.shoyu, self.miso])
+        shoyu_only = self.create_store('醤油だけ', [self.shoyu])
+        self.assertCountsMatchLinks({self.shoyu: 2, self.miso: 1, self.shio: 0})
+
+        self.client.post(reverse('remove_tag_from_store', args=[both.id]), {'tag_id': self.shoyu.id})
+        # 付いていないタグを外しても減らない
+        self.client.post(reverse('remove_tag_from_store', args=[both.id]), {'tag_id': self.shio.id})
+        self.assertCountsMatchLinks({self.shoyu: 1, self.miso: 1, self.shio: 0})
+
+        self.client.post(reverse('add_tag_to_store', args=[shoyu_only.id]), {'tag_id': self.shio.id})
+        self.client.post(reverse('add_tag_to_store', args=[shoyu_only.id]), {'tag_id': self.shio.id})
+        self.assertCountsMatchLinks({self.shoyu: 1, self.miso: 1, self.shio: 1})
+
+        self.client.post(reverse('store_delete', args=[shoyu_only.id]))
+        self.assertCountsMatchLinks({self.shoyu: 0, self.miso: 1, self.shio: 0})
+        self.assertEqual([(tag.name, tag.facet_count) for tag in tag_facets()], [('味噌', 1)])
+
+    def test_match_all_and_any(self):
+        self.create_store('醤油と味噌', [self.shoyu, self.miso])
+        self.create_store('醤油だけ', [self.shoyu])
+        self.create_store('味噌と塩', [self.miso, self.shio])
+        self.create_store('タグなし', [])
+
+        self.assertEqual(self.listed([self.shoyu, self.miso], MATCH_ALL), {'醤油と味噌'})
+        self.assertEqual(self.listed([self.shoyu, self.miso], MATCH_ANY), {'醤油と味噌', '醤油だけ', '味噌と塩'})
+        self.assertEqual(self.listed([self.shoyu, self.shio], MATCH_ALL), set())
+        self.assertEqual(self.listed([self.shio], MATCH_ALL), self.listed([self.shio], MATCH_ANY))
+
+
+class BenchmarkCommandTests(TestCase):
+    def test_runs_on_empty_database(self):
+        """
+        benchmark は自分でテスト用のDBを作って計測するので、テストのDBとは別のプロセスで実行する。
+        空のDBを指定しても、データを作成してすべてのURLを計測できる。
+        """
+        storage = tempfile.TemporaryDirectory()
+        self.addCleanup(storage.cleanup)
+        output = os.path.join(storage.name, 'benchmark.json')
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{storage.name}/empty.sqlite3',
+                   BLOB_STORAGE_ROOT=os.path.join(storage.name, 'blobs'),
+                   RECOMMENDATION_ROOT=os.path.join(storage.name, 'recommendations'))
+        completed = subprocess.run(
+            [sys.executable, 'manage.py', 'benchmark', '--scales', '1', '--repeat', '2', '--output', output],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, timeout=300,
+        )
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+        with open(output, encoding='utf-8') as f:
+            results = json.load(f)
+
+        [scale] = results['scales']
+        self.assertEqual(scale['counts']['stores'], 1)
+        names = {pattern.name for pattern in review_urls.urlpatterns if isinstance(pattern, URLPattern) and pattern.name}
+        self.assertEqual(names - set(scale['views']), set())
+        for label, result in scale['views'].items():
+            with self.subTest(label=label):
+                if 'skipped' in result:
+                    continue
+                self.assertLess(result['cold']['status'], 500)
+                self.assertLess(result['warm']['status'], 500)
+
+        # 同じ結果を基準にすれば、クエリ数が増えたビューはない
+        benchmark.Command(stderr=io.StringIO())._compare(output, results)
+
+    def test_rejects_empty_scale(self):
+        with self.assertRaisesMessage(CommandError, '1以上'):
+            call_command('benchmark', '--scales', '0', stdout=io.StringIO(), stderr=io.StringIO())
+
+
+class ExplainQueriesTests(TestCase):
+    def test_check_passes_on_empty_database(self):
+        out = io.StringIO()
+        call_command('explain_queries', '--check', stdout=out)
+        self.assertIn('すべてのクエリがインデックスを使っています', out.getvalue())
+        self.assertIn('[store_list] 1ページ目', out.getvalue())
+        self.assertIn('[dm_inbox] 受信箱', out.getvalue())
+
+    def test_view_option_limits_output(self):
+        out = io.StringIO()
+        call_command('explain_queries', '--view', 'notifications', '--sql', stdout=out)
+        headings = [line for line in out.getvalue().splitlines() if line.startswith('[')]
+        self.assertTrue(headings)
+        self.assertTrue(all(line.startswith('[notifications]') for line in headings))
+        self.assertIn('SELECT', out.getvalue())
+
+    def test_full_scan_fails_check(self):
+        command = explain_queries.Command()
+        unindexed = [('store_list', 'コメントで検索', Store.objects.filter(comment='醤油'))]
+        with mock.patch.object(explain_queries.Command, '_queries', return_value=unindexed):
+            with self.assertRaisesMessage(CommandError, '[store_list] コメントで検索'):
+                call_command(command, '--check', stdout=io.StringIO())
+        self.assertEqual(command._find_issues('SCAN reviews_store USING INDEX store_created_idx', 'sqlite'), [])
+        self.assertEqual(command._find_issues('USE TEMP B-TREE FOR ORDER BY', 'sqlite', allow_sort=True), [])
+        self.assertEqual(len(command._find_issues('USE TEMP B-TREE FOR ORDER BY', 'sqlite')), 1)
+        self.assertEqual(command._find_issues('Seq Scan on reviews_review', 'postgresql'),
+                         ['reviews_review を全件走査しています'])
+
+
+class ApiV1Tests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='pass')
+        cls.tag = Tag.objects.create(name='醤油', created_by=cls.user)
+        cls.store = Store.objects.create(name='テスト店', address='東京都', comment='長いコメント', created_by=cls.user)
+        cls.store.tags.add(cls.tag)
+        cls.empty_store = Store.objects.create(name='レビューなし', address='大阪府', created_by=cls.user)
+        for rating in [5, 3]:
+            review = Review.objects.create(store=cls.store, user=cls.user, rating=rating, comment='おいしい')
+            StoreRatingSummary.record_review(review)
+
+    def get(self, url, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        return response, ' '.join(query['sql'] for query in queries)
+
+    def test_store_list_all_fields(self):
+        response, _ = self.get(reverse('api_store_list'))
+        self.assertEqual(response.status_code, 200)
+        rows = {row['id']: row for row in response.json()['results']}
+        self.assertEqual(set(rows[self.store.id]), set(api.STORE_FIELDS))
+        rating = rows[self.store.id]['rating']
+        self.assertEqual((rating['review_count'], rating['average']), (2, 4.0))
+        self.assertEqual({row['rating']: row['count'] for row in rating['counts']}, {5: 1, 4: 0, 3: 1, 2: 0, 1: 0})
+        self.assertEqual(rows[self.store.id]['tags'], [{'id': self.tag.id, 'name': '醤油', 'color': self.tag.color}])
+        self.assertEqual(rows[self.empty_store.id]['rating']['review_count'], 0)
+
+    def test_sparse_fields_select_only_needed_columns(self):
+        response, sql = self.get(reverse('api_store_list'), fields='name,id,name')
+        self.assertEqual(response.json()['results'][0], {'name': 'レビューなし', 'id': self.empty_store.id})
+        self.assertNotIn('comment', sql)
+        self.assertNotIn('reviews_storeratingsummary', sql)
+        self.assertNotIn('reviews_store_tags', sql)
+
+        response, sql = self.get(reverse('api_store_reviews', args=[self.store.id]), fields='rating,user')
+        self.assertEqual([set(row) for row in response.json()['results']], [{'rating', 'user'}] * 2)
+        self.assertEqual(response.json()['results'][0]['user'], {'id': self.user.id, 'username': 'owner'})
+        self.assertNotIn('comment', sql)
+
+    def test_invalid_parameters_return_400(self):
+        for url, params in [
+            (reverse('api_store_list'), {'fields': 'id,secret'}),
+            (reverse('api_store_list'), {'tag': 'abc'}),
+            (reverse('api_store_reviews', args=[self.store.id]), {'fields': 'password'}),
+        ]:
+            with self.subTest(url=url, params=params):
+                response, _ = self.get(url, **params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+
+    def test_missing_store_returns_404(self):
+        response, _ = self.get(reverse('api_store_reviews', args=[self.empty_store.id + 100]))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {'error': '店舗が見つかりません'})
+        # 店舗があってレビューがないだけなら空の一覧
+        response, _ = self.get(reverse('api_store_reviews', args=[self.empty_store.id]))
+        self.assertEqual(response.json(), {'results': [], 'next_cursor': None})
+
+
+class PageCacheVersionTests(TestCase):
+    def setUp(self):
+        location = tempfile.TemporaryDirectory()
+        self.addCleanup(location.cleanup)
+        settings_override = override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location.name,
+        }})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_bump_is_visible_to_other_workers(self):
+        """ファイルのキャッシュなら、あるワーカーで上げたバージョンを別のワーカー（別の接続）から読める"""
+        other_worker = caches.create_connection('default')
+        store_version, global_version = get_store_version(1), get_global_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_store_version(1)
+        self.assertNotEqual(other_worker.get('store_pages:store:1:version'), store_version)
+        self.assertNotEqual(other_worker.get('store_pages:version'), global_version)
+        self.assertEqual(get_store_version(1), other_worker.get('store_pages:store:1:version'))
+
+    def test_bumps_never_reuse_a_version(self):
+        seen = {get_store_version(1)}
+        for _ in range(20):
+            with self.captureOnCommitCallbacks(execute=True):
+                bump_store_version(1)
+            seen.add(get_store_version(1))
+        self.assertEqual(len(seen), 21)
+
+    def test_locmem_with_multiple_workers_is_an_error(self):
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(CACHES=locmem, WEB_CONCURRENCY=2):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['reviews.E001'])
+        with override_settings(CACHES=locmem, WEB_CONCURRENCY=1):
+            self.assertEqual(check_shared_cache(None), [])
+        with override_settings(WEB_CONCURRENCY=4):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class NotificationStreamTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reader', password='pass')
+        UserProfile.objects.create(user=cls.user)
+
+    def test_wsgi_returns_no_content(self):
+        """WSGIではストリームを開かず204を返し、ページはポーリングする"""
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('notification_stream'))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(response.streaming)
+        page = self.client.get(reverse('store_list'))
+        self.assertContains(page, 'const sseEnabled = false;')
+
+    async def test_asgi_streams_unread_count(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('notification_stream'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = aiter(response.streaming_content)
+        self.assertEqual(await anext(content), b'data: {"unread_count": 0}\n\n')
+        await content.aclose()
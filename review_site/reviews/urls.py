@@ -1,5 +1,5 @@
 # reviews/urls.py
-from django.urls import path
+from django.urls import path, re_path
 from django.contrib.auth import views as auth_views
 from . import views
 
@@ -41,11 +41,23 @@ urlpatterns = [
     path('follow/<int:user_id>/', views.follow_user, name='follow_user'),
     path('notifications/', views.notifications_view, name='notifications'),
     path('api/notifications/count/', views.get_unread_notifications_count, name='unread_notifications_count'),
+    path('api/notifications/stream/', views.notification_stream, name='notification_stream'),
     
     # ユーザー一覧ページ
     path('users/', views.user_list, name='user_list'),
 
     # DM機能
+    path('dm/', views.dm_inbox, name='dm_inbox'),
     path('dm/send/<int:user_id>/', views.send_dm, name='send_dm'),
     path('dm/delete/<int:message_id>/', views.delete_dm, name='delete_dm'),
+    path('dm/<int:conversation_id>/messages/', views.dm_messages, name='dm_messages'),
+    path('dm/<int:conversation_id>/stream/', views.dm_stream, name='dm_stream'),
+    path('dm/<int:conversation_id>/read/', views.dm_mark_read, name='dm_mark_read'),
+
+    # 読み取り専用API（v1）
+    path('api/v1/stores/', views.api_store_list, name='api_store_list'),
+    path('api/v1/stores/<int:store_id>/reviews/', views.api_store_reviews, name='api_store_reviews'),
+
+    # 画像配信（ブロブストレージ）
+    re_path(r'^images/(?P<key>[0-9a-f]{64})/$', views.blob_image, name='blob_image'),
 ]
\ No newline at end of file
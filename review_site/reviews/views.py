@@ -1,67 +1,180 @@
 # reviews/views.py
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
+from django.utils.http import urlencode
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.http import JsonResponse
-from django.db.models import Q, Count, Prefetch
+from django.http import JsonResponse, FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.views.decorators.http import require_GET, condition
+from django.views.decorators.cache import cache_control
+from django.db.models import Q, Count, Prefetch, prefetch_related_objects
+from django.db import transaction
 from django.contrib import messages
-from .models import Store, Review, Reaction, UserProfile, Follow, Notification, Tag, Conversation, DirectMessage
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from .models import Store, Review, Reaction, UserProfile, Follow, Notification, Tag, Conversation, DirectMessage, StoreRatingSummary
 from .forms import StoreForm, ReviewForm, UserProfileForm, UserForm, TagForm
 from .dm_forms import DirectMessageForm
-import base64
-import io
-from PIL import Image
+from .blobstore import get_blob_store, is_valid_blob_key
+from .follow_graph import FollowGraph, get_follow_graph, invalidate_follow_graph
+from . import people_suggestions
+from . import store_recommendations
+from .pagination import paginate_by_keyset, paginate_by_field, get_page_size
+from .search import get_search_backend, update_search_index, remove_from_search_index
+from .image_processing import STORE_IMAGE_SIZE, AVATAR_IMAGE_SIZE
+from .image_queue import enqueue_image, mark_processing
+from .notifications import notify, get_unread_count, mark_all_read, notification_channel
+from .notification_fanout import enqueue_review_fanout
+from .pubsub import get_broker
+from .sse import can_stream, event_stream_response, stream_unavailable
+from .page_cache import (
+    bump_store_version, bump_user_store_versions, cache_anonymous_page, render_store_fragments,
+    store_detail_version, store_list_version,
+)
+from .sql_instrumentation import query_budget
+from .conditional import (
+    tags_etag, tags_last_modified, store_list_etag, store_detail_etag, api_stores_etag, api_store_reviews_etag,
+)
+from . import api
+from .tag_facets import (
+    MATCH_ALL, MATCH_ANY, parse_tag_ids, filter_stores_by_tags, tag_facets,
+    add_store_tag, remove_store_tag, save_store_form_tags, discard_store_tags,
+)
+from .direct_messages import (
+    MAX_MESSAGES_PER_FETCH, conversation_channel, message_to_dict, messages_since, mark_conversation_read,
+    publish_message, publish_deleted,
+)
+import json
 
 # 店一覧
+# 内容が変わっていなければ304を返す（毎回再検証させる）
+@query_budget(7)
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=store_list_etag)
+@cache_anonymous_page('store_list', store_list_version)
 def store_list(request):
     query = request.GET.get('q')
+    tag_ids = parse_tag_ids(request.GET.getlist('tag'))
+    match = MATCH_ANY if request.GET.get('match') == MATCH_ANY else MATCH_ALL
     
-    # prefetch_relatedとselect_relatedで関連オブジェクトを効率的に取得
-    stores = Store.objects.select_related('created_by').prefetch_related('tags', 'reviews')
+    # select_relatedで関連オブジェクトを効率的に取得（タグはカードのキャッシュがない店舗だけ後で読む）
+    # 評価統計はレビューを数えず、集計テーブル（StoreRatingSummary）を結合して読むだけにする
+    stores = Store.objects.select_related('created_by', 'created_by__profile', 'rating_summary')
     
+    # 店名・住所・コメント・タグ名を検索インデックスで検索
     if query:
-        stores = stores.filter(
-            Q(name__icontains=query) | 
-            Q(address__icontains=query)
-        )
+        stores = get_search_backend().filter(stores, query)
+    searched_stores = stores
     
-    stores = stores.order_by('-created_at')
+    # タグで絞り込む（AND: すべてのタグを持つ店、OR: いずれかのタグを持つ店）
+    stores = filter_stores_by_tags(stores, tag_ids, match)
     
-    # 各店舗の評価統計を計算
-    for store in stores:
-        rating_stats = {}
-        reviews = store.reviews.all()
-        total_reviews = reviews.count()
-        
-        # 評価統計を安全に計算
-        try:
-            for rating_value, rating_label in Review.RATING_CHOICES:
-                count = reviews.filter(rating=rating_value).count()
-                if count > 0:
-                    rating_stats[rating_value] = {
-                        'label': rating_label,
-                        'count': count
-                    }
-            
-            # 評価をカウント数でソートし、上位3つのみを取得
-            sorted_ratings = sorted(rating_stats.items(), key=lambda x: x[1]['count'], reverse=True)
-            store.rating_stats = dict(sorted_ratings[:3])
-        except Exception as e:
-            # エラーが発生した場合は空の統計を設定
-            print(f"Error calculating rating stats for store {store.id}: {e}")
-            store.rating_stats = {}
-        
-        store.total_reviews = total_reviews
+    # 検索結果の件数（検索・絞り込み時のみ数える）
+    result_count = stores.count() if query or tag_ids else None
+    
+    # (created_at, id) のカーソルで1ページ分だけ取得する
+    page = paginate_by_keyset(stores, request.GET.get('cursor'), get_page_size(request))
+    
+    # 各店舗の評価統計（上位3つ）を組み立てる（追加のクエリは発生しない）
+    for store in page:
+        summary = store.get_rating_summary()
+        store.total_reviews = summary.review_count
+        store.rating_stats = summary.get_rating_stats(limit=3)
+    
+    # 「もっと見る」用のJSON
+    if request.GET.get('format') == 'json':
+        prefetch_related_objects(page.object_list, 'tags')
+        return JsonResponse({
+            'stores': [_store_to_dict(store) for store in page],
+            'next_cursor': page.next_cursor,
+        })
+    
+    # 店舗カードは店舗のバージョンごとにキャッシュした断片を使う
+    fragments = render_store_fragments(
+        'store_card', page.object_list, 'reviews/store_card.html',
+        prepare=lambda missed: prefetch_related_objects(missed, 'tags'),
+    )
+    for store in page:
+        store.card_html = fragments[store.id]
+    
+    # サイドバーのタグと店舗数（検索していなければ集計済みの Tag.store_count を読むだけ）
+    facets = tag_facets(searched_stores if query else None)
+    for tag in facets:
+        tag.is_selected = tag.id in tag_ids
+        toggled = [tag_id for tag_id in tag_ids if tag_id != tag.id] if tag.is_selected else tag_ids + [tag.id]
+        tag.toggle_query = _store_list_query(query, toggled, match)
+    
+    # ログインユーザーへのおすすめ（検索・絞り込みをしていない1ページ目だけ）
+    recommended_stores = []
+    if request.user.is_authenticated and not (query or tag_ids or request.GET.get('cursor')):
+        recommended_stores = store_recommendations.recommended_stores(request.user.id)
     
     return render(request, 'reviews/store_list.html', {
-        'stores': stores,
-        'query': query
+        'stores': page.object_list,
+        'recommended_stores': recommended_stores,
+        'page': page,
+        'query': query,
+        'result_count': result_count,
+        'facets': facets,
+        'tag_ids': tag_ids,
+        'match': match,
+        'list_query': _store_list_query(query, tag_ids, match),
+        'match_all_query': _store_list_query(query, tag_ids, MATCH_ALL),
+        'match_any_query': _store_list_query(query, tag_ids, MATCH_ANY),
     })
 
+def _store_list_query(query, tag_ids, match):
+    """店一覧のクエリ文字列（検索語・タグ・AND/OR）を作る"""
+    params = []
+    if query:
+        params.append(('q', query))
+    params.extend(('tag', tag_id) for tag_id in tag_ids)
+    if match == MATCH_ANY and tag_ids:
+        params.append(('match', MATCH_ANY))
+    return urlencode(params)
+
+def _store_to_dict(store):
+    return {
+        'id': store.id,
+        'name': store.name,
+        'address': store.address,
+        'url': reverse('store_detail', args=[store.id]),
+        'image_url': store.get_image_url(),
+        'created_by': store.created_by.username,
+        'created_at': store.created_at.isoformat(),
+        'total_reviews': store.total_reviews,
+        'rating_stats': [
+            {'rating': rating_value, 'label': stats['label'], 'count': stats['count']}
+            for rating_value, stats in store.rating_stats.items()
+        ],
+        'tags': [{'id': tag.id, 'name': tag.name, 'color': tag.color} for tag in store.tags.all()],
+    }
+
+def _review_to_dict(review):
+    return {
+        'id': review.id,
+        'rating': review.rating,
+        'rating_label': review.get_rating_display(),
+        'comment': review.comment,
+        'user': {'id': review.user_id, 'username': review.user.username},
+        'created_at': review.created_at.isoformat(),
+        'reaction_counts': review.get_reaction_counts(),
+        'user_reaction': review.user_reaction,
+        'is_friend': review.is_friend,
+    }
+
 # 店の詳細・レビュー投稿
+def _store_detail_page_version(request, store_id):
+    # 類似店舗の一覧は全体を再構築すると変わる
+    return f'{store_detail_version(request, store_id)}.{store_recommendations.index_version()}'
+
+@query_budget(10)
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=store_detail_etag)
+@cache_anonymous_page('store_detail', _store_detail_page_version)
 def store_detail(request, store_id):
-    store = get_object_or_404(Store, id=store_id)
+    store = get_object_or_404(Store.objects.select_related('created_by', 'created_by__profile', 'rating_summary'), id=store_id)
     
     if request.method == 'POST':
         if not request.user.is_authenticated:
@@ -72,60 +185,65 @@ def store_detail(request, store_id):
             review = form.save(commit=False)
             review.store = store
             review.user = request.user
-            review.save()
+            # レビューの保存と評価集計の更新は同じトランザクションで行う
+            with transaction.atomic():
+                review.save()
+                StoreRatingSummary.record_review(review)
+                bump_store_version(store.id)
+                # 類似店舗の再計算とフォロワーへの通知はコミット後にバックグラウンドで行う
+                store_recommendations.record_review(review)
+                enqueue_review_fanout(review)
             return redirect('store_detail', store_id=store.id)
     else:
         form = ReviewForm()
     
-    # レビューを取得
-    reviews = store.reviews.all()
+    # レビューを新しい順に1ページ分だけ取得（リアクション数はReviewのカウンタ列に入っている）
+    page = paginate_by_keyset(
+        store.reviews.select_related('user', 'user__profile'),
+        request.GET.get('cursor'),
+        get_page_size(request),
+    )
+    reviews = page.object_list
+    
+    # ログインユーザー自身のリアクションを1回のクエリでまとめて取得
+    user_reactions = {}
+    if request.user.is_authenticated:
+        user_reactions = dict(
+            Reaction.objects.filter(review__in=reviews, user=request.user).values_list('review_id', 'reaction_type')
+        )
+    
+    # 友達関係はログインユーザーのフォロー関係を1回だけ読み込んでメモリ上で判定する
+    follow_graph = get_follow_graph(request)
     
     # 各レビューの情報を計算
     for review in reviews:
-        try:
-            # リアクション数を計算
-            review.good_count = review.reactions.filter(reaction_type='good').count()
-            review.bad_count = review.reactions.filter(reaction_type='bad').count()
-            review.question_count = review.reactions.filter(reaction_type='question').count()
-            
-            # 友達関係を確認
-            if request.user.is_authenticated and request.user != review.user:
-                is_following = Follow.objects.filter(follower=request.user, following=review.user).exists()
-                is_followed_by = Follow.objects.filter(follower=review.user, following=request.user).exists()
-                review.is_friend = is_following and is_followed_by
-            else:
-                review.is_friend = False
-        except Exception as e:
-            print(f"Error processing review {review.id}: {e}")
-            review.good_count = 0
-            review.bad_count = 0
-            review.question_count = 0
-            review.is_friend = False
-    
-    # 評価統計を構築
-    rating_stats = {}
-    try:
-        for rating_value, rating_label in Review.RATING_CHOICES:
-            count = reviews.filter(rating=rating_value).count()
-            if count > 0:
-                rating_stats[rating_value] = {
-                    'label': rating_label,
-                    'count': count
-                }
-        
-        
-        # カウント数でソート
-        sorted_ratings = sorted(rating_stats.items(), key=lambda x: x[1]['count'], reverse=True)
-        rating_stats = dict(sorted_ratings)
-    except Exception as e:
-        print(f"Error building rating stats: {e}")
-        rating_stats = {}
+        review.user_reaction = user_reactions.get(review.id)
+        review.is_friend = follow_graph.is_friend(review.user_id)
+    
+    # 「もっと見る」用のJSON
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'reviews': [_review_to_dict(review) for review in reviews],
+            'next_cursor': page.next_cursor,
+        })
+    
+    # 評価統計を構築（件数の多い順）
+    rating_stats = store.get_rating_stats()
+    
+    # 店舗情報はキャッシュした断片を使う（オーナー用の操作は断片の外で表示する）
+    store.info_html = render_store_fragments(
+        'store_info', [store], 'reviews/store_info.html',
+        prepare=lambda missed: prefetch_related_objects(missed, 'tags'),
+    )[store.id]
     
     return render(request, 'reviews/store_detail.html', {
         'store': store, 
         'form': form, 
         'reviews': reviews,
-        'rating_stats': rating_stats
+        'page': page,
+        'rating_stats': rating_stats,
+        # 類似店舗は保存済みの上位の一覧を読むだけ（表示する行もキャッシュ済み）
+        'similar_stores': store_recommendations.similar_stores(store.id),
     })
 
 # 店の登録
@@ -137,22 +255,18 @@ def store_new(request):
             store = form.save(commit=False)
             store.created_by = request.user
             
-            # 画像をBase64に変換して保存
-            if form.cleaned_data['image']:
-                image_file = form.cleaned_data['image']
-                # 画像をリサイズ
-                img = Image.open(image_file)
-                img = img.convert('RGB')
-                img.thumbnail((800, 600), Image.Resampling.LANCZOS)
-                
-                # Base64に変換
-                buffer = io.BytesIO()
-                img.save(buffer, format='JPEG', quality=85)
-                image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                store.image_data = image_base64
+            # 画像は「処理中」にして保存し、変換はワーカーで行う
+            image_file = form.cleaned_data['image']
+            if image_file:
+                mark_processing(store, 'image_status', 'image_queued_at')
             
             store.save()
-            form.save_m2m()  # ManyToManyフィールドを保存
+            save_store_form_tags(form, store)  # タグを保存し、タグごとの店舗数も更新
+            update_search_index(store)
+            bump_store_version(store.id)
+            if image_file:
+                enqueue_image(store, image_file, STORE_IMAGE_SIZE, 'image_key', 'image_status', 'image_queued_at',
+                              on_complete=bump_store_version)
             return redirect('store_list')
     else:
         form = StoreForm()
@@ -175,11 +289,15 @@ def tag_new(request):
 # タグ一覧
 @login_required
 def tag_list(request):
-    tags = Tag.objects.all().order_by('name')
+    tags = Tag.objects.select_related('created_by').order_by('name')
     return render(request, 'reviews/tag_list.html', {'tags': tags})
 
 # タグAPI（JSON）
+# タグの件数と最終作成日時が変わっていなければ、一覧を読まずに304を返す
+@query_budget(4)
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=tags_etag, last_modified_func=tags_last_modified)
 def tags_api(request):
     tags = Tag.objects.all().order_by('name')
     tags_data = [
@@ -210,7 +328,9 @@ def add_tag_to_store(request, store_id):
         if tag_id:
             try:
                 tag = Tag.objects.get(id=tag_id)
-                store.tags.add(tag)
+                add_store_tag(store, tag)
+                update_search_index(store)
+                bump_store_version(store.id)
                 
                 # 現在のタグリストを返す
                 current_tags = [
@@ -262,7 +382,10 @@ def review_delete(request, review_id):
         # POSTリクエストの場合のみ削除を実行 (安全のため)
         if request.method == 'POST':
             store_id = review.store.id  # 削除後に戻るため、店のIDを先に取得
-            review.delete()
+            with transaction.atomic():
+                review.delete()
+                StoreRatingSummary.discard_review(review)
+                bump_store_version(store_id)
             return redirect('store_detail', store_id=store_id)
             
     # 条件に合わない場合は、元の店の詳細ページにリダイレクト
@@ -283,20 +406,21 @@ def store_edit(request, store_id):
             # form.save() でコメントを含む全てのフィールドが保存されます
             store = form.save(commit=False)
             
-            # 新しい画像がアップロードされた場合のみ画像データを更新
-            if form.cleaned_data.get('image'):
-                image_file = form.cleaned_data['image']
-                img = Image.open(image_file)
-                img = img.convert('RGB')
-                img.thumbnail((800, 600), Image.Resampling.LANCZOS)
-                
-                buffer = io.BytesIO()
-                img.save(buffer, format='JPEG', quality=85)
-                image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                store.image_data = image_base64
+            # 新しい画像がアップロードされた場合のみ画像を更新（処理が終わるまでは元の画像を表示）
+            # 画像のキーは保存しない（読み込んだ後に処理が終わった画像を古いキーで戻さないため）
+            image_file = form.cleaned_data.get('image')
+            update_fields = ['name', 'address', 'comment', 'website_url']
+            if image_file:
+                mark_processing(store, 'image_status', 'image_queued_at')
+                update_fields += ['image_status', 'image_queued_at']
             
-            store.save()
-            form.save_m2m()  # タグを保存
+            store.save(update_fields=update_fields)
+            save_store_form_tags(form, store)  # タグを保存し、タグごとの店舗数も更新
+            update_search_index(store)
+            bump_store_version(store.id)
+            if image_file:
+                enqueue_image(store, image_file, STORE_IMAGE_SIZE, 'image_key', 'image_status', 'image_queued_at',
+                              on_complete=bump_store_version)
             return redirect('store_detail', store_id=store.id)
     else:
         form = StoreForm(instance=store)
@@ -319,7 +443,12 @@ def store_delete(request, store_id):
 
     # POSTリクエストの場合のみ削除を実行
     if request.method == 'POST':
-        store.delete()
+        store_id = store.id
+        with transaction.atomic():
+            discard_store_tags(store_id)
+            store.delete()
+        remove_from_search_index(store_id)
+        bump_store_version(store_id)
         return redirect('store_list')
     
     # GETリクエストの場合は、確認ページを表示
@@ -338,34 +467,9 @@ def add_reaction(request, review_id):
     if reaction_type not in ['good', 'bad', 'question']:
         return JsonResponse({'error': '不正なリアクションです'}, status=400)
     
-    # 既存のリアクションを削除して新しいリアクションを追加（または同じなら削除）
-    existing_reaction = Reaction.objects.filter(review=review, user=request.user).first()
-    
-    if existing_reaction:
-        if existing_reaction.reaction_type == reaction_type:
-            # 同じリアクションなら削除（取り消し）
-            existing_reaction.delete()
-            action = 'removed'
-        else:
-            # 違うリアクションなら更新
-            existing_reaction.reaction_type = reaction_type
-            existing_reaction.save()
-            action = 'updated'
-    else:
-        # 新しいリアクションを作成
-        Reaction.objects.create(
-            review=review,
-            user=request.user,
-            reaction_type=reaction_type
-        )
-        action = 'added'
-    
-    # 各リアクションの数を取得
-    reaction_counts = {
-        'good': review.reactions.filter(reaction_type='good').count(),
-        'bad': review.reactions.filter(reaction_type='bad').count(),
-        'question': review.reactions.filter(reaction_type='question').count(),
-    }
+    # リアクションの追加・取り消し・変更とカウンタの更新をまとめて行う
+    action, reaction_counts = Reaction.toggle(review.id, request.user, reaction_type)
+    bump_store_version(review.store_id)
     
     return JsonResponse({
         'action': action,
@@ -393,22 +497,20 @@ def profile_view(request):
         profile_form = UserProfileForm(request.POST, request.FILES, instance=profile)
         
         if profile_form.is_valid():
-            # プロフィール画像の処理
-            if 'avatar' in request.FILES:
-                image_file = request.FILES['avatar']
-                img = Image.open(image_file)
-                img = img.convert('RGB')
-                
-                # 画像サイズを調整
-                img.thumbnail((300, 300))
-                
-                # Base64に変換
-                buffer = io.BytesIO()
-                img.save(buffer, format='JPEG', quality=85)
-                img_data = base64.b64encode(buffer.getvalue()).decode()
-                profile.avatar_data = img_data
-            
-            profile_form.save()
+            # プロフィール画像は「処理中」にして保存し、変換はワーカーで行う
+            image_file = request.FILES.get('avatar')
+            profile = profile_form.save(commit=False)
+            # フォームの項目だけを保存する（同時に更新されたフォロワー数などを読み込んだ時点の値で上書きしない）
+            update_fields = ['bio', 'birth_date', 'updated_at']
+            if image_file:
+                mark_processing(profile, 'avatar_status', 'avatar_queued_at')
+                update_fields += ['avatar_status', 'avatar_queued_at']
+            profile.save(update_fields=update_fields)
+            if image_file:
+                # アイコンは店舗カードやレビューにも表示されるので、反映後に関係する店舗のキャッシュを破棄する
+                user_id = request.user.id
+                enqueue_image(profile, image_file, AVATAR_IMAGE_SIZE, 'avatar_key', 'avatar_status',
+                              'avatar_queued_at', on_complete=lambda pk: bump_user_store_versions(user_id))
             messages.success(request, 'プロフィールが更新されました！')
             return redirect('profile')
     else:
@@ -419,10 +521,45 @@ def profile_view(request):
         'profile': profile
     })
 
+def _people_suggestions(request, limit=5, exclude_ids=()):
+    """ログイン中のユーザーへの「知り合いかも」（推薦は保存済みの配列から読み、名前とアイコンだけを1クエリで読む）"""
+    if not request.user.is_authenticated:
+        return []
+    suggestions = [
+        suggestion for suggestion in people_suggestions.suggestions_for(request.user.id, limit + len(exclude_ids))
+        if suggestion.user_id not in exclude_ids
+    ][:limit]
+    if not suggestions:
+        return []
+    users = {
+        row['id']: row
+        for row in User.objects.filter(id__in=[suggestion.user_id for suggestion in suggestions])
+        .values('id', 'username', 'profile__avatar_key')
+    }
+    result = []
+    for suggestion in suggestions:
+        row = users.get(suggestion.user_id)
+        if row is None:
+            # 再構築後に削除されたユーザー
+            continue
+        avatar_key = row['profile__avatar_key']
+        result.append({
+            'id': row['id'],
+            'username': row['username'],
+            'avatar_url': reverse('blob_image', args=[avatar_key]) if avatar_key else None,
+            'mutual_count': suggestion.mutual_count,
+            'shared_store_count': suggestion.shared_store_count,
+        })
+    return result
+
+@query_budget(8)
 def user_profile_view(request, user_id):
     """他のユーザーのプロフィール表示"""
-    profile_user = get_object_or_404(User, id=user_id)
-    profile, created = UserProfile.objects.get_or_create(user=profile_user)
+    profile_user = get_object_or_404(User.objects.select_related('profile'), id=user_id)
+    profile = getattr(profile_user, 'profile', None)
+    if profile is None:
+        # プロフィールがない場合は作成（フォロー関係があるユーザーのプロフィールはフォロー時に作られている）
+        profile, created = UserProfile.objects.get_or_create(user=profile_user)
     
     # フォロー状況を確認
     is_following = False
@@ -430,17 +567,14 @@ def user_profile_view(request, user_id):
     is_friend = False
     
     if request.user.is_authenticated:
-        is_following = Follow.objects.filter(follower=request.user, following=profile_user).exists()
-        is_followed_by = Follow.objects.filter(follower=profile_user, following=request.user).exists()
-        is_friend = is_following and is_followed_by  # 相互フォローの場合は友達
+        follow_graph = get_follow_graph(request)
+        is_following = follow_graph.is_following(profile_user.id)
+        is_followed_by = follow_graph.is_followed_by(profile_user.id)
+        is_friend = follow_graph.is_friend(profile_user.id)  # 相互フォローの場合は友達
     
     # ユーザーの投稿した店舗とレビューを取得
-    user_stores = Store.objects.filter(created_by=profile_user).order_by('-created_at')[:5]
-    user_reviews = Review.objects.filter(user=profile_user).order_by('-created_at')[:5]
-    
-    # フォロワー・フォロー数を取得
-    followers_count = Follow.objects.filter(following=profile_user).count()
-    following_count = Follow.objects.filter(follower=profile_user).count()
+    user_stores = Store.objects.filter(created_by=profile_user).select_related('rating_summary').order_by('-created_at')[:5]
+    user_reviews = Review.objects.filter(user=profile_user).select_related('store').order_by('-created_at')[:5]
     
     return render(request, 'reviews/user_profile.html', {
         'profile_user': profile_user,
@@ -450,10 +584,13 @@ def user_profile_view(request, user_id):
         'is_friend': is_friend,
         'user_stores': user_stores,
         'user_reviews': user_reviews,
-        'followers_count': followers_count,
-        'following_count': following_count,
+        # フォロワー・フォロー数はUserProfileのカウンタを読むだけ
+        'followers_count': profile.followers_count,
+        'following_count': profile.following_count,
+        'people_suggestions': _people_suggestions(request, exclude_ids={profile_user.id}),
     })
 
+@query_budget(13)
 @login_required
 def follow_user(request, user_id):
     """ユーザーをフォロー/アンフォロー"""
@@ -464,34 +601,41 @@ def follow_user(request, user_id):
         if target_user == request.user:
             return JsonResponse({'success': False, 'message': '自分自身をフォローすることはできません。'})
         
-        follow_obj, created = Follow.objects.get_or_create(
-            follower=request.user,
-            following=target_user
-        )
+        # 相手が自分をフォローしているか（切り替えでは変わらない。キャッシュがなければ相手の分だけ読む）
+        follow_graph = FollowGraph.for_user_ids(request.user, [target_user.id])
+        
+        # フォロー・フォロー解除と両者のカウンタの更新を1つのトランザクションで行う
+        is_following, followers_count = Follow.toggle(request.user.id, target_user.id)
+        # Noneは同時に送られた同じフォローに先を越された場合で、通知やキャッシュの破棄はそちらのリクエストが行う
+        changed = is_following is not None
+        if not changed:
+            is_following = True
         
-        if created:
+        if is_following:
             # フォロー通知を作成
-            Notification.objects.create(
-                user=target_user,
-                from_user=request.user,
-                notification_type='follow',
-                message=f'{request.user.username}があなたをフォローしました。'
-            )
+            if changed:
+                notify(
+                    user=target_user,
+                    from_user=request.user,
+                    notification_type='follow',
+                    message=f'{request.user.username}があなたをフォローしました。'
+                )
             action = 'followed'
             message = f'{target_user.username}をフォローしました。'
         else:
-            # 既にフォローしている場合はアンフォロー
-            follow_obj.delete()
             action = 'unfollowed'
             message = f'{target_user.username}のフォローを解除しました。'
         
-        # フォロワー数を更新
-        followers_count = Follow.objects.filter(following=target_user).count()
+        if changed:
+            # 両者のフォロー関係のキャッシュを破棄
+            invalidate_follow_graph(request.user.id, target_user.id)
+            # 両者の「知り合いかも」を計算し直す（保存済みの配列から計算するのでDBは読まない）
+            transaction.on_commit(
+                lambda: people_suggestions.apply_follow_change(request.user.id, target_user.id, is_following)
+            )
         
-        # 友達状態を確認
-        is_following = Follow.objects.filter(follower=request.user, following=target_user).exists()
-        is_followed_by = Follow.objects.filter(follower=target_user, following=request.user).exists()
-        is_friend = is_following and is_followed_by
+        # 友達状態を確認（相互フォロー）
+        is_friend = is_following and follow_graph.is_followed_by(target_user.id)
         
         return JsonResponse({
             'success': True,
@@ -504,36 +648,65 @@ def follow_user(request, user_id):
     
     return JsonResponse({'success': False, 'message': '無効なリクエストです。'})
 
+@query_budget(4)
 @login_required
 def notifications_view(request):
-    """通知一覧（最適化版）"""
-    # 未読通知を効率的に取得・処理
-    unread_notifications = Notification.objects.filter(user=request.user, is_read=False)
-    unread_count = unread_notifications.count()
-    
-    if unread_count > 0:
-        # 一括で既読にして削除
-        unread_notifications.update(is_read=True)
-        unread_notifications.delete()
-        confirmation_message = f"{unread_count}件の通知を確認しました。"
-    else:
-        confirmation_message = None
+    """通知一覧（既読の通知も残し、新しい順に1ページずつ表示する）"""
+    # 先にページを読むので、このページの未読の通知は「新着」として表示される
+    page = paginate_by_keyset(
+        Notification.objects.filter(user=request.user).select_related('from_user', 'from_user__profile'),
+        request.GET.get('cursor'),
+        get_page_size(request),
+    )
     
-    # 残りの通知（基本的に空）
-    remaining_notifications = Notification.objects.filter(user=request.user)
+    # 未読の通知をまとめて既読にする（1回のUPDATE。未読がなければ行を書き換えない）
+    marked_count = mark_all_read(request.user.id)
     
     return render(request, 'reviews/notifications.html', {
-        'notifications': remaining_notifications,
-        'had_unread': unread_count > 0,
-        'confirmation_message': confirmation_message
+        'notifications': page.object_list,
+        'page': page,
+        'had_unread': marked_count > 0,
+        'confirmation_message': f"{marked_count}件の新しい通知を既読にしました。" if marked_count else None,
+        'retention_days': getattr(settings, 'NOTIFICATION_RETENTION_DAYS', 90),
     })
 
+@query_budget(3)
 @login_required
 def get_unread_notifications_count(request):
-    """未読通知数を取得"""
-    count = Notification.objects.filter(user=request.user, is_read=False).count()
+    """未読通知数を取得（キャッシュしたカウンタから読む）"""
+    count = get_unread_count(request.user.id)
     return JsonResponse({'count': count})
 
+async def notification_stream(request):
+    """
+    未読通知数をServer-Sent Eventsで送り続ける（ASGIのときだけ。WSGIでは204を返し、ページ側がポーリングする）。
+    接続時に現在の未読数を送り、その後は通知が作成・既読化されたときだけ送る。
+    待機中はイベントループ上で眠っているだけなので、接続しているだけのクライアントはほぼコストがかからない。
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponse(status=401)
+    if not can_stream(request):
+        return stream_unavailable()
+
+    heartbeat = getattr(settings, 'SSE_HEARTBEAT_INTERVAL', 25)
+
+    async def events():
+        # 購読を始めてから現在の未読数を読むことで、その間の更新を取りこぼさない
+        subscription = get_broker().subscribe(notification_channel(user.id))
+        async with subscription:
+            count = await sync_to_async(get_unread_count)(user.id)
+            yield f"data: {json.dumps({'unread_count': count})}\n\n"
+            while True:
+                message = await subscription.get(timeout=heartbeat)
+                if message is None:
+                    # 接続を維持するためのコメント行
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"data: {json.dumps(message)}\n\n"
+
+    return event_stream_response(events())
+
 @login_required
 def remove_tag_from_store(request, store_id):
     """店舗からタグを削除"""
@@ -552,7 +725,9 @@ def remove_tag_from_store(request, store_id):
     
     try:
         tag = Tag.objects.get(id=tag_id)
-        store.tags.remove(tag)
+        remove_store_tag(store, tag)
+        update_search_index(store)
+        bump_store_version(store.id)
         return JsonResponse({
             'success': True,
             'message': 'タグが削除されました'
@@ -562,31 +737,47 @@ def remove_tag_from_store(request, store_id):
     except Exception as e:
         return JsonResponse({'success': False, 'message': str(e)}, status=500)
 
+@query_budget(5)
 @login_required
 def user_list(request):
-    # 自分以外の全ユーザーを取得
-    all_users = User.objects.select_related('profile').exclude(id=request.user.id).order_by('username')
+    query = (request.GET.get('q') or '').strip()
     
-    # 現在のユーザーがフォローしているユーザーのIDリスト
-    following_ids = set(Follow.objects.filter(follower=request.user).values_list('following_id', flat=True))
+    # 自分以外のユーザーをユーザー名順に1ページ分だけ取得（表示に使う列だけを読む）
+    users = User.objects.exclude(id=request.user.id)
+    if query:
+        users = users.filter(username__startswith=query)
+    page = paginate_by_field(
+        users.values('id', 'username', 'profile__avatar_key'),
+        'username',
+        request.GET.get('cursor'),
+        get_page_size(request),
+    )
     
-    # 現在のユーザーをフォローしているユーザーのIDリスト
-    followers_ids = set(Follow.objects.filter(following=request.user).values_list('follower_id', flat=True))
+    # フォロー状態はこのページのユーザーの分だけ調べる
+    follow_graph = FollowGraph.for_user_ids(request.user, [row['id'] for row in page])
 
     users_with_status = []
-    for user in all_users:
-        is_following = user.id in following_ids
-        is_followed_by = user.id in followers_ids
-        is_friend = is_following and is_followed_by
-        
+    for row in page:
+        avatar_key = row['profile__avatar_key']
         users_with_status.append({
-            'user': user,
-            'is_following': is_following,
-            'is_friend': is_friend,
+            'user': {
+                'id': row['id'],
+                'username': row['username'],
+                'avatar_url': reverse('blob_image', args=[avatar_key]) if avatar_key else None,
+            },
+            'is_following': follow_graph.is_following(row['id']),
+            'is_friend': follow_graph.is_friend(row['id']),
         })
 
-    return render(request, 'reviews/user_list.html', {'users_with_status': users_with_status})
+    return render(request, 'reviews/user_list.html', {
+        'users_with_status': users_with_status,
+        'page': page,
+        'query': query,
+        # 「知り合いかも」は検索していない1ページ目にだけ出す
+        'people_suggestions': [] if query or request.GET.get('cursor') else _people_suggestions(request),
+    })
 
+@query_budget(12)
 @login_required
 def send_dm(request, user_id):
     """DMの会話画面とメッセージ送信"""
@@ -596,11 +787,8 @@ def send_dm(request, user_id):
     if recipient == request.user:
         return redirect('user_list')
 
-    # 2人のユーザーを含む会話を取得または作成
-    conversation = Conversation.objects.filter(participants=request.user).filter(participants=recipient).first()
-    if not conversation:
-        conversation = Conversation.objects.create()
-        conversation.participants.add(request.user, recipient)
+    # 2人のユーザーの会話を取得または作成
+    conversation = Conversation.get_or_create_between(request.user, recipient)
 
     if request.method == 'POST':
         form = DirectMessageForm(request.POST)
@@ -608,20 +796,33 @@ def send_dm(request, user_id):
             message = form.save(commit=False)
             message.conversation = conversation
             message.sender = request.user
-            message.save()
+            with transaction.atomic():
+                message.save()
+                # 受信箱の並び順のために会話の更新日時を進める
+                Conversation.objects.filter(id=conversation.id).update(updated_at=message.created_at)
+                publish_message(message)
+            # JSで送信した場合は作成したメッセージだけを返す（会話全体は再読み込みしない）
+            if request.GET.get('format') == 'json':
+                return JsonResponse({'success': True, 'message': message_to_dict(message)}, status=201)
             # POST後は同じページにリダイレクトしてフォームの再送信を防ぐ
             return redirect('send_dm', user_id=recipient.id)
+        if request.GET.get('format') == 'json':
+            return JsonResponse({'success': False, 'errors': form.errors}, status=400)
     else:
         form = DirectMessageForm()
 
+    # 開いた時点で相手からのメッセージを既読にする
+    mark_conversation_read(conversation.id, request.user)
+
     # 会話のメッセージを取得
-    messages = conversation.messages.all().order_by('created_at')
+    messages = list(conversation.messages.select_related('sender').order_by('id'))
 
     # テンプレートをレンダリング
     return render(request, 'reviews/dm_conversation.html', {
         'recipient': recipient,
         'conversation': conversation,
         'messages': messages,
+        'last_message_id': messages[-1].id if messages else 0,
         'form': form,
     })
 
@@ -643,10 +844,225 @@ def delete_dm(request, message_id):
     recipient = message.conversation.participants.exclude(id=request.user.id).first()
     recipient_id = recipient.id if recipient else None
 
+    conversation_id, message_id = message.conversation_id, message.id
     message.delete()
+    publish_deleted(conversation_id, message_id)
     messages.success(request, "メッセージを削除しました。")
 
     if recipient_id:
         return redirect('send_dm', user_id=recipient_id)
     else:
         return redirect('user_list')
+
+
+@query_budget(4)
+@login_required
+def dm_inbox(request):
+    """DMの受信箱（会話の一覧）"""
+    conversations = list(Conversation.objects.inbox_for(request.user))
+    for conversation in conversations:
+        conversation.other_user = conversation.get_other_user(request.user)
+        # プロフィール未作成のユーザーもいる
+        profile = getattr(conversation.other_user, 'profile', None)
+        conversation.other_avatar_url = profile.get_avatar_url() if profile else None
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'conversations': [{
+                'id': conversation.id,
+                'other_user': {
+                    'id': conversation.other_user.id,
+                    'username': conversation.other_user.username,
+                    'avatar_url': conversation.other_avatar_url,
+                },
+                'last_message': {
+                    'content': conversation.last_message_content,
+                    'sender_id': conversation.last_message_sender_id,
+                    'created_at': conversation.last_message_at.isoformat(),
+                },
+                'unread_count': conversation.unread_count,
+                'url': reverse('send_dm', args=[conversation.other_user.id]),
+            } for conversation in conversations],
+        })
+
+    return render(request, 'reviews/dm_inbox.html', {
+        'conversations': conversations,
+    })
+
+@login_required
+def dm_mark_read(request, conversation_id):
+    """会話を開いている間に届いたメッセージを既読にする"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'POST method required'}, status=405)
+    conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
+    updated = mark_conversation_read(conversation.id, request.user)
+    return JsonResponse({'success': True, 'updated': updated})
+
+@query_budget(5)
+@login_required
+@require_GET
+def dm_messages(request, conversation_id):
+    """
+    会話のうち ?since=<メッセージID> より後のメッセージだけをJSONで返す。
+    1回に返すのは MAX_MESSAGES_PER_FETCH 件までで、続きがあれば has_more が true になる。
+    """
+    conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
+    try:
+        since_id = int(request.GET.get('since', 0))
+    except (TypeError, ValueError):
+        since_id = 0
+
+    # 1件多く読んで続きがあるかを判定する
+    messages = [message_to_dict(message)
+                for message in messages_since(conversation.id, since_id, limit=MAX_MESSAGES_PER_FETCH + 1)]
+    has_more = len(messages) > MAX_MESSAGES_PER_FETCH
+    messages = messages[:MAX_MESSAGES_PER_FETCH]
+    return JsonResponse({
+        'messages': messages,
+        'last_id': messages[-1]['id'] if messages else since_id,
+        'has_more': has_more,
+    })
+
+async def dm_stream(request, conversation_id):
+    """
+    会話の新着・削除をServer-Sent Eventsで送り続ける（ASGIのときだけ。WSGIでは204を返し、ページ側がポーリングする）。
+    メッセージのイベントにはIDを付けるので、再接続時はブラウザが送るLast-Event-ID以降の分をDBから補う。
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponse(status=401)
+    if not await Conversation.objects.filter(id=conversation_id, participants=user).aexists():
+        raise Http404
+    if not can_stream(request):
+        return stream_unavailable()
+
+    try:
+        last_id = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        last_id = 0
+    heartbeat = getattr(settings, 'SSE_HEARTBEAT_INTERVAL', 25)
+
+    def format_event(event):
+        if event['type'] == 'message':
+            return f"id: {event['message']['id']}\ndata: {json.dumps(event)}\n\n"
+        return f"data: {json.dumps(event)}\n\n"
+
+    async def events():
+        # 購読を始めてから取りこぼし分を読むことで、その間に送られたメッセージを落とさない
+        subscription = get_broker().subscribe(conversation_channel(conversation_id))
+        async with subscription:
+            sent_id = last_id
+            # 1回に読むのは MAX_MESSAGES_PER_FETCH 件までなので、追いつくまで続けて読む
+            while sent_id:
+                missed = [message async for message in messages_since(conversation_id, sent_id)]
+                for message in missed:
+                    yield format_event({'type': 'message', 'message': message_to_dict(message)})
+                    sent_id = message.id
+                if len(missed) < MAX_MESSAGES_PER_FETCH:
+                    break
+            while True:
+                event = await subscription.get(timeout=heartbeat)
+                if event is None:
+                    yield ': keepalive\n\n'
+                    continue
+                if event['type'] == 'message':
+                    # 取りこぼし分として送ったものは重複させない
+                    if event['message']['id'] <= sent_id:
+                        continue
+                    sent_id = event['message']['id']
+                yield format_event(event)
+
+    return event_stream_response(events())
+
+
+@query_budget(0)
+@require_GET
+def blob_image(request, key):
+    """ブロブストレージの画像を配信する（内容が変わらないので長期キャッシュ可能）"""
+    if not is_valid_blob_key(key):
+        raise Http404
+
+    etag = f'"{key}"'
+    cache_control = 'public, max-age=31536000, immutable'
+
+    def not_modified():
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Cache-Control'] = cache_control
+        return response
+
+    # キーが同じなら中身も同じなので、ETagが一致すれば本文を返さない
+    if_none_match = request.headers.get('If-None-Match', '')
+    if etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return not_modified()
+
+    try:
+        blob = get_blob_store().open(key)
+    except FileNotFoundError:
+        raise Http404
+
+    # 「*」は何かしらの表現があるときだけ一致する（存在しないキーは上で404になる）
+    if if_none_match.strip() == '*':
+        blob.close()
+        return not_modified()
+
+    response = FileResponse(blob, content_type='image/jpeg')
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response
+
+
+# 読み取り専用API（v1）
+# .values() の行から直接JSONを作り、?fields= で選ばれた項目の列だけを読む
+@query_budget(2)
+@require_GET
+@cache_control(no_cache=True)
+@condition(etag_func=api_stores_etag)
+def api_store_list(request):
+    """店舗の一覧（新しい順、カーソルでページング。?tag= を複数指定するとすべてのタグを持つ店舗、?match=any でいずれか）"""
+    try:
+        fields = api.parse_fields(request, api.STORE_FIELDS)
+        tag_ids = api.parse_tag_ids(request)
+    except api.ApiError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    match = MATCH_ANY if request.GET.get('match') == MATCH_ANY else MATCH_ALL
+    stores = filter_stores_by_tags(Store.objects.all(), tag_ids, match)
+    page = paginate_by_keyset(
+        stores.values(*api.select_columns(fields, api.STORE_FIELDS)),
+        request.GET.get('cursor'),
+        get_page_size(request),
+    )
+    if 'tags' in fields:
+        api.attach_store_tags(page.object_list)
+
+    return JsonResponse({
+        'results': api.serialize_rows(page.object_list, fields, api.STORE_FIELDS),
+        'next_cursor': page.next_cursor,
+    })
+
+
+@query_budget(2)
+@require_GET
+@cache_control(no_cache=True)
+@condition(etag_func=api_store_reviews_etag)
+def api_store_reviews(request, store_id):
+    """店舗のレビュー（新しい順、カーソルでページング）"""
+    try:
+        fields = api.parse_fields(request, api.REVIEW_FIELDS)
+    except api.ApiError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    page = paginate_by_keyset(
+        Review.objects.filter(store_id=store_id).values(*api.select_columns(fields, api.REVIEW_FIELDS)),
+        request.GET.get('cursor'),
+        get_page_size(request),
+    )
+    # レビューが1件もない場合だけ、店舗が存在するかを確かめる
+    if not page.object_list and not Store.objects.filter(id=store_id).exists():
+        return JsonResponse({'error': '店舗が見つかりません'}, status=404)
+
+    return JsonResponse({
+        'results': api.serialize_rows(page.object_list, fields, api.REVIEW_FIELDS),
+        'next_cursor': page.next_cursor,
+    })